@@ -0,0 +1,20 @@
+-- Migration: High-water marks for incremental preprocessing
+-- jobs.preprocess records, per raw source table, the newest created_at and date it has aggregated.
+-- The next run only re-aggregates weeks touched by rows beyond those marks.
+-- Safe to run multiple times.
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS ops.etl_watermark (
+    source_table TEXT PRIMARY KEY,
+    max_created_at TIMESTAMPTZ,
+    max_date DATE,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- Support the "created_at > watermark OR date > watermark" probes
+CREATE INDEX IF NOT EXISTS idx_sales_created_at ON raw.sales_fact (created_at);
+CREATE INDEX IF NOT EXISTS idx_inv_created_at ON raw.inventory_snapshot (created_at);
+CREATE INDEX IF NOT EXISTS idx_inv_date ON raw.inventory_snapshot (date);
+
+COMMIT;
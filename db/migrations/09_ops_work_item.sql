@@ -0,0 +1,27 @@
+-- Migration: Work items for multi-node forecasting runs
+-- A coordinator splits a batch run's series into ops.work_item rows; workers on any host claim
+-- them with SELECT ... FOR UPDATE SKIP LOCKED under a time-limited lease, write results and
+-- mark them done. Items whose lease expired are claimable again.
+-- Safe to run multiple times.
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS ops.work_item (
+    run_id UUID NOT NULL REFERENCES ops.batch_run (run_id) ON UPDATE CASCADE ON DELETE CASCADE,
+    item_no INTEGER NOT NULL CHECK (item_no >= 0),
+    sku_ids TEXT[] NOT NULL,
+    location_ids TEXT[] NOT NULL CHECK (cardinality(location_ids) = cardinality(sku_ids)),
+    status TEXT NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'leased', 'done', 'failed')),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    leased_by TEXT,
+    lease_expires_at TIMESTAMPTZ,
+    started_at TIMESTAMPTZ,
+    finished_at TIMESTAMPTZ,
+    notes TEXT,
+    PRIMARY KEY (run_id, item_no)
+);
+
+-- Claim probe: next pending (or expired) item of a run
+CREATE INDEX IF NOT EXISTS idx_work_item_claim ON ops.work_item (run_id, status, item_no);
+
+COMMIT;
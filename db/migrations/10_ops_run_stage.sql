@@ -0,0 +1,31 @@
+-- Migration: Per-stage timing and resource metrics for job runs
+-- Jobs instrumented with jobs.utils.instrument write one row per named stage (DB reads, fitting,
+-- MLflow logging, writes, ...) with wall/CPU seconds, rows handled and memory peaks.
+-- run_id is the job's ops.batch_run id where it has one; ingest and preprocess, which do not
+-- record batch runs, use a fresh id, so there is no foreign key. Workers of a coordinated run
+-- (ops.work_item) each record their own rows under worker_id.
+-- Safe to run multiple times.
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS ops.run_stage (
+    run_id UUID NOT NULL,
+    job_type TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    worker_id TEXT NOT NULL DEFAULT '',
+    stage_order INTEGER NOT NULL,
+    calls INTEGER NOT NULL DEFAULT 1,
+    started_at TIMESTAMPTZ NOT NULL,
+    wall_seconds DOUBLE PRECISION NOT NULL,
+    cpu_seconds DOUBLE PRECISION NOT NULL,
+    row_count BIGINT NOT NULL DEFAULT 0,
+    rss_peak_mb DOUBLE PRECISION,
+    rss_growth_mb DOUBLE PRECISION,
+    traced_peak_mb DOUBLE PRECISION,
+    recorded_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (run_id, stage, worker_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_run_stage_job_type_recorded ON ops.run_stage (job_type, recorded_at);
+
+COMMIT;
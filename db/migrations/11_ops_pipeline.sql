@@ -0,0 +1,42 @@
+-- Migration: DAG pipeline runs
+-- jobs.pipeline records each execution of the ingest -> preprocess -> {train_baseline, train_ml}
+-- -> compute_policy DAG as an ops.batch_run with job_type 'pipeline', and the state of every
+-- stage in ops.pipeline_stage: the input watermarks it ran against (used to skip unchanged
+-- stages next time), attempts, and the outcome (used to resume from the failed stage).
+-- Safe to run multiple times.
+
+BEGIN;
+
+ALTER TABLE ops.batch_run DROP CONSTRAINT IF EXISTS batch_run_job_type_check;
+ALTER TABLE ops.batch_run
+ADD CONSTRAINT batch_run_job_type_check CHECK (
+        job_type IN (
+            'train',
+            'batch_inference',
+            'compute_policy',
+            'monitor',
+            'train_ml',
+            'pipeline'
+        )
+    );
+
+CREATE TABLE IF NOT EXISTS ops.pipeline_stage (
+    run_id UUID NOT NULL REFERENCES ops.batch_run (run_id) ON UPDATE CASCADE ON DELETE CASCADE,
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending' CHECK (
+        status IN ('pending', 'running', 'succeeded', 'skipped', 'failed', 'blocked')
+    ),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    command TEXT,
+    input_signature JSONB,
+    started_at TIMESTAMPTZ,
+    finished_at TIMESTAMPTZ,
+    error TEXT,
+    PRIMARY KEY (run_id, stage)
+);
+
+-- Last successful execution of a stage (change detection)
+CREATE INDEX IF NOT EXISTS idx_pipeline_stage_stage_finished ON ops.pipeline_stage (stage, finished_at DESC)
+WHERE status IN ('succeeded', 'skipped');
+
+COMMIT;
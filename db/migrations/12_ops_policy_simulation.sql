@@ -0,0 +1,46 @@
+-- Migration: Monte Carlo policy simulation results
+-- jobs.simulate_policy replays simulated demand paths through the ROP / order-up-to decisions of a
+-- compute_policy run and records, per SKU-location, the achieved fill rate, cycle service level
+-- (share of weeks without a stockout), stockout weeks and average on-hand next to the target
+-- service level. Runs are ops.batch_run rows with job_type 'simulate_policy'.
+-- Safe to run multiple times.
+
+BEGIN;
+
+ALTER TABLE ops.batch_run DROP CONSTRAINT IF EXISTS batch_run_job_type_check;
+ALTER TABLE ops.batch_run
+ADD CONSTRAINT batch_run_job_type_check CHECK (
+        job_type IN (
+            'train',
+            'batch_inference',
+            'compute_policy',
+            'monitor',
+            'train_ml',
+            'pipeline',
+            'simulate_policy'
+        )
+    );
+
+CREATE TABLE IF NOT EXISTS ops.policy_simulation (
+    run_id UUID NOT NULL REFERENCES ops.batch_run (run_id) ON UPDATE CASCADE ON DELETE CASCADE,
+    sku_id TEXT NOT NULL REFERENCES raw.sku_dim (sku_id) ON UPDATE CASCADE ON DELETE CASCADE,
+    location_id TEXT NOT NULL REFERENCES raw.location_dim (location_id) ON UPDATE CASCADE ON DELETE CASCADE,
+    policy_run_id UUID NOT NULL REFERENCES ops.batch_run (run_id) ON UPDATE CASCADE ON DELETE CASCADE,
+    demand_source TEXT NOT NULL CHECK (demand_source IN ('history', 'residuals')),
+    paths INTEGER NOT NULL CHECK (paths > 0),
+    weeks INTEGER NOT NULL CHECK (weeks > 0),
+    lead_time_weeks INTEGER NOT NULL,
+    service_level NUMERIC(4, 3) NOT NULL,
+    rop_units NUMERIC(18, 4) NOT NULL,
+    order_up_to_units NUMERIC(18, 4) NOT NULL,
+    fill_rate DOUBLE PRECISION NOT NULL,
+    cycle_service_level DOUBLE PRECISION NOT NULL,
+    stockout_weeks DOUBLE PRECISION NOT NULL,
+    avg_on_hand DOUBLE PRECISION NOT NULL,
+    computed_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (run_id, sku_id, location_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_policy_simulation_policy_run ON ops.policy_simulation (policy_run_id);
+
+COMMIT;
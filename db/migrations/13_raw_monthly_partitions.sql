@@ -0,0 +1,172 @@
+-- Migration: Monthly range partitioning of raw.sales_fact and raw.inventory_snapshot
+-- Both daily fact tables become PARTITION BY RANGE (date). The existing heap of each is not copied:
+-- it is attached as one partition, <table>_legacy, covering the months it already holds, up to
+-- the month after the later of its newest row and today. New months get one partition each,
+-- <table>_yYYYYmMM, created ahead by jobs.ingest / jobs.partitions ensure. Old months are
+-- detached or archived by jobs.partitions retain, with no DELETE involved.
+-- Both tables get the same legacy bounds, so their partitions line up (partition-wise joins).
+-- To avoid a table rewrite or a long exclusive lock, this runs in three steps:
+--   1. add the legacy range as a NOT VALID CHECK (catalog only);
+--   2. VALIDATE it in its own transaction (one scan under SHARE UPDATE EXCLUSIVE, which does not
+--      block reads or writes);
+--   3. rename the heap, create the partitioned table under the old name and ATTACH the heap.
+--      The validated CHECK lets ATTACH skip its scan; existing indexes, CHECKs and foreign keys
+--      are adopted by the parent's, not rebuilt.
+-- An empty heap (fresh database) is dropped instead, and its months get regular partitions.
+-- Between steps 1 and 3, rows dated past the legacy range are rejected; the gap lasts as long as
+-- the validation scan.
+-- Safe to run multiple times.
+
+-- Step 1: legacy range as a NOT VALID CHECK
+BEGIN;
+SET LOCAL lock_timeout = '10s';
+
+DO $$
+DECLARE
+    t TEXT;
+    lo DATE;
+    hi DATE;
+BEGIN
+    SELECT date_trunc('month', LEAST(
+               (SELECT MIN(date) FROM raw.sales_fact),
+               (SELECT MIN(date) FROM raw.inventory_snapshot),
+               CURRENT_DATE))::date,
+           (date_trunc('month', GREATEST(
+               (SELECT MAX(date) FROM raw.sales_fact),
+               (SELECT MAX(date) FROM raw.inventory_snapshot),
+               CURRENT_DATE)) + INTERVAL '1 month')::date
+    INTO lo, hi;
+    FOREACH t IN ARRAY ARRAY['sales_fact', 'inventory_snapshot'] LOOP
+        IF EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = format('raw.%I', t)::regclass)
+           OR EXISTS (SELECT 1 FROM pg_constraint
+                      WHERE conrelid = format('raw.%I', t)::regclass AND conname = t || '_legacy_range') THEN
+            CONTINUE;
+        END IF;
+        EXECUTE format(
+            'ALTER TABLE raw.%I ADD CONSTRAINT %I CHECK (date >= %L::date AND date < %L::date) NOT VALID',
+            t, t || '_legacy_range', lo, hi
+        );
+    END LOOP;
+END $$;
+
+COMMIT;
+
+-- Step 2: validate, one transaction of its own
+DO $$
+DECLARE
+    t TEXT;
+BEGIN
+    FOREACH t IN ARRAY ARRAY['sales_fact', 'inventory_snapshot'] LOOP
+        IF EXISTS (SELECT 1 FROM pg_constraint
+                   WHERE conrelid = format('raw.%I', t)::regclass AND conname = t || '_legacy_range'
+                     AND NOT convalidated) THEN
+            EXECUTE format('ALTER TABLE raw.%I VALIDATE CONSTRAINT %I', t, t || '_legacy_range');
+        END IF;
+    END LOOP;
+END $$;
+
+-- Step 3: swap in the partitioned tables and attach the heaps
+BEGIN;
+SET LOCAL lock_timeout = '10s';
+
+DO $$
+DECLARE
+    bounds TEXT[];
+    first_month DATE;
+    m DATE;
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'raw.sales_fact'::regclass) THEN
+        RETURN;
+    END IF;
+    SELECT array_agg(b[1] ORDER BY b[1]) INTO bounds
+    FROM pg_constraint c, regexp_matches(pg_get_constraintdef(c.oid), '''(\d{4}-\d{2}-\d{2})''', 'g') AS b
+    WHERE c.conrelid = 'raw.sales_fact'::regclass AND c.conname = 'sales_fact_legacy_range';
+
+    ALTER TABLE raw.sales_fact RENAME TO sales_fact_legacy;
+    ALTER INDEX raw.sales_fact_pkey RENAME TO sales_fact_legacy_pkey;
+    ALTER INDEX IF EXISTS raw.idx_sales_sku_loc_date RENAME TO idx_sales_legacy_sku_loc_date;
+    ALTER INDEX IF EXISTS raw.idx_sales_date RENAME TO idx_sales_legacy_date;
+    ALTER INDEX IF EXISTS raw.idx_sales_created_at RENAME TO idx_sales_legacy_created_at;
+
+    CREATE TABLE raw.sales_fact (
+        sku_id TEXT NOT NULL CONSTRAINT sales_fact_sku_id_fkey REFERENCES raw.sku_dim (sku_id) ON UPDATE CASCADE ON DELETE CASCADE,
+        location_id TEXT NOT NULL CONSTRAINT sales_fact_location_id_fkey REFERENCES raw.location_dim (location_id) ON UPDATE CASCADE ON DELETE CASCADE,
+        date DATE NOT NULL CONSTRAINT sales_fact_date_fkey REFERENCES raw.calendar_dim (date) ON UPDATE CASCADE ON DELETE RESTRICT,
+        units_sold INTEGER NOT NULL CONSTRAINT sales_fact_units_sold_check CHECK (units_sold >= 0),
+        source TEXT,
+        created_at TIMESTAMPTZ DEFAULT NOW(),
+        PRIMARY KEY (sku_id, location_id, date)
+    ) PARTITION BY RANGE (date);
+    CREATE INDEX idx_sales_sku_loc_date ON raw.sales_fact (sku_id, location_id, date);
+    CREATE INDEX idx_sales_date ON raw.sales_fact (date);
+    CREATE INDEX idx_sales_created_at ON raw.sales_fact (created_at);
+
+    IF EXISTS (SELECT 1 FROM raw.sales_fact_legacy) THEN
+        EXECUTE format(
+            'ALTER TABLE raw.sales_fact ATTACH PARTITION raw.sales_fact_legacy FOR VALUES FROM (%L) TO (%L)',
+            bounds[1], bounds[2]
+        );
+        first_month := bounds[2]::date;
+    ELSE
+        DROP TABLE raw.sales_fact_legacy;
+        first_month := bounds[1]::date;
+    END IF;
+    FOR m IN SELECT generate_series(first_month, bounds[2]::date + INTERVAL '1 month', INTERVAL '1 month') LOOP
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS raw.%I PARTITION OF raw.sales_fact FOR VALUES FROM (%L) TO (%L)',
+            'sales_fact_' || to_char(m, '"y"YYYY"m"MM'), m, (m + INTERVAL '1 month')::date
+        );
+    END LOOP;
+END $$;
+
+DO $$
+DECLARE
+    bounds TEXT[];
+    first_month DATE;
+    m DATE;
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'raw.inventory_snapshot'::regclass) THEN
+        RETURN;
+    END IF;
+    SELECT array_agg(b[1] ORDER BY b[1]) INTO bounds
+    FROM pg_constraint c, regexp_matches(pg_get_constraintdef(c.oid), '''(\d{4}-\d{2}-\d{2})''', 'g') AS b
+    WHERE c.conrelid = 'raw.inventory_snapshot'::regclass AND c.conname = 'inventory_snapshot_legacy_range';
+
+    ALTER TABLE raw.inventory_snapshot RENAME TO inventory_snapshot_legacy;
+    ALTER INDEX raw.inventory_snapshot_pkey RENAME TO inventory_snapshot_legacy_pkey;
+    ALTER INDEX IF EXISTS raw.idx_inv_sku_loc_date RENAME TO idx_inv_legacy_sku_loc_date;
+    ALTER INDEX IF EXISTS raw.idx_inv_date RENAME TO idx_inv_legacy_date;
+    ALTER INDEX IF EXISTS raw.idx_inv_created_at RENAME TO idx_inv_legacy_created_at;
+
+    CREATE TABLE raw.inventory_snapshot (
+        sku_id TEXT NOT NULL CONSTRAINT inventory_snapshot_sku_id_fkey REFERENCES raw.sku_dim (sku_id) ON UPDATE CASCADE ON DELETE CASCADE,
+        location_id TEXT NOT NULL CONSTRAINT inventory_snapshot_location_id_fkey REFERENCES raw.location_dim (location_id) ON UPDATE CASCADE ON DELETE CASCADE,
+        date DATE NOT NULL CONSTRAINT inventory_snapshot_date_fkey REFERENCES raw.calendar_dim (date) ON UPDATE CASCADE ON DELETE RESTRICT,
+        on_hand INTEGER NOT NULL CONSTRAINT inventory_snapshot_on_hand_check CHECK (on_hand >= 0),
+        on_order INTEGER NOT NULL DEFAULT 0 CONSTRAINT inventory_snapshot_on_order_check CHECK (on_order >= 0),
+        created_at TIMESTAMPTZ DEFAULT NOW(),
+        PRIMARY KEY (sku_id, location_id, date)
+    ) PARTITION BY RANGE (date);
+    CREATE INDEX idx_inv_sku_loc_date ON raw.inventory_snapshot (sku_id, location_id, date);
+    CREATE INDEX idx_inv_date ON raw.inventory_snapshot (date);
+    CREATE INDEX idx_inv_created_at ON raw.inventory_snapshot (created_at);
+
+    IF EXISTS (SELECT 1 FROM raw.inventory_snapshot_legacy) THEN
+        EXECUTE format(
+            'ALTER TABLE raw.inventory_snapshot ATTACH PARTITION raw.inventory_snapshot_legacy FOR VALUES FROM (%L) TO (%L)',
+            bounds[1], bounds[2]
+        );
+        first_month := bounds[2]::date;
+    ELSE
+        DROP TABLE raw.inventory_snapshot_legacy;
+        first_month := bounds[1]::date;
+    END IF;
+    FOR m IN SELECT generate_series(first_month, bounds[2]::date + INTERVAL '1 month', INTERVAL '1 month') LOOP
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS raw.%I PARTITION OF raw.inventory_snapshot FOR VALUES FROM (%L) TO (%L)',
+            'inventory_snapshot_' || to_char(m, '"y"YYYY"m"MM'), m, (m + INTERVAL '1 month')::date
+        );
+    END LOOP;
+END $$;
+
+COMMIT;
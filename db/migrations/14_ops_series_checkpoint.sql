@@ -0,0 +1,26 @@
+-- Migration: Per-series checkpoints and heartbeats of batch runs
+-- train_ml records every series whose results are written in ops.series_checkpoint, stores its
+-- options in ops.batch_run.config and refreshes ops.batch_run.heartbeat_at while it runs. A run
+-- whose heartbeat went stale (OOM kill, lost connection) is marked failed by the next start of
+-- the job and can be resumed with --resume, which only processes series without a checkpoint.
+-- Safe to run multiple times.
+
+BEGIN;
+
+ALTER TABLE ops.batch_run ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMPTZ;
+ALTER TABLE ops.batch_run ADD COLUMN IF NOT EXISTS config JSONB;
+
+CREATE TABLE IF NOT EXISTS ops.series_checkpoint (
+    run_id UUID NOT NULL REFERENCES ops.batch_run (run_id) ON UPDATE CASCADE ON DELETE CASCADE,
+    sku_id TEXT NOT NULL,
+    location_id TEXT NOT NULL,
+    model_name TEXT NOT NULL,
+    completed_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (run_id, sku_id, location_id)
+);
+
+-- Stale-run probe: running runs by job type
+CREATE INDEX IF NOT EXISTS idx_batch_run_running ON ops.batch_run (job_type, heartbeat_at)
+WHERE status = 'running';
+
+COMMIT;
@@ -0,0 +1,362 @@
+"""
+Pipeline benchmark suite on fixed-seed synthetic data.
+
+Each stage runs in its own spawned process so peak RSS is per stage. The
+in-memory stages time the core functions of ingest (simulation and row
+building), train_baseline, train_ml and compute_policy on generated inputs.
+With --db, the same stages (plus preprocess, which is SQL only) also run
+end to end against $PGDATABASE, which must be a scratch database with the
+migrations applied: synthetic data is written into it.
+
+Results go to a JSON file; with --baseline, every stage is compared against a
+stored result and the command exits non-zero if a stage regressed beyond
+--tolerance.
+
+    python -m jobs.benchmark --tier small --output bench.json
+    python -m jobs.benchmark --tier small --baseline bench.json
+"""
+from datetime import date, datetime, timedelta, timezone
+import argparse
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import sys
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+import uuid
+import numpy as np
+
+SEED = 42
+FIRST_WEEK = date(2023, 1, 2)  # a Monday; synthetic history starts here
+CHUNK_SKUS = 200
+
+
+class Tier(NamedTuple):
+    skus: int
+    locations: int
+    weeks: int
+    ml_series: int  # train_ml fits a sample of this many series
+
+    @property
+    def series(self) -> int:
+        return self.skus * self.locations
+
+
+TIERS = {
+    "small": Tier(skus=500, locations=2, weeks=104, ml_series=10),
+    "medium": Tier(skus=5000, locations=2, weeks=104, ml_series=40),
+    "large": Tier(skus=50000, locations=2, weeks=104, ml_series=100),
+}
+
+
+def series_keys(tier: Tier) -> List[Tuple[str, str]]:
+    """Keys in the SKU/location naming of jobs.ingest."""
+    return [(f"SKU{i+1:04d}", f"LOC{j+1}") for i in range(tier.skus) for j in range(tier.locations)]
+
+
+def synthetic_panel(tier: Tier, seed: int = SEED):
+    """Weekly demand with the ingest simulator's base/trend/season shape, drawn directly per week."""
+    from jobs.panel import DemandPanel
+
+    rng = np.random.default_rng(seed)
+    n = tier.series
+    base = rng.uniform(5, 50, size=n)
+    trend = rng.uniform(-0.05, 0.05, size=n)
+    t = np.arange(tier.weeks)
+    iso_w = np.array([(FIRST_WEEK + timedelta(weeks=int(k))).isocalendar()[1] for k in t], dtype=np.float64)
+    season = 1.0 + 0.3 * np.sin((iso_w / 52.0) * 2 * np.pi)
+    mean = np.maximum(0.0, base[:, None] * (1 + trend[:, None] * t) * season)
+    values = np.maximum(0, np.trunc(mean + mean * 0.3 * rng.standard_normal((n, tier.weeks)))).astype(np.int32)
+    return DemandPanel(series_keys(tier), FIRST_WEEK, values, np.ones(values.shape, dtype=bool))
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process so far (ru_maxrss is KiB on Linux, bytes on macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+# Stage functions take (tier, seed), build their inputs outside the timed
+# region and return timed(), which does the work and returns the (rows,
+# series) it processed.
+
+def stage_ingest(tier: Tier, seed: int):
+    from jobs.ingest import _simulate_block_numpy, _block_rows
+
+    dates = [FIRST_WEEK + timedelta(days=k) for k in range(tier.weeks * 7)]
+
+    def timed():
+        rows = 0
+        for lo in range(0, tier.skus, CHUNK_SKUS):
+            sku_indices = range(lo, min(lo + CHUNK_SKUS, tier.skus))
+            keys = [(f"SKU{i+1:04d}", f"LOC{j+1}") for i in sku_indices for j in range(tier.locations)]
+            units, on_hand, on_order = _simulate_block_numpy(seed, sku_indices, tier.locations, dates)
+            for _ in _block_rows(keys, dates, units):
+                rows += 1
+            for _ in _block_rows(keys, dates, on_hand, on_order):
+                rows += 1
+        return rows, tier.series
+    return timed
+
+
+def stage_train_baseline(tier: Tier, seed: int):
+    from jobs.train_baseline import H_DEFAULT, baseline_rows
+
+    panel = synthetic_panel(tier, seed)
+
+    def timed():
+        metric_rows, forecast_rows = baseline_rows(panel, panel.n_weeks - 1, H_DEFAULT, uuid.uuid4())
+        rows = sum(1 for _ in metric_rows) + sum(1 for _ in forecast_rows)
+        return rows, len(panel)
+    return timed
+
+
+def stage_train_ml(tier: Tier, seed: int, backtest_mode: str = "filter"):
+    from jobs.train_ml import H_DEFAULT, train_series
+
+    panel = synthetic_panel(Tier(tier.ml_series, 1, tier.weeks, tier.ml_series), seed)
+
+    def timed():
+        rows = 0
+        for series in panel:
+            result = train_series(series, panel.n_weeks - 1, H_DEFAULT, backtest_mode=backtest_mode)
+            rows += len(result['horizon_rows']) + len(result['models_results'][result['best_model_key']]['per_week'])
+        return rows, len(panel)
+    return timed
+
+
+def stage_compute_policy(tier: Tier, seed: int):
+    from jobs.compute_policy import build_recommendations
+
+    rng = random.Random(seed)
+    keys = series_keys(tier)
+    settings = {k: (rng.randint(1, 4), rng.choice([0.90, 0.95, 0.99])) for k in keys}
+    inventory = {k: (rng.randint(0, 500), rng.choice([0, 0, 100])) for k in keys}
+    lt_demand = {k: (rng.uniform(10, 200), rng.uniform(1, 20)) for k in keys}
+    latest = FIRST_WEEK + timedelta(weeks=tier.weeks - 1)
+
+    def timed():
+        rows = build_recommendations(uuid.uuid4(), latest, settings, inventory, lt_demand)
+        return len(rows), len(rows)
+    return timed
+
+
+def stage_ingest_db(tier: Tier, seed: int):
+    from jobs.ingest import (
+        seed_sku_dim, seed_location_dim, seed_calendar, seed_settings, seed_sales_and_inventory_numpy,
+    )
+    from jobs.utils.db import get_conn, BULK_LOAD_SESSION
+    from jobs.utils.partitions import PARTITIONED_TABLES, ensure_partitions
+
+    end_date = FIRST_WEEK + timedelta(days=tier.weeks * 7 - 1)
+
+    def timed():
+        random.seed(seed)
+        with get_conn(session=BULK_LOAD_SESSION) as conn:
+            seed_sku_dim(conn, tier.skus)
+            seed_location_dim(conn, tier.locations)
+            seed_calendar(conn, FIRST_WEEK, end_date)
+            for table in PARTITIONED_TABLES:
+                ensure_partitions(conn, table, FIRST_WEEK, end_date)
+            seed_settings(conn, tier.skus, tier.locations)
+            n_rows = seed_sales_and_inventory_numpy(
+                conn, tier.skus, tier.locations, FIRST_WEEK, end_date, seed=seed, chunk_skus=CHUNK_SKUS,
+            )
+        return 2 * n_rows, tier.series
+    return timed
+
+
+def stage_preprocess_db(tier: Tier, seed: int):
+    from jobs.preprocess import upsert_weekly_demand, upsert_weekly_inventory, recompute_weekly_features
+    from jobs.utils.db import get_conn, BULK_LOAD_SESSION
+
+    def timed():
+        with get_conn(session=BULK_LOAD_SESSION) as conn:
+            upsert_weekly_demand(conn)
+            upsert_weekly_inventory(conn)
+            recompute_weekly_features(conn)
+            with conn.cursor() as cur:
+                cur.execute("""
+                  SELECT COALESCE(SUM(n), 0), COUNT(*)
+                  FROM (SELECT COUNT(*) AS n FROM curated.weekly_demand GROUP BY sku_id, location_id) s
+                """)
+                rows, series = cur.fetchone()
+        return int(rows), int(series)
+    return timed
+
+
+def stage_train_baseline_db(tier: Tier, seed: int):
+    from jobs.train_baseline import H_DEFAULT, run_vectorized, write_batch_run_start, write_batch_run_finish
+    from jobs.utils.db import get_conn, BULK_LOAD_SESSION
+
+    def timed():
+        with get_conn(session=BULK_LOAD_SESSION) as conn:
+            run_id = write_batch_run_start(conn, "batch_inference")
+            forecasts, metrics = run_vectorized(conn, run_id, H_DEFAULT)
+            write_batch_run_finish(conn, run_id, notes=f"benchmark: forecasts={forecasts}, metrics={metrics}")
+        return forecasts + metrics, forecasts // H_DEFAULT
+    return timed
+
+
+def stage_compute_policy_db(tier: Tier, seed: int):
+    from jobs import compute_policy as cp
+    from jobs.utils.db import get_conn
+
+    def timed():
+        with get_conn() as conn:
+            run_id = cp.write_batch_run_start(conn, "compute_policy")
+            latest = cp.fetch_latest_week(conn)
+            inf_run = cp.fetch_latest_inference_run(conn)
+            if inf_run is None:
+                raise RuntimeError("No successful batch_inference run found")
+            rows = cp.build_recommendations(
+                run_id, latest, cp.fetch_settings(conn), cp.fetch_inventory_latest(conn, latest),
+                cp.fetch_lead_time_demand(conn, inf_run, latest),
+            )
+            cp.insert_recommendations(conn, run_id, rows)
+            cp.write_batch_run_finish(conn, run_id, notes=f"benchmark: recommendations={len(rows)}")
+        return len(rows), len(rows)
+    return timed
+
+
+MEMORY_STAGES: Dict[str, Callable] = {
+    "ingest": stage_ingest,
+    "train_baseline": stage_train_baseline,
+    "train_ml": stage_train_ml,
+    "compute_policy": stage_compute_policy,
+}
+DB_STAGES: Dict[str, Callable] = {
+    "ingest_db": stage_ingest_db,
+    "preprocess_db": stage_preprocess_db,
+    "train_baseline_db": stage_train_baseline_db,
+    "compute_policy_db": stage_compute_policy_db,
+}
+STAGES = {**MEMORY_STAGES, **DB_STAGES}
+
+
+def _run_stage(name: str, tier: Tier, seed: int, options: Dict) -> Dict:
+    """Child-process entry point: build the stage inputs, then time the stage."""
+    timed = STAGES[name](tier, seed, **options)
+    setup_rss = peak_rss_mb()
+    t0 = time.perf_counter()
+    rows, series = timed()
+    wall = time.perf_counter() - t0
+    return {
+        "wall_seconds": round(wall, 4),
+        "rows": rows,
+        "series": series,
+        "rows_per_sec": round(rows / wall, 2) if wall > 0 else None,
+        "series_per_sec": round(series / wall, 2) if wall > 0 else None,
+        "setup_rss_mb": round(setup_rss, 1),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def run_stage(name: str, tier: Tier, seed: int, options: Optional[Dict] = None) -> Dict:
+    """Run one stage in a fresh spawned process, so peak RSS covers that stage only."""
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(1) as pool:
+        return pool.apply(_run_stage, (name, tier, seed, options or {}))
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> List[Dict]:
+    """
+    Compare every stage present in both result sets: a stage regresses when
+    its series/sec (rows/sec if no series) drops below baseline * (1 - tolerance)
+    or its peak RSS grows above baseline * (1 + tolerance).
+    """
+    out = []
+    for name, cur in results["stages"].items():
+        ref = baseline.get("stages", {}).get(name)
+        if ref is None:
+            continue
+        rate_key = "series_per_sec" if cur.get("series_per_sec") and ref.get("series_per_sec") else "rows_per_sec"
+        rate_ratio = (cur[rate_key] or 0.0) / ref[rate_key] if ref.get(rate_key) else None
+        rss_ratio = cur["peak_rss_mb"] / ref["peak_rss_mb"] if ref.get("peak_rss_mb") else None
+        regressions = []
+        if rate_ratio is not None and rate_ratio < 1 - tolerance:
+            regressions.append(f"{rate_key} {rate_ratio:.2f}x")
+        if rss_ratio is not None and rss_ratio > 1 + tolerance:
+            regressions.append(f"peak_rss_mb {rss_ratio:.2f}x")
+        out.append({
+            "stage": name,
+            "throughput": rate_key,
+            "throughput_ratio": round(rate_ratio, 3) if rate_ratio is not None else None,
+            "peak_rss_ratio": round(rss_ratio, 3) if rss_ratio is not None else None,
+            "regressions": regressions,
+        })
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic data")
+    parser.add_argument("--tier", choices=sorted(TIERS), default="small",
+                        help="; ".join(f"{k}: {t.series} series x {t.weeks} weeks" for k, t in TIERS.items()))
+    parser.add_argument("--stages", type=str, default=None,
+                        help=f"Comma-separated subset of: {', '.join(STAGES)} (default: all in-memory stages, "
+                             "plus the *_db stages with --db)")
+    parser.add_argument("--db", action="store_true",
+                        help="Also run the database stages against $PGDATABASE (use a scratch database)")
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--ml-backtest-mode", choices=["refit", "filter"], default="filter",
+                        help="Backtest mode for the train_ml stage")
+    parser.add_argument("--output", type=str, default=None, help="Result JSON (default: benchmark-<tier>.json)")
+    parser.add_argument("--baseline", type=str, default=None, help="Stored result JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Allowed relative throughput drop / peak RSS growth before a stage is flagged")
+    args = parser.parse_args()
+    tier = TIERS[args.tier]
+
+    if args.stages:
+        names = [s.strip() for s in args.stages.split(",") if s.strip()]
+        unknown = [s for s in names if s not in STAGES]
+        if unknown:
+            parser.error(f"unknown stage(s): {', '.join(unknown)}")
+    else:
+        names = list(MEMORY_STAGES) + (list(DB_STAGES) if args.db else [])
+
+    results = {
+        "tier": args.tier,
+        "series": tier.series,
+        "weeks": tier.weeks,
+        "seed": args.seed,
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "stages": {},
+    }
+    print(f"Benchmark tier={args.tier} ({tier.series} series x {tier.weeks} weeks, seed={args.seed})")
+    print(f"  {'stage':<20}{'wall s':>10}{'rows/s':>14}{'series/s':>12}{'peak MB':>10}")
+    for name in names:
+        options = {"backtest_mode": args.ml_backtest_mode} if name == "train_ml" else {}
+        stage = run_stage(name, tier, args.seed, options)
+        results["stages"][name] = stage
+        print(f"  {name:<20}{stage['wall_seconds']:>10.2f}{stage['rows_per_sec'] or 0:>14,.0f}"
+              f"{stage['series_per_sec'] or 0:>12,.1f}{stage['peak_rss_mb']:>10.0f}")
+
+    regressed = False
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("tier") != args.tier:
+            print(f"  warning: baseline is tier={baseline.get('tier')}, this run is tier={args.tier}")
+        results["baseline"] = args.baseline
+        results["comparison"] = compare(results, baseline, args.tolerance)
+        print(f"Compared with {args.baseline} (tolerance {args.tolerance:.0%}):")
+        for row in results["comparison"]:
+            regressed |= bool(row["regressions"])
+            status = "REGRESSION " + ", ".join(row["regressions"]) if row["regressions"] else "ok"
+            print(f"  {row['stage']:<20}throughput x{row['throughput_ratio']}  peak rss x{row['peak_rss_ratio']}  {status}")
+
+    output = args.output or f"benchmark-{args.tier}.json"
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+    if regressed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
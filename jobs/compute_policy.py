@@ -1,10 +1,12 @@
+import argparse
 import uuid
 from datetime import date
-import math
 from typing import Dict, Tuple, Optional
-import psycopg2
-import psycopg2.extras
-from jobs.utils.db import get_conn
+import numpy as np
+from scipy.stats import norm
+from jobs.utils.db import get_conn, copy_upsert, register_statement, execute_prepared
+from jobs.utils.instrument import RunProfiler, stage, add_instrument_arguments
+from jobs.utils.snapshot import Snapshot, add_snapshot_arguments, open_snapshot
 
 Z_DEFAULTS = {0.90: 1.2816, 0.95: 1.6449, 0.99: 2.3263}
 def z_from_service_level(sl: float) -> float:
@@ -13,6 +15,43 @@ def z_from_service_level(sl: float) -> float:
     if sl >= 0.90: return Z_DEFAULTS[0.90]
     return 1.2816
 
+# z modes: 'exact' is the inverse normal CDF of the service level, 'legacy' snaps it to Z_DEFAULTS
+Z_MODES = ("exact", "legacy")
+POLICIES = {
+    "exact": 'ROP = mu_LT + z*sigma_LT, z = Phi^-1(service_level); qty = max(ROP - on_hand - on_order, 0)',
+    "legacy": 'ROP = mu_LT + z*sigma_LT; qty = max(ROP - on_hand - on_order, 0)',
+}
+SERVICE_LEVEL_CLIP = (0.5, 0.9999)  # z in [0, 3.719]; 1.0 would be an infinite safety stock
+
+def z_values(service_level: np.ndarray, z_mode: str = "exact") -> np.ndarray:
+    """z per service level; 'legacy' matches z_from_service_level."""
+    sl = np.asarray(service_level, dtype=np.float64)
+    if z_mode == "legacy":
+        return np.select(
+            [sl >= 0.99, sl >= 0.95, sl >= 0.90],
+            [Z_DEFAULTS[0.99], Z_DEFAULTS[0.95], Z_DEFAULTS[0.90]],
+            1.2816,
+        )
+    return norm.ppf(np.clip(sl, *SERVICE_LEVEL_CLIP))
+
+def policy_arrays(
+    mu_lt: np.ndarray, residual_std: np.ndarray, lead_time: np.ndarray,
+    service_level: np.ndarray, on_hand: np.ndarray, on_order: np.ndarray,
+    z_mode: str = "exact",
+) -> Dict[str, np.ndarray]:
+    """
+    Vectorized policy over aligned arrays, one element per SKU-location:
+    sigma_LT = residual_std * sqrt(max(lead_time, 1)), ROP = mu_LT + z*sigma_LT,
+    order_qty = floor(max(ROP - on_hand - on_order, 0)). Returns
+    {'z', 'sigma_lt', 'rop', 'order_qty'}.
+    """
+    lead_time = np.asarray(lead_time)
+    z = z_values(service_level, z_mode)
+    sigma_lt = np.asarray(residual_std, dtype=np.float64) * np.sqrt(np.where(lead_time > 0, lead_time, 1))
+    rop = np.asarray(mu_lt, dtype=np.float64) + z * sigma_lt
+    order_qty = np.maximum(rop - on_hand - on_order, 0).astype(np.int64)
+    return {"z": z, "sigma_lt": sigma_lt, "rop": rop, "order_qty": order_qty}
+
 def write_batch_run_start(conn, job_type: str) -> uuid.UUID:
     run_id = uuid.uuid4()
     with conn.cursor() as cur:
@@ -32,116 +71,208 @@ def write_batch_run_finish(conn, run_id: uuid.UUID, status: str = 'succeeded', n
         """, (status, notes, str(run_id)))
     conn.commit()
 
+# Hot lookups, prepared once per (pooled) connection
+LATEST_WEEK = register_statement(
+    "policy_latest_week", "SELECT MAX(week_start_date) FROM curated.weekly_demand"
+)
+SETTINGS = register_statement(
+    "policy_settings", "SELECT sku_id, location_id, lead_time_weeks, service_level FROM raw.sku_location_settings"
+)
+INVENTORY_LATEST = register_statement("policy_inventory_latest", """
+  SELECT sku_id, location_id, end_on_hand, end_on_order
+  FROM curated.weekly_inventory
+  WHERE week_start_date = $1::date
+""")
+LATEST_INFERENCE_RUN = register_statement("policy_latest_inference_run", """
+  SELECT run_id
+  FROM ops.batch_run
+  WHERE job_type = 'batch_inference' AND status = 'succeeded'
+  ORDER BY started_at DESC
+  LIMIT 1
+""")
+
 def fetch_latest_week(conn) -> date:
     with conn.cursor() as cur:
-        cur.execute("SELECT MAX(week_start_date) FROM curated.weekly_demand;")
+        execute_prepared(cur, LATEST_WEEK)
         row = cur.fetchone()
         if not row or not row[0]:
             raise RuntimeError("No weekly demand data found")
         return row[0]
 
 def fetch_settings(conn) -> Dict[Tuple[str,str], Tuple[int, float]]:
-    sql = "SELECT sku_id, location_id, lead_time_weeks, service_level FROM raw.sku_location_settings"
     with conn.cursor() as cur:
-        cur.execute(sql)
+        execute_prepared(cur, SETTINGS)
         rows = cur.fetchall()
     return {(sku, loc): (lt, float(sl)) for sku, loc, lt, sl in rows}
 
 def fetch_inventory_latest(conn, latest: date) -> Dict[Tuple[str,str], Tuple[int, int]]:
-    sql = """
-      SELECT sku_id, location_id, end_on_hand, end_on_order
-      FROM curated.weekly_inventory
-      WHERE week_start_date = %s
-    """
     with conn.cursor() as cur:
-        cur.execute(sql, (latest,))
+        execute_prepared(cur, INVENTORY_LATEST, (latest,))
         rows = cur.fetchall()
     return {(sku, loc): (int(oh), int(oo)) for sku, loc, oh, oo in rows}
 
+def snapshot_inventory_latest(snapshot: Snapshot, latest: date) -> Dict[Tuple[str,str], Tuple[int, int]]:
+    """fetch_inventory_latest from a snapshot's weekly_inventory."""
+    rows = np.flatnonzero(snapshot.column("weekly_inventory", "week_start_date") == np.datetime64(latest, "D"))
+    keys, bounds = snapshot.series("weekly_inventory")
+    series = np.searchsorted(bounds, rows, side="right") - 1
+    on_hand = snapshot.column("weekly_inventory", "end_on_hand")[rows]
+    on_order = snapshot.column("weekly_inventory", "end_on_order")[rows]
+    return {keys[s]: (int(oh), int(oo)) for s, oh, oo in zip(series.tolist(), on_hand.tolist(), on_order.tolist())}
+
 def fetch_latest_inference_run(conn) -> Optional[uuid.UUID]:
     with conn.cursor() as cur:
-        cur.execute("""
-          SELECT run_id
-          FROM ops.batch_run
-          WHERE job_type = 'batch_inference' AND status = 'succeeded'
-          ORDER BY started_at DESC
-          LIMIT 1
-        """)
+        execute_prepared(cur, LATEST_INFERENCE_RUN)
         row = cur.fetchone()
         return uuid.UUID(row[0]) if row and row[0] else None
 
-def fetch_forecasts_for_lt(conn, run_id: uuid.UUID, sku: str, loc: str, latest: date, lt: int) -> Tuple[float, float]:
+def fetch_lead_time_demand(conn, run_id: uuid.UUID, latest: date) -> Dict[Tuple[str,str], Tuple[float, float]]:
+    """
+    One streamed query for every series of the inference run: mu_LT is the sum
+    of the first max(lead_time_weeks, 1) horizon forecasts after `latest`, and
+    residual_std is taken from the first of them. Series without forecasts are
+    absent from the result (callers fall back to (0.0, 0.0)).
+    """
     sql = """
-      SELECT horizon_week_start, forecast_units::float, residual_std::float
-      FROM ops.forecast
-      WHERE run_id = %s AND sku_id = %s AND location_id = %s
-        AND horizon_week_start > %s
-      ORDER BY horizon_week_start ASC
-      LIMIT %s
+      SELECT f.sku_id, f.location_id, f.forecast_units::float, f.residual_std::float
+      FROM (
+        SELECT sku_id, location_id, horizon_week_start, forecast_units, residual_std,
+               ROW_NUMBER() OVER (PARTITION BY sku_id, location_id ORDER BY horizon_week_start) AS rn
+        FROM ops.forecast
+        WHERE run_id = %s AND horizon_week_start > %s
+      ) f
+      JOIN raw.sku_location_settings s
+        ON s.sku_id = f.sku_id AND s.location_id = f.location_id
+      WHERE f.rn <= GREATEST(s.lead_time_weeks, 1)
+      ORDER BY f.sku_id, f.location_id, f.horizon_week_start
     """
-    with conn.cursor() as cur:
-        cur.execute(sql, (str(run_id), sku, loc, latest, lt))
-        rows = cur.fetchall()
-    if not rows:
-        return 0.0, 0.0
-    mu = sum([float(r[1]) for r in rows])
-    residual_std = float(rows[0][2]) if rows[0][2] is not None else 0.0
-    return mu, residual_std
+    out: Dict[Tuple[str,str], Tuple[float, float]] = {}
+    with conn.cursor(name="lead_time_demand") as cur:
+        cur.itersize = 50000
+        cur.execute(sql, (str(run_id), latest))
+        for sku, loc, units, residual_std in cur:
+            key = (sku, loc)
+            if key in out:
+                mu, first_std = out[key]
+                out[key] = (mu + float(units), first_std)
+            else:
+                out[key] = (float(units), float(residual_std) if residual_std is not None else 0.0)
+    return out
+
+RECOMMENDATION_COLUMNS = [
+    "run_id", "sku_id", "location_id", "as_of_week_start",
+    "lead_time_weeks", "service_level", "rop_units",
+    "on_hand", "on_order", "order_qty",
+    "mu_lt", "sigma_lt", "z_value", "policy",
+]
 
 def insert_recommendations(conn, run_id: uuid.UUID, rows: list[tuple]):
-    sql = """
-      INSERT INTO ops.replenishment_recommendation (
-        run_id, sku_id, location_id, as_of_week_start,
-        lead_time_weeks, service_level, rop_units,
-        on_hand, on_order, order_qty,
-        mu_lt, sigma_lt, z_value, policy
-      ) VALUES %s
-      ON CONFLICT (run_id, sku_id, location_id, as_of_week_start) DO UPDATE SET
-        lead_time_weeks = EXCLUDED.lead_time_weeks,
-        service_level = EXCLUDED.service_level,
-        rop_units = EXCLUDED.rop_units,
-        on_hand = EXCLUDED.on_hand,
-        on_order = EXCLUDED.on_order,
-        order_qty = EXCLUDED.order_qty,
-        mu_lt = EXCLUDED.mu_lt,
-        sigma_lt = EXCLUDED.sigma_lt,
-        z_value = EXCLUDED.z_value,
-        computed_at = NOW()
+    copy_upsert(
+        conn, "ops.replenishment_recommendation", RECOMMENDATION_COLUMNS, rows,
+        conflict_columns=["run_id", "sku_id", "location_id", "as_of_week_start"],
+        update_columns=[
+            "lead_time_weeks", "service_level", "rop_units", "on_hand", "on_order",
+            "order_qty", "mu_lt", "sigma_lt", "z_value",
+        ],
+        touch_columns=["computed_at"],
+    )
+
+def policy_inputs(
+    settings: Dict[Tuple[str,str], Tuple[int, float]],
+    inventory: Dict[Tuple[str,str], Tuple[int, int]],
+    lt_demand: Dict[Tuple[str,str], Tuple[float, float]],
+) -> Tuple[list, Dict[str, np.ndarray]]:
     """
-    with conn.cursor() as cur:
-        psycopg2.extras.execute_values(cur, sql, rows, page_size=10000)
-    conn.commit()
+    (keys, arrays) for policy_arrays, one element per SKU-location in settings;
+    missing inventory counts as (0, 0) and missing forecasts as (0.0, 0.0).
+    """
+    keys = list(settings)
+    n = len(keys)
+    inv = [inventory.get(k, (0, 0)) for k in keys]
+    dem = [lt_demand.get(k, (0.0, 0.0)) for k in keys]
+    arrays = {
+        "lead_time": np.fromiter((lt for lt, _ in settings.values()), dtype=np.int64, count=n),
+        "service_level": np.fromiter((sl for _, sl in settings.values()), dtype=np.float64, count=n),
+        "on_hand": np.fromiter((oh for oh, _ in inv), dtype=np.int64, count=n),
+        "on_order": np.fromiter((oo for _, oo in inv), dtype=np.int64, count=n),
+        "mu_lt": np.fromiter((mu for mu, _ in dem), dtype=np.float64, count=n),
+        "residual_std": np.fromiter((sd for _, sd in dem), dtype=np.float64, count=n),
+    }
+    return keys, arrays
+
+def recommendation_rows(
+    run_id: uuid.UUID, latest: date, keys: list,
+    inputs: Dict[str, np.ndarray], outputs: Dict[str, np.ndarray], z_mode: str = "exact",
+) -> list[tuple]:
+    """Rows in RECOMMENDATION_COLUMNS order from policy_inputs / policy_arrays results."""
+    run, policy = str(run_id), POLICIES[z_mode]
+    return [
+        (run, sku, loc, latest, lt, sl, rop, oh, oo, qty, mu, sigma, z, policy)
+        for (sku, loc), lt, sl, rop, oh, oo, qty, mu, sigma, z in zip(
+            keys,
+            inputs["lead_time"].tolist(), inputs["service_level"].tolist(), outputs["rop"].tolist(),
+            inputs["on_hand"].tolist(), inputs["on_order"].tolist(), outputs["order_qty"].tolist(),
+            inputs["mu_lt"].tolist(), outputs["sigma_lt"].tolist(), outputs["z"].tolist(),
+        )
+    ]
+
+def build_recommendations(
+    run_id: uuid.UUID, latest: date,
+    settings: Dict[Tuple[str,str], Tuple[int, float]],
+    inventory: Dict[Tuple[str,str], Tuple[int, int]],
+    lt_demand: Dict[Tuple[str,str], Tuple[float, float]],
+    z_mode: str = "exact",
+) -> list[tuple]:
+    """One recommendation row (RECOMMENDATION_COLUMNS order) per SKU-location in settings."""
+    keys, inputs = policy_inputs(settings, inventory, lt_demand)
+    outputs = policy_arrays(
+        inputs["mu_lt"], inputs["residual_std"], inputs["lead_time"],
+        inputs["service_level"], inputs["on_hand"], inputs["on_order"], z_mode=z_mode,
+    )
+    return recommendation_rows(run_id, latest, keys, inputs, outputs, z_mode)
 
 def main():
-    with get_conn() as conn:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--z-mode", choices=Z_MODES, default="exact",
+                        help="exact: z = inverse normal CDF of the service level; "
+                             "legacy: z snapped to the 0.90/0.95/0.99 table (previous outputs)")
+    add_snapshot_arguments(parser)
+    add_instrument_arguments(parser)
+    args = parser.parse_args()
+
+    with get_conn() as conn, \
+            RunProfiler("compute_policy", profile=args.profile, trace_memory=args.trace_memory) as prof:
         run_id = write_batch_run_start(conn, "compute_policy")
-        latest = fetch_latest_week(conn)
-        settings = fetch_settings(conn)
-        inventory = fetch_inventory_latest(conn, latest)
-        inf_run = fetch_latest_inference_run(conn)
+        with stage("read_inputs") as s:
+            latest = fetch_latest_week(conn)
+            settings = fetch_settings(conn)
+            snapshot = open_snapshot(conn, args.snapshot_dir)
+            if snapshot is not None:
+                inventory = snapshot_inventory_latest(snapshot, latest)
+            else:
+                inventory = fetch_inventory_latest(conn, latest)
+            inf_run = fetch_latest_inference_run(conn)
+            s.rows = len(settings) + len(inventory)
         if inf_run is None:
+            prof.save(conn, run_id)
             write_batch_run_finish(conn, run_id, status="failed", notes="No successful batch_inference run found")
             raise RuntimeError("No successful batch_inference run found")
 
-        out_rows: list[tuple] = []
-        for (sku, loc), (lt, sl) in settings.items():
-            on_hand, on_order = inventory.get((sku, loc), (0, 0))
-            mu_lt, residual_std = fetch_forecasts_for_lt(conn, inf_run, sku, loc, latest, lt if lt > 0 else 1)
-            z = z_from_service_level(sl)
-            sigma_lt = float(residual_std * math.sqrt(lt if lt > 0 else 1))
-            rop = float(mu_lt + z * sigma_lt)
-            order_qty = int(max(rop - on_hand - on_order, 0))
-            out_rows.append((
-                str(run_id), sku, loc, latest,
-                lt, sl, rop,
-                on_hand, on_order, order_qty,
-                mu_lt, sigma_lt, z, 'ROP = mu_LT + z*sigma_LT; qty = max(ROP - on_hand - on_order, 0)'
-            ))
-
-        insert_recommendations(conn, run_id, out_rows)
-        notes = f"Computed {len(out_rows)} recommendations as_of={latest}"
+        with stage("read_lead_time_demand") as s:
+            lt_demand = fetch_lead_time_demand(conn, inf_run, latest)
+            s.rows = len(lt_demand)
+        with stage("compute") as s:
+            out_rows = build_recommendations(run_id, latest, settings, inventory, lt_demand, args.z_mode)
+            s.rows = len(out_rows)
+
+        with stage("write_recommendations") as s:
+            insert_recommendations(conn, run_id, out_rows)
+            s.rows = len(out_rows)
+        prof.save(conn, run_id)
+        notes = f"Computed {len(out_rows)} recommendations as_of={latest} z_mode={args.z_mode}"
         write_batch_run_finish(conn, run_id, status="succeeded", notes=notes)
         print(f"Policy run {run_id} completed. {notes}")
+        print(prof.report())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
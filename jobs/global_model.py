@@ -0,0 +1,173 @@
+"""
+Global gradient-boosted forecaster trained across all series on curated.weekly_features.
+
+One HistGradientBoostingRegressor learns units[t] / scale from the feature
+row of an origin week o (lags and rolling stats as of o), the units at o, the
+seasonal lag units[t - 52], the horizon h = t - o and the target's ISO week,
+where scale is the series' 8-week rolling mean at the origin (at least 1).
+Horizons are direct (h is an input), so every series x horizon is predicted
+in one batched call.
+
+Two fits per run, whatever the number of series: one on targets up to the
+start of the backtest window, whose one-step predictions over the window are
+the backtest rows, and one on all targets for the H-week forecasts.
+"""
+from datetime import date
+from typing import Dict, List, Tuple
+import numpy as np
+from sklearn.ensemble import HistGradientBoostingRegressor
+from jobs.panel import DemandPanel, SEASON, residual_std
+from jobs.utils.db import iter_groups
+
+MODEL_NAME = 'global_hgb_v1'
+FEATURE_COLUMNS = (
+    'lag_1', 'lag_2', 'lag_3', 'lag_4', 'lag_5', 'lag_6', 'lag_7', 'lag_8', 'lag_52',
+    'roll_mean_4', 'roll_std_4', 'roll_mean_8', 'roll_std_8',
+)
+SCALE_COLUMN = FEATURE_COLUMNS.index('roll_mean_8')
+TRAIN_WEEKS = 52  # origin weeks per series in each training set
+MAX_TRAIN_ROWS = 2_000_000  # (series, origin, horizon) samples per fit; larger sets are subsampled
+HGB_PARAMS = dict(loss='poisson', learning_rate=0.05, max_iter=300, max_leaf_nodes=31, min_samples_leaf=40)
+
+
+def load_features(conn, panel: DemandPanel, since: int) -> np.ndarray:
+    """
+    weekly_features rows of the panel's series from week index `since` on, as
+    a float32 (series, weeks, FEATURE_COLUMNS) array aligned with the panel;
+    NaN where a row or value is missing.
+    """
+    feats = np.full((panel.n_series, panel.n_weeks, len(FEATURE_COLUMNS)), np.nan, dtype=np.float32)
+    groups = iter_groups(conn, f"""
+      SELECT sku_id, location_id, week_start_date - %s, {', '.join(FEATURE_COLUMNS)}
+      FROM curated.weekly_features
+      WHERE week_start_date >= %s
+      ORDER BY sku_id, location_id, week_start_date
+    """, (panel.first_week, panel.week_start(since)), name="weekly_features_panel")
+    for key, rows in groups:
+        i = panel.codes.get(key)
+        if i is None:
+            continue
+        block = np.array(rows, dtype=np.float64)
+        cols = block[:, 0].astype(np.int64) // 7
+        keep = cols < panel.n_weeks
+        feats[i, cols[keep]] = block[keep, 1:]
+    return feats
+
+
+class _Design:
+    """Builds model inputs for (series row, origin week, horizon) triples of one panel."""
+
+    def __init__(self, panel: DemandPanel, feats: np.ndarray, H: int):
+        self.values = panel.values
+        self.mask = panel.mask
+        self.feats = feats
+        self.iso_week = np.array(
+            [panel.week_start(t).isocalendar()[1] for t in range(panel.n_weeks + H)], dtype=np.float32
+        )
+
+    def __call__(self, rows: np.ndarray, origins: np.ndarray, h: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns (inputs, scale) for the triples."""
+        f = self.feats[rows, origins]
+        units = self.values[rows, origins].astype(np.float32)
+        scale = np.maximum(np.where(np.isnan(f[:, SCALE_COLUMN]), units, f[:, SCALE_COLUMN]), 1.0)
+        targets = origins + h
+        ref = targets - SEASON
+        in_range = (ref >= 0) & (ref < self.values.shape[1])
+        ref = np.clip(ref, 0, self.values.shape[1] - 1)
+        seasonal = np.where(in_range & self.mask[rows, ref], self.values[rows, ref], np.nan)
+        inputs = np.column_stack([
+            units / scale,
+            f / scale[:, None],
+            seasonal / scale,
+            h,
+            self.iso_week[targets],
+            np.log1p(scale),
+        ]).astype(np.float32)
+        return inputs, scale
+
+    def training_set(self, cutoff: int, H: int, train_weeks: int, max_rows: int, rng) -> Tuple[np.ndarray, np.ndarray]:
+        """Samples with targets up to week `cutoff`: (inputs, units / scale)."""
+        parts = []
+        for h in range(1, H + 1):
+            lo, hi = max(0, cutoff - h - train_weeks + 1), cutoff - h + 1
+            if hi <= lo:
+                continue
+            window = self.mask[:, lo:hi] & self.mask[:, lo + h:hi + h] & ~np.isnan(self.feats[:, lo:hi, 0])
+            rows, cols = np.nonzero(window)
+            parts.append((rows, cols + lo, np.full(len(rows), h)))
+        if not parts:
+            return np.zeros((0, len(FEATURE_COLUMNS) + 5), dtype=np.float32), np.zeros(0)
+        rows, origins, h = (np.concatenate(p) for p in zip(*parts))
+        if len(rows) > max_rows:
+            pick = np.sort(rng.choice(len(rows), size=max_rows, replace=False))
+            rows, origins, h = rows[pick], origins[pick], h[pick]
+        inputs, scale = self(rows, origins, h)
+        return inputs, self.values[rows, origins + h] / scale
+
+
+def _fit(inputs: np.ndarray, target: np.ndarray, seed: int) -> HistGradientBoostingRegressor:
+    model = HistGradientBoostingRegressor(random_state=seed, **HGB_PARAMS)
+    return model.fit(inputs, target)
+
+
+def global_forecasts(
+    conn,
+    panel: DemandPanel,
+    latest: int,
+    H: int,
+    backtest_weeks: int,
+    train_weeks: int = TRAIN_WEEKS,
+    max_train_rows: int = MAX_TRAIN_ROWS,
+    seed: int = 0,
+) -> Tuple[Dict[Tuple[str, str], Tuple[List[Tuple[date, float, float, float]], float, List[Tuple[date, float]]]], Dict]:
+    """
+    Fit the global model on the panel and return
+    ({(sku_id, location_id): (per_week, residual_std, horizon_rows)}, info).
+    per_week holds one-step backtest rows (week, actual, forecast, residual)
+    over the same origins as the per-series backtests; horizon_rows the H-week
+    forecasts from the latest week. Series without a value in the latest week
+    get no entry. info has the training set sizes.
+    """
+    if not len(panel) or latest < 1:
+        return {}, {'train_rows': 0, 'backtest_train_rows': 0}
+    rng = np.random.default_rng(seed)
+    cutoff = latest - backtest_weeks
+    feats = load_features(conn, panel, since=max(0, cutoff - H - train_weeks + 1))
+    design = _Design(panel, feats, H)
+    results: Dict[Tuple[str, str], list] = {}
+
+    # Backtest: trained on targets before the window, one-step predictions at every origin in it
+    inputs, target = design.training_set(cutoff, H, train_weeks, max_train_rows, rng)
+    backtest_train_rows = len(target)
+    if backtest_train_rows:
+        model = _fit(inputs, target, seed)
+        lo, hi = max(0, latest - backtest_weeks), min(latest, panel.n_weeks - 1)
+        window = panel.mask[:, lo:hi] & panel.mask[:, lo + 1:hi + 1]
+        rows, cols = np.nonzero(window)
+        origins = cols + lo
+        inputs, scale = design(rows, origins, np.ones(len(rows), dtype=np.int64))
+        forecast = np.maximum(model.predict(inputs) * scale, 0.0) if len(rows) else np.zeros(0)
+        actual = panel.values[rows, origins + 1].astype(np.float64)
+        for i, w, a, f in zip(rows.tolist(), origins.tolist(), actual.tolist(), forecast.tolist()):
+            key = panel.keys[i]
+            results.setdefault(key, []).append((panel.week_start(w + 1), a, f, a - f))
+
+    # Production: trained on every target, H-week forecasts from the latest week
+    inputs, target = design.training_set(latest, H, train_weeks, max_train_rows, rng)
+    train_rows = len(target)
+    forecasts = {}
+    if train_rows:
+        model = _fit(inputs, target, seed)
+        rows = np.flatnonzero(panel.mask[:, latest])
+        h = np.tile(np.arange(1, H + 1), len(rows))
+        rows = np.repeat(rows, H)
+        inputs, scale = design(rows, np.full(len(rows), latest), h)
+        forecast = np.maximum(model.predict(inputs) * scale, 0.0) if len(rows) else np.zeros(0)
+        for i, step, f in zip(rows.tolist(), h.tolist(), forecast.tolist()):
+            forecasts.setdefault(panel.keys[i], []).append((panel.week_start(latest + step), f))
+
+    out = {}
+    for key, horizon_rows in forecasts.items():
+        per_week = results.get(key, [])
+        out[key] = (per_week, residual_std([r for (_, _, _, r) in per_week]), horizon_rows)
+    return out, {'train_rows': train_rows, 'backtest_train_rows': backtest_train_rows}
@@ -0,0 +1,279 @@
+"""
+Hierarchical forecasts: fit at category x location and total level, disaggregate to SKU-locations.
+
+The panel's series are summed into one node per (raw.sku_dim.category,
+location) plus a total node. Only those nodes get the seasonal ETS/SARIMA
+fits (train_ml runs its usual per-series selection on them), so the number
+of expensive fits follows the number of categories x locations instead of
+SKU-locations. The node forecasts are optionally reconciled with the total
+(OLS, or MinT with a diagonal covariance of the nodes' backtest residuals;
+the tree has two levels, so both have a closed form), then split to the
+series of each node by proportions:
+
+    historical  each series' share of its node's units over the last
+                PROPORTION_WEEKS weeks before the origin
+    forecast    each series' share of its node's seasonal naive forecasts
+                for the target week (historical where those sum to 0)
+
+Backtest rows are built the same way at every origin, from the nodes'
+one-step backtest forecasts and proportions known at that origin, so they
+line up with the bottom-up backtests in ops.metrics_accuracy. Compare a run
+with a bottom-up run per aggregation level with
+
+    python -m jobs.hierarchy --run-id <hierarchical run> [--baseline-run-id <bottom-up run>]
+"""
+from datetime import date
+import argparse
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from jobs.panel import DemandPanel, seasonal_naive, residual_std
+from jobs.utils.db import get_conn
+
+MODEL_NAME = 'hierarchical_v1'
+TOTAL_KEY = ('total', '*')
+PROPORTION_SOURCES = ('historical', 'forecast')
+RECONCILE_METHODS = ('none', 'ols', 'mint')
+PROPORTION_WEEKS = 52
+LEVELS = ('sku_location', 'category_location', 'category', 'total')
+
+Forecast = Tuple[List[Tuple[date, float, float, float]], float, List[Tuple[date, float]]]
+
+
+def load_categories(conn) -> Dict[str, str]:
+    """sku_id -> category (SKUs without one share the category 'none')."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT sku_id, COALESCE(category, 'none') FROM raw.sku_dim")
+        return dict(cur.fetchall())
+
+
+class Hierarchy:
+    """Category x location nodes of a DemandPanel: node_of[i] is the node row of series i."""
+
+    def __init__(self, panel: DemandPanel, categories: Dict[str, str]):
+        self.panel = panel
+        node_keys = [(f"category:{categories.get(sku_id, 'none')}", loc_id) for sku_id, loc_id in panel.keys]
+        self.nodes: List[Tuple[str, str]] = sorted(set(node_keys))
+        codes = {key: g for g, key in enumerate(self.nodes)}
+        self.node_of = np.array([codes[key] for key in node_keys], dtype=np.int64)
+
+    @property
+    def n_nodes(self) -> int:
+        return len(self.nodes)
+
+    def aggregate(self) -> DemandPanel:
+        """Panel of the node sums (rows in self.nodes order) followed by the total."""
+        panel = self.panel
+        values = np.zeros((self.n_nodes + 1, panel.n_weeks), dtype=np.int64)
+        mask = np.zeros((self.n_nodes + 1, panel.n_weeks), dtype=bool)
+        np.add.at(values, self.node_of, np.where(panel.mask, panel.values, 0))
+        np.logical_or.at(mask, self.node_of, panel.mask)
+        values[-1] = values[:-1].sum(axis=0)
+        mask[-1] = mask[:-1].any(axis=0)
+        return DemandPanel(self.nodes + [TOTAL_KEY], panel.first_week, values, mask)
+
+    def _node_sum(self, x: np.ndarray) -> np.ndarray:
+        """Sum of the (series, k) array over each node's series, broadcast back to (series, k)."""
+        sums = np.zeros((self.n_nodes, x.shape[1]))
+        np.add.at(sums, self.node_of, x)
+        return sums[self.node_of]
+
+    def historical_proportions(self, origins: np.ndarray) -> np.ndarray:
+        """(series, origins) shares of each node's units over the PROPORTION_WEEKS weeks up to each origin."""
+        panel = self.panel
+        csum = np.zeros((panel.n_series, panel.n_weeks + 1))
+        np.cumsum(np.where(panel.mask, panel.values, 0), axis=1, out=csum[:, 1:])
+        hi = np.minimum(origins, panel.n_weeks - 1) + 1
+        window = csum[:, hi] - csum[:, np.maximum(hi - PROPORTION_WEEKS, 0)]
+        # Nodes without units in the window: equal shares among the series seen by then
+        seen = (np.cumsum(panel.mask, axis=1)[:, hi - 1] > 0).astype(np.float64)
+        window = np.where(self._node_sum(window) > 0, window, seen)
+        total = self._node_sum(window)
+        return np.divide(window, total, out=np.zeros_like(window), where=total > 0)
+
+    def forecast_proportions(self, origins: np.ndarray, targets: np.ndarray) -> np.ndarray:
+        """(series, targets) shares of each node's seasonal naive forecasts (historical shares as of origins where 0)."""
+        panel = self.panel
+        sn = seasonal_naive(panel.values, panel.mask, targets)
+        # seasonal_naive looks back from the target; forecasts for series not seen by the origin are dropped
+        seen = np.cumsum(panel.mask, axis=1)[:, np.minimum(origins, panel.n_weeks - 1)] > 0
+        sn = np.where(seen, sn, 0.0)
+        total = self._node_sum(sn)
+        shares = np.divide(sn, total, out=np.zeros_like(sn), where=total > 0)
+        return np.where(total > 0, shares, self.historical_proportions(origins))
+
+    def proportions(self, source: str, origins: np.ndarray, targets: np.ndarray) -> np.ndarray:
+        if source == 'forecast':
+            return self.forecast_proportions(origins, targets)
+        return self.historical_proportions(origins)
+
+
+def reconcile(base: np.ndarray, total: np.ndarray, variances: np.ndarray, method: str) -> np.ndarray:
+    """
+    Reconciled node forecasts for (nodes, weeks) base forecasts and the total's
+    base forecasts per week. Minimising sum((b - b_hat)^2 / w) + (sum(b) - t_hat)^2 / w_t
+    gives b = b_hat + w / (w_t + sum(w)) * (t_hat - sum(b_hat)): OLS has every
+    w = 1, MinT (diagonal) uses the nodes' backtest residual variances
+    (variances[-1] is the total's). Weeks where any node or the total has no
+    base forecast (NaN) are left as they are. Floored at 0.
+    """
+    if method == 'none':
+        return base
+    w = np.ones(len(variances)) if method == 'ols' else np.maximum(variances, 1e-6)
+    gap = total - base.sum(axis=0)
+    adjusted = base + w[:-1, None] / w.sum() * gap[None, :]
+    complete = ~np.isnan(gap)
+    return np.where(complete[None, :], np.maximum(adjusted, 0.0), base)
+
+
+def hierarchical_forecasts(
+    hierarchy: Hierarchy,
+    latest: int,
+    H: int,
+    backtest_weeks: int,
+    node_forecasts: Dict[Tuple[str, str], Forecast],
+    proportions: str = 'historical',
+    method: str = 'none',
+) -> Tuple[Dict[Tuple[str, str], Forecast], Dict]:
+    """
+    Disaggregate node forecasts (as returned per node by train_ml: per_week
+    one-step backtest rows, residual_std, horizon_rows; the total under
+    TOTAL_KEY) to every series of the panel. Returns
+    ({(sku_id, location_id): (per_week, residual_std, horizon_rows)}, info),
+    the same shape as jobs.global_model.global_forecasts. Series without a
+    value in the latest week get no entry. info has the node count and the
+    total's backtest WAPE before and after reconciliation.
+    """
+    panel = hierarchy.panel
+    if not len(panel) or latest < 1:
+        return {}, {'nodes': hierarchy.n_nodes}
+    lo, hi = max(0, latest - backtest_weeks), min(latest, panel.n_weeks - 1)
+    # Columns: backtest targets lo+1 .. hi, then horizon weeks latest+1 .. latest+H
+    targets = np.concatenate([np.arange(lo + 1, hi + 1), latest + np.arange(1, H + 1)])
+    origins = np.concatenate([np.arange(lo, hi), np.full(H, latest)])
+    column = {panel.week_start(t): c for c, t in enumerate(targets[:hi - lo])}
+    base = np.full((hierarchy.n_nodes + 1, len(targets)), np.nan)
+    variances = np.zeros(hierarchy.n_nodes + 1)
+    for g, key in enumerate(hierarchy.nodes + [TOTAL_KEY]):
+        if key not in node_forecasts:
+            continue
+        per_week, std, horizon_rows = node_forecasts[key]
+        for week, _, f, _ in per_week:
+            if week in column:
+                base[g, column[week]] = f
+        base[g, hi - lo:hi - lo + len(horizon_rows)] = [f for _, f in horizon_rows][:H]
+        variances[g] = std ** 2
+    nodes = reconcile(base[:-1], base[-1], variances, method)
+    shares = hierarchy.proportions(proportions, origins, targets)
+    forecast = shares * nodes[hierarchy.node_of]
+
+    # Backtest rows at the series' own origins (observed origin and target), as in the per-series backtests
+    window = panel.mask[:, lo:hi] & panel.mask[:, lo + 1:hi + 1]
+    rows, cols = np.nonzero(window & ~np.isnan(forecast[:, :hi - lo]))
+    results: Dict[Tuple[str, str], list] = {}
+    actual = panel.values[rows, cols + lo + 1].astype(np.float64)
+    for i, c, a, f in zip(rows.tolist(), cols.tolist(), actual.tolist(), forecast[rows, cols].tolist()):
+        results.setdefault(panel.keys[i], []).append((panel.week_start(lo + c + 1), a, f, a - f))
+
+    out = {}
+    horizon = forecast[:, hi - lo:]
+    for i in np.flatnonzero(panel.mask[:, latest] & ~np.isnan(horizon).any(axis=1)).tolist():
+        key = panel.keys[i]
+        per_week = results.get(key, [])
+        horizon_rows = [(panel.week_start(latest + h), float(horizon[i, h - 1])) for h in range(1, H + 1)]
+        out[key] = (per_week, residual_std([r for (_, _, _, r) in per_week]), horizon_rows)
+
+    actual_total = np.where(panel.mask, panel.values, 0).sum(axis=0, dtype=np.float64)[targets[:hi - lo]]
+    info = {'nodes': hierarchy.n_nodes}
+    for name, total in (('total_wape_base', base[-1]), ('total_wape_reconciled', nodes.sum(axis=0))):
+        ok = ~np.isnan(total[:hi - lo])
+        denom = actual_total[ok].sum()
+        info[name] = float(np.abs(total[:hi - lo][ok] - actual_total[ok]).sum() / denom) if denom > 0 else None
+    return out, info
+
+
+def fetch_baseline_run(conn, exclude: Optional[str] = None) -> Optional[str]:
+    """Latest succeeded bottom-up (non-hierarchical) train_ml run, other than `exclude`."""
+    with conn.cursor() as cur:
+        cur.execute("""
+          SELECT run_id::text FROM ops.batch_run
+          WHERE job_type = 'train_ml' AND status = 'succeeded'
+            AND COALESCE(notes, '') NOT LIKE '%%hierarchical=%%'
+            AND run_id::text IS DISTINCT FROM %s
+          ORDER BY started_at DESC
+          LIMIT 1
+        """, (exclude,))
+        row = cur.fetchone()
+    return row[0] if row else None
+
+
+def compare_runs(conn, run_id: str, baseline_run_id: str) -> List[Dict]:
+    """
+    Backtest WAPE of two train_ml runs per aggregation level, over the
+    (sku_id, location_id, week) rows both wrote to ops.metrics_accuracy:
+    forecasts and actuals are summed to the level first, so the upper levels
+    show how well each run forecasts aggregates.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+          WITH pairs AS (
+            SELECT m.location_id, m.week_start_date, COALESCE(s.category, 'none') AS category,
+                   m.actual_units AS a, m.forecast_units AS f, b.forecast_units AS fb
+            FROM ops.metrics_accuracy m
+            JOIN ops.metrics_accuracy b
+              ON b.run_id = %(baseline)s AND b.sku_id = m.sku_id
+             AND b.location_id = m.location_id AND b.week_start_date = m.week_start_date
+            JOIN raw.sku_dim s ON s.sku_id = m.sku_id
+            WHERE m.run_id = %(run)s
+          )
+          SELECT level, COUNT(*), SUM(ABS(f - a)) / NULLIF(SUM(a), 0), SUM(ABS(fb - a)) / NULLIF(SUM(a), 0)
+          FROM (
+            SELECT 'sku_location' AS level, a, f, fb FROM pairs
+            UNION ALL
+            SELECT 'category_location', SUM(a), SUM(f), SUM(fb) FROM pairs GROUP BY category, location_id, week_start_date
+            UNION ALL
+            SELECT 'category', SUM(a), SUM(f), SUM(fb) FROM pairs GROUP BY category, week_start_date
+            UNION ALL
+            SELECT 'total', SUM(a), SUM(f), SUM(fb) FROM pairs GROUP BY week_start_date
+          ) x
+          GROUP BY level
+        """, {'run': run_id, 'baseline': baseline_run_id})
+        rows = {level: (n, wape, base) for level, n, wape, base in cur.fetchall()}
+    return [
+        {'level': level, 'rows': rows[level][0],
+         'wape': float(rows[level][1]) if rows[level][1] is not None else None,
+         'baseline_wape': float(rows[level][2]) if rows[level][2] is not None else None}
+        for level in LEVELS if level in rows
+    ]
+
+
+def format_comparison(comparison: List[Dict]) -> str:
+    def fmt(x):
+        return f"{x:.4f}" if x is not None else "n/a"
+    return ", ".join(f"{c['level']} {fmt(c['wape'])} vs {fmt(c['baseline_wape'])}" for c in comparison)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare a train_ml run's backtest WAPE with a bottom-up run per level")
+    parser.add_argument("--run-id", type=str, required=True, help="train_ml run to evaluate (e.g. a --hierarchical run)")
+    parser.add_argument("--baseline-run-id", type=str, default=None,
+                        help="Bottom-up train_ml run to compare with (default: the latest non-hierarchical run)")
+    args = parser.parse_args()
+
+    with get_conn() as conn:
+        baseline = args.baseline_run_id or fetch_baseline_run(conn, exclude=args.run_id)
+        if baseline is None:
+            raise RuntimeError("No bottom-up train_ml run to compare with")
+        comparison = compare_runs(conn, args.run_id, baseline)
+    if not comparison:
+        print(f"Runs {args.run_id} and {baseline} have no backtest rows in common.")
+        return
+    print(f"Backtest WAPE, run {args.run_id} vs bottom-up run {baseline}:")
+    print(f"  {'level':20s} {'rows':>8s} {'run':>8s} {'baseline':>9s}")
+    for c in comparison:
+        wape = f"{c['wape']:.4f}" if c['wape'] is not None else "n/a"
+        base = f"{c['baseline_wape']:.4f}" if c['baseline_wape'] is not None else "n/a"
+        print(f"  {c['level']:20s} {c['rows']:8d} {wape:>8s} {base:>9s}")
+
+
+if __name__ == "__main__":
+    main()
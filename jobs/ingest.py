@@ -2,8 +2,13 @@ from datetime import date, timedelta
 import argparse
 import random
 import math
+import time
+from itertools import repeat
+import numpy as np
 from tqdm import tqdm
-from jobs.utils.db import get_conn, execute_values_insert
+from jobs.utils.db import get_conn, execute_values_insert, copy_upsert, BULK_LOAD_SESSION
+from jobs.utils.instrument import RunProfiler, stage, add_instrument_arguments
+from jobs.utils.partitions import PARTITIONED_TABLES, ensure_partitions
 
 def iso_week_start(d: date) -> date:
     return d - timedelta(days=d.weekday())
@@ -129,23 +134,111 @@ def seed_sales_and_inventory(conn, n_skus: int, n_locations: int, start_date: da
                 d += timedelta(days=1)
                 week_index += (1 if d.weekday() == 0 else 0)
 
-    sales_sql = """
-        INSERT INTO raw.sales_fact (sku_id, location_id, date, units_sold, source)
-        VALUES %s
-        ON CONFLICT (sku_id, location_id, date) DO UPDATE SET
-          units_sold = EXCLUDED.units_sold,
-          source = EXCLUDED.source
+    # Upserted rows get a fresh created_at, so incremental preprocess re-aggregates corrected weeks
+    copy_upsert(
+        conn, "raw.sales_fact",
+        ["sku_id", "location_id", "date", "units_sold", "source"],
+        sales_rows,
+        conflict_columns=["sku_id", "location_id", "date"],
+        touch_columns=["created_at"],
+    )
+    copy_upsert(
+        conn, "raw.inventory_snapshot",
+        ["sku_id", "location_id", "date", "on_hand", "on_order"],
+        inv_rows,
+        conflict_columns=["sku_id", "location_id", "date"],
+        touch_columns=["created_at"],
+    )
+
+def _simulate_block_numpy(seed: int, sku_indices: range, n_locations: int, dates: list[date]):
+    """
+    Simulate every location of a block of SKUs at once.
+    Returns (units, on_hand, on_order) int arrays shaped (series, days), with
+    series ordered SKU-major like the python engine. Each SKU draws from its
+    own generator seeded by (seed, sku index), so output depends only on the
+    seed, never on the chunk size.
     """
-    execute_values_insert(conn, sales_sql, sales_rows)
+    n_days = len(dates)
+    iso_w = np.array([d.isocalendar()[1] for d in dates], dtype=np.float64)
+    weekday = np.array([d.weekday() for d in dates])
+    monday = weekday == 0
+    # week_index advances on every Monday after the first simulated day
+    week_index = np.concatenate(([0], np.cumsum(monday[1:])))
+    season_factor = 1.0 + 0.3 * np.sin((iso_w / 52.0) * 2 * np.pi)
+    weekday_factor = np.where(weekday < 5, 1.0, 0.9)
 
-    inv_sql = """
-        INSERT INTO raw.inventory_snapshot (sku_id, location_id, date, on_hand, on_order)
-        VALUES %s
-        ON CONFLICT (sku_id, location_id, date) DO UPDATE SET
-          on_hand = EXCLUDED.on_hand,
-          on_order = EXCLUDED.on_order
+    n_series = len(sku_indices) * n_locations
+    noise = np.empty((n_series, n_days))
+    orders = np.empty((n_series, n_days), dtype=np.int64)
+    base = np.empty(n_series)
+    trend = np.empty(n_series)
+    on_hand = np.empty(n_series, dtype=np.int64)
+    for k, i in enumerate(sku_indices):
+        rng = np.random.default_rng([seed, i])
+        rows = slice(k * n_locations, (k + 1) * n_locations)
+        base[rows] = rng.uniform(5, 50)
+        trend[rows] = rng.uniform(-0.05, 0.05)
+        on_hand[rows] = rng.integers(100, 501, size=n_locations)
+        noise[rows] = rng.standard_normal((n_locations, n_days))
+        placed = rng.random((n_locations, n_days)) < 0.02
+        orders[rows] = np.where(placed, rng.integers(50, 201, size=(n_locations, n_days)), 0)
+
+    weekly_mean = np.maximum(0.0, base[:, None] * (1 + trend[:, None] * week_index) * season_factor)
+    daily_mean = weekly_mean / 7.0 * weekday_factor
+    demand = np.maximum(0, np.trunc(daily_mean + daily_mean * 0.3 * noise)).astype(np.int64)
+
+    units = np.empty_like(demand)
+    inv_on_hand = np.empty_like(demand)
+    inv_on_order = np.empty_like(demand)
+    on_order = np.zeros(n_series, dtype=np.int64)
+    # Stock carries over day to day, so iterate days but vectorize across series
+    for d in range(n_days):
+        sold = np.where(on_hand <= 0, 0, demand[:, d])
+        on_hand -= sold
+        on_order += orders[:, d]
+        if monday[d]:
+            on_hand += on_order
+            on_order[:] = 0
+        units[:, d] = sold
+        inv_on_hand[:, d] = np.maximum(on_hand, 0)
+        inv_on_order[:, d] = on_order
+    return units, inv_on_hand, inv_on_order
+
+def _block_rows(keys: list[tuple[str, str]], dates: list[date], *columns: np.ndarray):
+    """Yield (sku_id, location_id, date, *values) tuples for a simulated block."""
+    days = [d.isoformat() for d in dates]
+    for k, (sku_id, loc_id) in enumerate(keys):
+        yield from zip(repeat(sku_id), repeat(loc_id), days, *(col[k].tolist() for col in columns))
+
+def seed_sales_and_inventory_numpy(conn, n_skus: int, n_locations: int, start_date: date, end_date: date,
+                                   seed: int = 42, chunk_skus: int = 200) -> int:
+    """
+    Vectorized generator: simulates `chunk_skus` SKUs x all locations per block
+    and streams each block to the database, so memory is bounded by one chunk.
+    Returns the number of daily rows written per table.
     """
-    execute_values_insert(conn, inv_sql, inv_rows)
+    dates = [start_date + timedelta(days=k) for k in range((end_date - start_date).days + 1)]
+    total = 0
+    for lo in tqdm(range(0, n_skus, chunk_skus), desc="Generating sales/inventory"):
+        sku_indices = range(lo, min(lo + chunk_skus, n_skus))
+        keys = [(f"SKU{i+1:04d}", f"LOC{j+1}") for i in sku_indices for j in range(n_locations)]
+        units, on_hand, on_order = _simulate_block_numpy(seed, sku_indices, n_locations, dates)
+        # Upserted rows get a fresh created_at, so incremental preprocess re-aggregates corrected weeks
+        copy_upsert(
+            conn, "raw.sales_fact",
+            ["sku_id", "location_id", "date", "units_sold", "source"],
+            ((*row, "sim") for row in _block_rows(keys, dates, units)),
+            conflict_columns=["sku_id", "location_id", "date"],
+            touch_columns=["created_at"],
+        )
+        total += copy_upsert(
+            conn, "raw.inventory_snapshot",
+            ["sku_id", "location_id", "date", "on_hand", "on_order"],
+            _block_rows(keys, dates, on_hand, on_order),
+            conflict_columns=["sku_id", "location_id", "date"],
+            touch_columns=["created_at"],
+        )
+    return total
 
 def main():
     parser = argparse.ArgumentParser()
@@ -153,6 +246,12 @@ def main():
     parser.add_argument("--locations", type=int, default=3)
     parser.add_argument("--weeks", type=int, default=156)
     parser.add_argument("--start", type=str, default=None)
+    parser.add_argument("--engine", choices=["python", "numpy"], default="python",
+                        help="Sales/inventory simulator: per-day python loop or vectorized numpy blocks")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed for the numpy engine")
+    parser.add_argument("--chunk-skus", type=int, default=200,
+                        help="SKUs simulated and written per block by the numpy engine")
+    add_instrument_arguments(parser)
     args = parser.parse_args()
 
     if args.start:
@@ -162,18 +261,48 @@ def main():
         start_date = iso_week_start(today - timedelta(weeks=args.weeks))
     end_date = date.today()
 
-    with get_conn() as conn:
+    with get_conn(session=BULK_LOAD_SESSION) as conn, \
+            RunProfiler("ingest", profile=args.profile, trace_memory=args.trace_memory) as prof:
         print("Seeding sku_dim...")
-        seed_sku_dim(conn, args.skus)
+        with stage("sku_dim") as s:
+            seed_sku_dim(conn, args.skus)
+            s.rows = args.skus
         print("Seeding location_dim...")
-        seed_location_dim(conn, args.locations)
+        with stage("location_dim") as s:
+            seed_location_dim(conn, args.locations)
+            s.rows = args.locations
         print("Seeding calendar_dim...")
-        seed_calendar(conn, start_date, end_date)
+        with stage("calendar_dim") as s:
+            seed_calendar(conn, start_date, end_date)
+            s.rows = (end_date - start_date).days + 1
         print("Seeding settings...")
-        seed_settings(conn, args.skus, args.locations)
-        print("Seeding sales & inventory (this may take a few minutes)...")
-        seed_sales_and_inventory(conn, args.skus, args.locations, start_date, end_date)
-        print("Done.")
+        with stage("settings") as s:
+            seed_settings(conn, args.skus, args.locations)
+            s.rows = args.skus * args.locations
+        with stage("partitions") as s:
+            for table in PARTITIONED_TABLES:
+                created = ensure_partitions(conn, table, start_date, end_date)
+                if created:
+                    print(f"Created {len(created)} partition(s) of {table}")
+                s.rows += len(created)
+        print(f"Seeding sales & inventory with the {args.engine} engine (this may take a few minutes)...")
+        t0 = time.perf_counter()
+        with stage("sales_and_inventory") as s:
+            if args.engine == "numpy":
+                n_rows = seed_sales_and_inventory_numpy(
+                    conn, args.skus, args.locations, start_date, end_date,
+                    seed=args.seed, chunk_skus=max(1, args.chunk_skus),
+                )
+            else:
+                seed_sales_and_inventory(conn, args.skus, args.locations, start_date, end_date)
+                n_rows = args.skus * args.locations * ((end_date - start_date).days + 1)
+            # Each simulated day writes one sales_fact and one inventory_snapshot row
+            s.rows = 2 * n_rows
+        elapsed = time.perf_counter() - t0
+        print(f"Wrote {2 * n_rows} rows in {elapsed:.1f}s ({2 * n_rows / max(elapsed, 1e-9):,.0f} rows/sec)")
+        stage_run_id = prof.save(conn)
+        print(prof.report())
+        print(f"Done (stage metrics: ops.run_stage run_id={stage_run_id}).")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
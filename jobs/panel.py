@@ -0,0 +1,291 @@
+"""
+Columnar in-memory panel of weekly demand shared by the forecasting jobs.
+
+Series are integer-coded rows of one contiguous (series x week) int32 matrix
+with a boolean validity mask, over a global weekly index starting at
+first_week. Rows and week ranges are numpy views, and the seasonal naive,
+backtest and horizon helpers below work on those arrays directly instead of
+rebuilding {week: units} dicts per call.
+"""
+from datetime import date, timedelta
+import hashlib
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+import numpy as np
+import pandas as pd
+from jobs.utils.db import iter_groups
+
+if TYPE_CHECKING:
+    from jobs.utils.snapshot import Snapshot
+
+FALLBACK_WINDOW = 8  # existing weeks averaged when the week 52 back is missing
+SEASON = 52
+
+
+class PanelSeries:
+    """One series of a DemandPanel: views into its row of the panel, no copies."""
+
+    __slots__ = ("key", "first_week", "values", "mask", "_observed")
+
+    def __init__(self, key: Tuple[str, str], first_week: date, values: np.ndarray, mask: np.ndarray):
+        self.key = key
+        self.first_week = first_week
+        self.values = values
+        self.mask = mask
+        self._observed: Optional[np.ndarray] = None
+
+    def __getstate__(self):
+        return (self.key, self.first_week, self.values, self.mask)
+
+    def __setstate__(self, state):
+        self.key, self.first_week, self.values, self.mask = state
+        self._observed = None
+
+    @property
+    def observed(self) -> np.ndarray:
+        """Week indices that have a value, ascending."""
+        if self._observed is None:
+            self._observed = np.flatnonzero(self.mask)
+        return self._observed
+
+    def __len__(self) -> int:
+        return len(self.observed)
+
+    def week_start(self, t: int) -> date:
+        return self.first_week + timedelta(weeks=int(t))
+
+    def to_pandas(self) -> pd.Series:
+        """Observed values indexed by week start (gaps are skipped, not filled)."""
+        obs = self.observed
+        index = pd.DatetimeIndex(np.datetime64(self.first_week, "D") + 7 * obs.astype("timedelta64[D]"))
+        return pd.Series(self.values[obs].astype(np.int64), index=index)
+
+    def fingerprint(self) -> str:
+        """Content hash of the observed (week, units) pairs, independent of the panel's week origin."""
+        obs = self.observed
+        h = hashlib.sha256()
+        h.update(np.int64(self.first_week.toordinal()).tobytes())
+        h.update(obs.astype(np.int64).tobytes())
+        h.update(self.values[obs].astype(np.int64).tobytes())
+        return h.hexdigest()
+
+
+class DemandPanel:
+    """
+    keys[i] is the (sku_id, location_id) of row i; values[i, t] holds its
+    units in week first_week + t weeks where mask[i, t] is set.
+    """
+
+    def __init__(self, keys: List[Tuple[str, str]], first_week: date, values: np.ndarray, mask: np.ndarray):
+        self.keys = keys
+        self.codes: Dict[Tuple[str, str], int] = {key: i for i, key in enumerate(keys)}
+        self.first_week = first_week
+        self.values = values
+        self.mask = mask
+
+    @property
+    def n_series(self) -> int:
+        return self.values.shape[0]
+
+    @property
+    def n_weeks(self) -> int:
+        return self.values.shape[1]
+
+    @property
+    def nbytes(self) -> int:
+        return self.values.nbytes + self.mask.nbytes
+
+    def week_index(self, week: date) -> int:
+        days = (week - self.first_week).days
+        if days % 7:
+            raise ValueError(f"{week} is not aligned to weekly steps from {self.first_week}")
+        return days // 7
+
+    def week_start(self, t: int) -> date:
+        return self.first_week + timedelta(weeks=int(t))
+
+    def series(self, row: Union[int, Tuple[str, str]]) -> PanelSeries:
+        """Series by row number or (sku_id, location_id) key."""
+        i = row if isinstance(row, (int, np.integer)) else self.codes[row]
+        return PanelSeries(self.keys[i], self.first_week, self.values[i], self.mask[i])
+
+    def __iter__(self) -> Iterator[PanelSeries]:
+        for i in range(self.n_series):
+            yield self.series(i)
+
+    def __len__(self) -> int:
+        return self.n_series
+
+    def weeks(self, start: int, stop: int) -> "DemandPanel":
+        """View of week indices [start, stop) for every series."""
+        start = max(0, start)
+        view = DemandPanel.__new__(DemandPanel)
+        view.keys, view.codes = self.keys, self.codes
+        view.first_week = self.week_start(start)
+        view.values = self.values[:, start:stop]
+        view.mask = self.mask[:, start:stop]
+        return view
+
+    @classmethod
+    def load(cls, conn, keys: Optional[Sequence[Tuple[str, str]]] = None,
+             through: Optional[date] = None, snapshot: Optional["Snapshot"] = None) -> "DemandPanel":
+        """
+        Load curated.weekly_demand (only the given (sku_id, location_id) keys
+        if set), streamed one series at a time into the preallocated matrix;
+        rows are in (sku_id, location_id) order. `through` extends the week
+        index up to that week (e.g. the global latest week when loading a
+        subset of series). With a snapshot (jobs.utils.snapshot), the panel
+        is built from its memory-mapped weekly_demand instead.
+        """
+        if snapshot is not None:
+            return cls.from_snapshot(snapshot, keys, through)
+        where, key_params = "", ()
+        if keys is not None:
+            where = "WHERE (sku_id, location_id) IN (SELECT * FROM unnest(%s::text[], %s::text[]))"
+            key_params = ([k[0] for k in keys], [k[1] for k in keys])
+        with conn.cursor() as cur:
+            cur.execute(f"""
+              SELECT MIN(first_week), MAX(last_week), COUNT(*)
+              FROM (
+                SELECT MIN(week_start_date) AS first_week, MAX(week_start_date) AS last_week
+                FROM curated.weekly_demand
+                {where}
+                GROUP BY sku_id, location_id
+              ) s
+            """, key_params)
+            first_week, last_week, n_series = cur.fetchone()
+        if not n_series:
+            return cls([], date.min, np.zeros((0, 0), dtype=np.int32), np.zeros((0, 0), dtype=bool))
+        if through is not None and through > last_week:
+            last_week = through
+        n_weeks = (last_week - first_week).days // 7 + 1
+        keys: List[Tuple[str, str]] = []
+        values = np.zeros((n_series, n_weeks), dtype=np.int32)
+        mask = np.zeros((n_series, n_weeks), dtype=bool)
+        series = iter_groups(conn, f"""
+          SELECT sku_id, location_id, week_start_date - %s, units_sold
+          FROM curated.weekly_demand
+          {where}
+          ORDER BY sku_id, location_id, week_start_date
+        """, (first_week, *key_params), name="weekly_panel")
+        for i, (key, ts) in enumerate(series):
+            offsets, units = np.array(ts, dtype=np.int64).T
+            if (offsets % 7).any():
+                ws = first_week + timedelta(days=int(offsets[np.flatnonzero(offsets % 7)[0]]))
+                raise RuntimeError(f"week_start_date {ws} is not aligned to weekly steps from {first_week}")
+            cols = offsets // 7
+            if i >= n_series or cols[0] < 0 or cols[-1] >= n_weeks:
+                raise RuntimeError("curated.weekly_demand changed while loading; rerun the job")
+            values[i, cols] = units
+            mask[i, cols] = True
+            keys.append(key)
+        return cls(keys, first_week, values[:len(keys)], mask[:len(keys)])
+
+    @classmethod
+    def from_snapshot(cls, snapshot: "Snapshot", keys: Optional[Sequence[Tuple[str, str]]] = None,
+                      through: Optional[date] = None) -> "DemandPanel":
+        """Same panel as load(), scattered from a snapshot's weekly_demand columns in one pass."""
+        keys, codes, rows = snapshot.rows_for("weekly_demand", keys)
+        if not len(rows):
+            return cls([], date.min, np.zeros((0, 0), dtype=np.int32), np.zeros((0, 0), dtype=bool))
+        weeks = snapshot.column("weekly_demand", "week_start_date")[rows]
+        first, last = weeks.min(), weeks.max()
+        if through is not None:
+            last = max(last, np.datetime64(through, "D"))
+        offsets = (weeks - first).astype(np.int64)
+        if (offsets % 7).any():
+            ws = weeks[np.flatnonzero(offsets % 7)[0]]
+            raise RuntimeError(f"week_start_date {ws} is not aligned to weekly steps from {first}")
+        n_weeks = int((last - first).astype(np.int64)) // 7 + 1
+        values = np.zeros((len(keys), n_weeks), dtype=np.int32)
+        mask = np.zeros((len(keys), n_weeks), dtype=bool)
+        values[codes, offsets // 7] = snapshot.column("weekly_demand", "units_sold")[rows]
+        mask[codes, offsets // 7] = True
+        return cls(keys, first.astype(date), values, mask)
+
+
+def panel_keys(conn) -> List[Tuple[str, str]]:
+    """Every (sku_id, location_id) in curated.weekly_demand, in panel row order."""
+    with conn.cursor() as cur:
+        cur.execute("""
+          SELECT DISTINCT sku_id, location_id
+          FROM curated.weekly_demand
+          ORDER BY sku_id, location_id
+        """)
+        return cur.fetchall()
+
+
+def seasonal_naive(values: np.ndarray, mask: np.ndarray, targets: np.ndarray) -> np.ndarray:
+    """
+    Seasonal naive forecast for every series (rows) and target week index.
+    Uses the value 52 weeks earlier when present, else the mean of the last
+    FALLBACK_WINDOW existing weeks before the target (0.0 if none), floored at 0.
+    Returns a float64 array of shape (series, len(targets)).
+    """
+    n, T = values.shape
+    targets = np.asarray(targets, dtype=np.int64)
+    rows = np.arange(n)[:, None]
+    # prefix[i, k] = sum of the first k existing values of series i
+    rank = np.cumsum(mask, axis=1)
+    prefix = np.zeros((n, T + 1))
+    csum = np.cumsum(np.where(mask, values, 0), axis=1, dtype=np.float64)
+    r, c = np.nonzero(mask)
+    prefix[r, rank[r, c]] = csum[r, c]
+    # number of existing weeks strictly before each target
+    before = np.concatenate([np.zeros((n, 1), dtype=rank.dtype), rank], axis=1)
+    count = before[:, np.minimum(targets, T)]
+    window = np.minimum(count, FALLBACK_WINDOW)
+    recent_sum = prefix[rows, count] - prefix[rows, count - window]
+    fallback = np.maximum(np.divide(recent_sum, window, out=np.zeros(recent_sum.shape), where=window > 0), 0.0)
+
+    ref = targets - SEASON
+    ref_in_range = (ref >= 0) & (ref < T)
+    ref_clipped = np.clip(ref, 0, max(T - 1, 0))
+    has_ref = mask[:, ref_clipped] & ref_in_range
+    return np.where(has_ref, values[:, ref_clipped].astype(np.float64), fallback)
+
+
+def backtest_origins(mask: np.ndarray, latest: int, backtest_weeks: int) -> np.ndarray:
+    """
+    Origin week indices w of a one-step rolling backtest for one series:
+    observed weeks with latest - backtest_weeks <= w < latest whose next week
+    (the target) is observed too.
+    """
+    w = np.arange(max(0, latest - backtest_weeks), min(latest, len(mask) - 1))
+    return w[mask[w] & mask[w + 1]]
+
+
+def backtest_seasonal_naive(
+    values: np.ndarray, mask: np.ndarray, latest: int, backtest_weeks: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    One-step rolling seasonal naive backtest for all series at once.
+    Returns (targets, actual, forecast, valid, residual_std): target week
+    indices, (series x targets) actual/forecast arrays, the mask of backtest
+    cells that exist, and residual_std per series.
+    """
+    n = values.shape[0]
+    targets = np.arange(max(1, latest - backtest_weeks + 1), latest + 1)
+    valid = mask[:, targets] & mask[:, targets - 1]
+    actual = values[:, targets].astype(np.float64)
+    forecast = seasonal_naive(values, mask, targets)
+    residual = np.where(valid, actual - forecast, 0.0)
+
+    count = valid.sum(axis=1)
+    mean = residual.sum(axis=1) / np.maximum(count, 1)
+    sq = np.where(valid, (residual - mean[:, None]) ** 2, 0.0)
+    std = np.sqrt(sq.sum(axis=1) / np.maximum(count - 1, 1))
+    first = np.abs(residual[np.arange(n), valid.argmax(axis=1)]) if n else np.zeros(0)
+    residual_std = np.where(count >= 2, std, np.where(count == 1, first, 0.0))
+    return targets, actual, forecast, valid, residual_std
+
+
+def horizon_seasonal_naive(values: np.ndarray, mask: np.ndarray, latest: int, horizon: int) -> np.ndarray:
+    """Seasonal naive forecasts for weeks latest+1 .. latest+horizon, shape (series, horizon)."""
+    return seasonal_naive(values, mask, np.arange(latest + 1, latest + horizon + 1))
+
+
+def residual_std(residuals) -> float:
+    """Sample std of backtest residuals (|residual| for one, 0.0 for none)."""
+    if len(residuals) >= 2:
+        return float(np.std(residuals, ddof=1))
+    return float(abs(residuals[0])) if len(residuals) else 0.0
@@ -0,0 +1,95 @@
+"""
+Maintenance of the monthly partitions of raw.sales_fact and raw.inventory_snapshot.
+
+    # Show partitions and their row estimates
+    python -m jobs.partitions list
+
+    # Create monthly partitions ahead of incoming data (jobs.ingest also does this for its range)
+    python -m jobs.partitions ensure --months-ahead 3
+
+    # Retention: detach partitions ending on or before the cutoff, moving them to the archive schema
+    python -m jobs.partitions retain --keep-months 36 --dry-run
+    python -m jobs.partitions retain --keep-months 36 --concurrently
+    python -m jobs.partitions retain --before 2024-01-01 --drop
+"""
+import argparse
+from datetime import date
+from jobs.utils.db import get_conn
+from jobs.utils.partitions import (
+    ARCHIVE_SCHEMA, PARTITIONED_TABLES, add_months, detach_partitions, ensure_partitions,
+    is_partitioned, list_partitions, month_start,
+)
+
+
+def cmd_list(conn, args):
+    for table in args.tables:
+        if not is_partitioned(conn, table):
+            print(f"{table}: not partitioned (apply db/migrations/13_raw_monthly_partitions.sql)")
+            continue
+        parts = list_partitions(conn, table)
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT c.oid::regclass::text, c.reltuples::bigint FROM pg_class c WHERE c.oid = ANY(%s::regclass[])",
+                ([p.name for p in parts],),
+            )
+            estimates = dict(cur.fetchall())
+        print(f"{table}: {len(parts)} partition(s)")
+        for p in parts:
+            rows = estimates.get(p.name, -1)
+            print(f"  {p.name:45s} [{p.lower}, {p.upper})  ~{rows if rows >= 0 else '?'} rows")
+
+
+def cmd_ensure(conn, args):
+    through = date.fromisoformat(args.through) if args.through else add_months(date.today(), args.months_ahead)
+    for table in args.tables:
+        parts = list_partitions(conn, table)
+        first = parts[-1].upper if parts else month_start(date.today())
+        created = ensure_partitions(conn, table, first, through)
+        print(f"{table}: created {len(created)} partition(s)" + (f": {', '.join(created)}" if created else ""))
+
+
+def cmd_retain(conn, args):
+    if args.before:
+        cutoff = date.fromisoformat(args.before)
+    else:
+        cutoff = add_months(date.today(), -args.keep_months)
+    action = "drop" if args.drop else f"move to schema {args.archive_schema}"
+    for table in args.tables:
+        detached = detach_partitions(
+            conn, table, cutoff, archive_schema=args.archive_schema, drop=args.drop,
+            concurrently=args.concurrently, dry_run=args.dry_run,
+        )
+        verb = "would detach" if args.dry_run else "detached"
+        print(f"{table}: {verb} {len(detached)} partition(s) ending on or before {cutoff} ({action})")
+        for p in detached:
+            print(f"  {p.name} [{p.lower}, {p.upper})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Monthly partitions of the raw fact tables")
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--tables", nargs="+", default=list(PARTITIONED_TABLES), choices=PARTITIONED_TABLES)
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("list", parents=[common], help="List partitions")
+    ensure = sub.add_parser("ensure", parents=[common], help="Create monthly partitions up to a date")
+    ensure.add_argument("--months-ahead", type=int, default=3, help="Cover months up to this many ahead of today")
+    ensure.add_argument("--through", type=str, default=None, help="Cover months up to this date (YYYY-MM-DD)")
+    retain = sub.add_parser("retain", parents=[common], help="Detach (archive or drop) partitions older than the retention window")
+    window = retain.add_mutually_exclusive_group(required=True)
+    window.add_argument("--keep-months", type=int, help="Keep partitions ending after the month this many months back")
+    window.add_argument("--before", type=str, help="Detach partitions ending on or before this date (YYYY-MM-DD)")
+    target = retain.add_mutually_exclusive_group()
+    target.add_argument("--archive-schema", type=str, default=ARCHIVE_SCHEMA,
+                        help=f"Schema detached partitions are moved to (default: {ARCHIVE_SCHEMA})")
+    target.add_argument("--drop", action="store_true", help="Drop detached partitions instead of archiving them")
+    retain.add_argument("--concurrently", action="store_true",
+                        help="DETACH ... CONCURRENTLY: does not block readers/writers of the parent")
+    retain.add_argument("--dry-run", action="store_true", help="Only report what would be detached")
+    args = parser.parse_args()
+
+    with get_conn() as conn:
+        {"list": cmd_list, "ensure": cmd_ensure, "retain": cmd_retain}[args.command](conn, args)
+
+
+if __name__ == "__main__":
+    main()
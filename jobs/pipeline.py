@@ -0,0 +1,345 @@
+"""
+DAG runner for the weekly pipeline:
+
+    ingest -> preprocess -> {train_baseline, train_ml} -> compute_policy
+
+Each stage declares the stages it depends on and the input watermarks it
+reads (cheap probes over the tables it consumes). Before a stage runs, its
+watermarks plus its command line form an input signature; when that matches
+the last successful execution of the stage, it is skipped. Stages whose
+dependencies are done run concurrently (up to --max-parallel), each as a
+`python -m jobs.<stage>` child process with retries. The DAG execution is an
+ops.batch_run (job_type 'pipeline') and every stage's state is kept in
+ops.pipeline_stage, so --resume reruns a failed pipeline from its failed
+stages while keeping the ones that already completed.
+
+    python -m jobs.pipeline
+    python -m jobs.pipeline --exclude ingest --stage-args train_ml="--horizon 4 --workers 4"
+    python -m jobs.pipeline --resume
+"""
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import argparse
+import shlex
+import signal
+import subprocess
+import sys
+import threading
+import uuid
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+import psycopg2
+from psycopg2.extras import Json
+from jobs.utils.db import get_conn
+from jobs.preprocess import fetch_source_high_water
+
+
+class Stage(NamedTuple):
+    name: str
+    args: Tuple[str, ...]  # default command-line arguments of `python -m jobs.<name>`
+    depends_on: Tuple[str, ...]
+    inputs: Tuple[str, ...]  # INPUT_PROBES names; no inputs = source stage, always runs
+    outputs: Tuple[str, ...]
+
+
+def _row(sql: str) -> Callable:
+    def probe(conn):
+        with conn.cursor() as cur:
+            cur.execute(sql)
+            return [str(v) if v is not None else None for v in cur.fetchone()]
+    return probe
+
+
+INPUT_PROBES: Dict[str, Callable] = {
+    "raw.sales_fact": lambda conn: [str(v) for v in fetch_source_high_water(conn, "raw.sales_fact")],
+    "raw.inventory_snapshot": lambda conn: [str(v) for v in fetch_source_high_water(conn, "raw.inventory_snapshot")],
+    "raw.sku_location_settings": _row(
+        "SELECT COUNT(*), SUM(lead_time_weeks), SUM(service_level) FROM raw.sku_location_settings"
+    ),
+    "curated.weekly_demand": _row(
+        "SELECT COUNT(*), MAX(week_start_date), SUM(units_sold::bigint) FROM curated.weekly_demand"
+    ),
+    "curated.weekly_inventory": _row(
+        "SELECT COUNT(*), MAX(week_start_date), SUM(end_on_hand::bigint), SUM(end_on_order::bigint) "
+        "FROM curated.weekly_inventory"
+    ),
+    "ops.batch_inference": _row("""
+        SELECT MAX(run_id::text) FROM (
+          SELECT run_id FROM ops.batch_run
+          WHERE job_type = 'batch_inference' AND status = 'succeeded'
+          ORDER BY started_at DESC LIMIT 1
+        ) r
+    """),
+}
+
+STAGES: Tuple[Stage, ...] = (
+    Stage("ingest", ("--skus", "1000", "--locations", "3", "--weeks", "156"), (), (),
+          ("raw.sku_dim", "raw.location_dim", "raw.calendar_dim", "raw.sku_location_settings",
+           "raw.sales_fact", "raw.inventory_snapshot")),
+    Stage("preprocess", (), ("ingest",), ("raw.sales_fact", "raw.inventory_snapshot"),
+          ("curated.weekly_demand", "curated.weekly_inventory", "curated.weekly_features")),
+    Stage("train_baseline", ("--horizon", "4"), ("preprocess",), ("curated.weekly_demand",),
+          ("ops.batch_inference", "ops.forecast", "ops.metrics_accuracy")),
+    Stage("train_ml", ("--horizon", "4"), ("preprocess",), ("curated.weekly_demand",),
+          ("ops.forecast", "ops.metrics_accuracy")),
+    Stage("compute_policy", (), ("train_baseline", "train_ml"),
+          ("ops.batch_inference", "raw.sku_location_settings", "curated.weekly_inventory"),
+          ("ops.replenishment_recommendation",)),
+)
+
+DONE = ("succeeded", "skipped")
+
+# Stage child processes alive right now, and whether the pipeline is being stopped (no more attempts)
+_children: set = set()
+_stopping = threading.Event()
+
+
+def write_batch_run_start(conn) -> uuid.UUID:
+    run_id = uuid.uuid4()
+    with conn.cursor() as cur:
+        cur.execute("""
+          INSERT INTO ops.batch_run (run_id, job_type, status, started_at)
+          VALUES (%s, 'pipeline', 'running', NOW())
+        """, (str(run_id),))
+        cur.executemany("""
+          INSERT INTO ops.pipeline_stage (run_id, stage) VALUES (%s, %s)
+        """, [(str(run_id), stage.name) for stage in STAGES])
+    conn.commit()
+    return run_id
+
+
+def write_batch_run_finish(conn, run_id: uuid.UUID, status: str, notes: str):
+    with conn.cursor() as cur:
+        cur.execute("""
+          UPDATE ops.batch_run SET status = %s, finished_at = NOW(), notes = %s WHERE run_id = %s
+        """, (status, notes, str(run_id)))
+    conn.commit()
+
+
+def find_failed_run(conn) -> Optional[str]:
+    with conn.cursor() as cur:
+        cur.execute("""
+          SELECT run_id FROM ops.batch_run
+          WHERE job_type = 'pipeline' AND status = 'failed'
+          ORDER BY started_at DESC LIMIT 1
+        """)
+        row = cur.fetchone()
+    return str(row[0]) if row else None
+
+
+def reopen_run(conn, run_id: str) -> Dict[str, str]:
+    """Mark a failed pipeline run running again; returns its stage statuses."""
+    with conn.cursor() as cur:
+        cur.execute("""
+          UPDATE ops.batch_run SET status = 'running', finished_at = NULL
+          WHERE run_id = %s AND job_type = 'pipeline' AND status IN ('failed', 'running')
+        """, (run_id,))
+        if cur.rowcount != 1:
+            conn.rollback()
+            raise RuntimeError(f"{run_id} is not a failed pipeline run")
+        cur.execute("SELECT stage, status FROM ops.pipeline_stage WHERE run_id = %s", (run_id,))
+        statuses = dict(cur.fetchall())
+        cur.executemany("""
+          INSERT INTO ops.pipeline_stage (run_id, stage) VALUES (%s, %s) ON CONFLICT DO NOTHING
+        """, [(run_id, stage.name) for stage in STAGES if stage.name not in statuses])
+    conn.commit()
+    return {stage.name: statuses.get(stage.name, 'pending') for stage in STAGES}
+
+
+def update_stage(conn, run_id, name: str, **fields):
+    columns = ", ".join(f"{k} = %s" for k in fields)
+    values = [Json(v) if k == "input_signature" else v for k, v in fields.items()]
+    with conn.cursor() as cur:
+        cur.execute(f"UPDATE ops.pipeline_stage SET {columns} WHERE run_id = %s AND stage = %s",
+                    (*values, str(run_id), name))
+    conn.commit()
+
+
+def input_signature(conn, stage: Stage, command: List[str]) -> Optional[Dict]:
+    """Watermarks of the stage's inputs plus its command; None for source stages."""
+    if not stage.inputs:
+        return None
+    signature = {name: INPUT_PROBES[name](conn) for name in stage.inputs}
+    signature["command"] = command
+    conn.commit()
+    return signature
+
+
+def last_done_signature(conn, name: str) -> Optional[Dict]:
+    """Input signature of the stage's latest successful (or skipped) execution."""
+    with conn.cursor() as cur:
+        cur.execute("""
+          SELECT input_signature FROM ops.pipeline_stage
+          WHERE stage = %s AND status IN ('succeeded', 'skipped') AND input_signature IS NOT NULL
+          ORDER BY finished_at DESC LIMIT 1
+        """, (name,))
+        row = cur.fetchone()
+    conn.commit()
+    return row[0] if row else None
+
+
+def run_command(name: str, command: List[str], retries: int, retry_delay: float) -> Tuple[bool, int, str]:
+    """
+    Run the stage as a child process, prefixing its output with the stage
+    name, retrying failures. Returns (succeeded, attempts, last error line).
+    """
+    error = ""
+    for attempt in range(1, retries + 2):
+        if _stopping.is_set():
+            return False, attempt - 1, error or "pipeline stopped"
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1)
+        _children.add(proc)
+        if _stopping.is_set():
+            proc.terminate()  # started while stop_children was running
+        try:
+            last_line = ""
+            for line in proc.stdout:
+                line = line.rstrip()
+                if line:
+                    last_line = line
+                print(f"[{name}] {line}", flush=True)
+            returncode = proc.wait()
+        finally:
+            _children.discard(proc)
+        if returncode == 0:
+            return True, attempt, ""
+        error = f"exit code {returncode}: {last_line}"[:500]
+        print(f"[pipeline] {name} failed (attempt {attempt}/{retries + 1}): {error}", flush=True)
+        if attempt <= retries:
+            _stopping.wait(retry_delay * attempt)
+    return False, retries + 1, error
+
+
+def stop_children():
+    """Stop retrying stages and terminate the running ones (the pool then only waits for them to exit)."""
+    _stopping.set()
+    for proc in list(_children):
+        proc.terminate()
+
+
+def parse_stage_args(values: List[str], parser: argparse.ArgumentParser) -> Dict[str, Tuple[str, ...]]:
+    names = {stage.name for stage in STAGES}
+    out = {}
+    for value in values:
+        name, sep, args = value.partition("=")
+        if not sep or name not in names:
+            parser.error(f"--stage-args expects STAGE=\"ARGS\" with STAGE one of {', '.join(sorted(names))}")
+        out[name] = tuple(shlex.split(args))
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the ingest -> preprocess -> train -> policy DAG")
+    parser.add_argument("--exclude", type=str, default="",
+                        help="Comma-separated stages to leave out (treated as done, e.g. ingest in production)")
+    parser.add_argument("--stage-args", action="append", default=[], metavar='STAGE="ARGS"',
+                        help="Replace a stage's default arguments, e.g. train_ml=\"--horizon 4 --workers 4\"")
+    parser.add_argument("--force", action="store_true", help="Run every stage even if its inputs are unchanged")
+    parser.add_argument("--max-parallel", type=int, default=2, help="Stages run at the same time")
+    parser.add_argument("--retries", type=int, default=1, help="Retries per failed stage")
+    parser.add_argument("--retry-delay", type=float, default=30.0,
+                        help="Seconds before the first retry (grows linearly per attempt)")
+    parser.add_argument("--resume", nargs="?", const="latest", default=None, metavar="RUN_ID",
+                        help="Resume a failed pipeline run (default: the latest one), rerunning only stages "
+                             "that did not complete")
+    args = parser.parse_args()
+    stage_args = parse_stage_args(args.stage_args, parser)
+    excluded = {s.strip() for s in args.exclude.split(",") if s.strip()}
+    unknown = excluded - {stage.name for stage in STAGES}
+    if unknown:
+        parser.error(f"unknown stage(s) in --exclude: {', '.join(sorted(unknown))}")
+
+    # SIGTERM unwinds like Ctrl-C, so an interrupted run is still marked failed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
+    with get_conn() as conn:
+        if args.resume:
+            run_id = find_failed_run(conn) if args.resume == "latest" else args.resume
+            if run_id is None:
+                raise RuntimeError("No failed pipeline run to resume")
+            status = {name: (s if s in DONE else 'pending') for name, s in reopen_run(conn, run_id).items()}
+            print(f"[pipeline] Resuming run {run_id}; already done: "
+                  f"{', '.join(n for n, s in status.items() if s in DONE) or 'none'}")
+        else:
+            run_id = write_batch_run_start(conn)
+            status = {stage.name: 'pending' for stage in STAGES}
+            print(f"[pipeline] Run {run_id} started")
+        for name in excluded:
+            if status[name] not in DONE:
+                status[name] = 'skipped'
+                update_stage(conn, run_id, name, status='skipped', finished_at=datetime.now(timezone.utc), error='excluded')
+
+        running = {}
+        with ThreadPoolExecutor(max_workers=max(1, args.max_parallel)) as pool:
+            try:
+                while True:
+                    # Dependents of a failed or blocked stage can never run
+                    for stage in STAGES:
+                        if status[stage.name] == 'pending' and any(
+                            status[d] in ('failed', 'blocked') for d in stage.depends_on
+                        ):
+                            status[stage.name] = 'blocked'
+                            update_stage(conn, run_id, stage.name, status='blocked')
+                    ready = [
+                        stage for stage in STAGES
+                        if status[stage.name] == 'pending' and all(status[d] in DONE for d in stage.depends_on)
+                    ]
+                    for stage in ready:
+                        if len(running) >= max(1, args.max_parallel):
+                            break
+                        command = [sys.executable, "-m", f"jobs.{stage.name}", *stage_args.get(stage.name, stage.args)]
+                        signature = input_signature(conn, stage, command[2:])
+                        if not args.force and signature is not None and signature == last_done_signature(conn, stage.name):
+                            status[stage.name] = 'skipped'
+                            update_stage(conn, run_id, stage.name, status='skipped', input_signature=signature,
+                                         command=shlex.join(command[2:]), finished_at=datetime.now(timezone.utc), error=None)
+                            print(f"[pipeline] {stage.name}: inputs unchanged since its last successful run, skipped")
+                            continue
+                        status[stage.name] = 'running'
+                        update_stage(conn, run_id, stage.name, status='running', input_signature=signature,
+                                     command=shlex.join(command[2:]), started_at=datetime.now(timezone.utc), finished_at=None, error=None)
+                        print(f"[pipeline] {stage.name}: starting")
+                        running[pool.submit(run_command, stage.name, command, args.retries, args.retry_delay)] = stage
+                    if not running:
+                        if any(s == 'pending' for s in status.values()):
+                            continue  # a skip just unblocked more stages
+                        break
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        stage = running.pop(future)
+                        ok, attempts, error = future.result()
+                        status[stage.name] = 'succeeded' if ok else 'failed'
+                        with conn.cursor() as cur:
+                            cur.execute("""
+                              UPDATE ops.pipeline_stage
+                              SET status = %s, attempts = attempts + %s, finished_at = NOW(), error = %s
+                              WHERE run_id = %s AND stage = %s
+                            """, (status[stage.name], attempts, error or None, str(run_id), stage.name))
+                        conn.commit()
+                        print(f"[pipeline] {stage.name}: {status[stage.name]}")
+            except BaseException as e:
+                # A stage runner raising (e.g. Popen failing) or Ctrl-C / SIGTERM: leave the run failed, not
+                # running, so --resume finds it. Best effort, the connection may be gone too.
+                try:
+                    conn.rollback()
+                    error = f"pipeline stopped: {type(e).__name__}: {e}"[:500]
+                    for name, s in status.items():
+                        if s == 'running':
+                            status[name] = 'failed'
+                            update_stage(conn, run_id, name, status='failed', finished_at=datetime.now(timezone.utc), error=error)
+                    write_batch_run_finish(conn, run_id, 'failed', ", ".join(f"{name}={s}" for name, s in status.items()))
+                except psycopg2.Error:
+                    pass
+                stop_children()
+                raise
+
+        failed = any(s in ('failed', 'blocked') for s in status.values())
+        notes = ", ".join(f"{name}={s}" for name, s in status.items())
+        write_batch_run_finish(conn, run_id, 'failed' if failed else 'succeeded', notes)
+        print(f"[pipeline] Run {run_id} {'failed' if failed else 'succeeded'}: {notes}")
+        if failed:
+            print(f"[pipeline] Fix the failure and rerun the remaining stages with: python -m jobs.pipeline --resume {run_id}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
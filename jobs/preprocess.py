@@ -1,6 +1,38 @@
-from jobs.utils.db import get_conn
+from datetime import date, datetime, timedelta
+import argparse
+import time
+from typing import Dict, Optional, Tuple
+import psycopg2
+from jobs.utils.db import get_conn, BULK_LOAD_SESSION
+from jobs.utils.instrument import RunProfiler, stage, add_instrument_arguments
+from jobs.utils.snapshot import add_snapshot_arguments, export_snapshot, is_current
 
-def upsert_weekly_demand(conn):
+SOURCE_TABLES = ("raw.sales_fact", "raw.inventory_snapshot")
+# The monthly partitions of both source tables line up, so the sales/inventory join and the
+# weekly aggregates can run partition by partition (ignored while the tables are plain heaps)
+PREPROCESS_SESSION = {**BULK_LOAD_SESSION, "enable_partitionwise_join": "on", "enable_partitionwise_aggregate": "on"}
+AFFECTED_WEEKS = "preprocess_affected_weeks"
+# Longest window in weekly_features (lag_52); rolling_8 falls inside it
+FEATURE_LOOKBACK_WEEKS = 52
+FEATURES_TABLE = "curated.weekly_features"
+FEATURES_SHADOW = "weekly_features_shadow"  # same schema, swapped in by rename
+SWAP_LOCK_TIMEOUT = "5s"  # per attempt; readers queue behind the swap for at most this long
+SWAP_ATTEMPTS = 5
+
+def _affected_weeks_filter(week_range: Optional[Tuple[date, date]], *aliases: str) -> Tuple[str, Dict[str, date]]:
+    """
+    WHERE clause restricting daily rows to AFFECTED_WEEKS. The explicit date
+    bounds let the planner use the date indexes (and prune partitions).
+    """
+    if week_range is None:
+        return "", {}
+    lo, hi = week_range
+    conds = [f"{alias}.date >= %(day_lo)s AND {alias}.date < %(day_hi)s" for alias in aliases]
+    conds.append(f"c.week_start_date IN (SELECT week_start_date FROM {AFFECTED_WEEKS})")
+    return "WHERE " + " AND ".join(conds), {"day_lo": lo, "day_hi": hi + timedelta(days=7)}
+
+def upsert_weekly_demand(conn, week_range: Optional[Tuple[date, date]] = None) -> int:
+    """Aggregate daily sales into weekly demand; only AFFECTED_WEEKS when week_range is given. Returns rows upserted."""
     sql = """
     INSERT INTO curated.weekly_demand (
         sku_id, location_id, week_start_date, units_sold, stockout_flag, data_quality_flags
@@ -16,17 +48,22 @@ def upsert_weekly_demand(conn):
     JOIN raw.calendar_dim c ON c.date = s.date
     LEFT JOIN raw.inventory_snapshot i
       ON i.sku_id = s.sku_id AND i.location_id = s.location_id AND i.date = s.date
+    {where}
     GROUP BY s.sku_id, s.location_id, c.week_start_date
     ON CONFLICT (sku_id, location_id, week_start_date) DO UPDATE SET
       units_sold = EXCLUDED.units_sold,
       stockout_flag = EXCLUDED.stockout_flag,
       data_quality_flags = EXCLUDED.data_quality_flags;
     """
+    where, params = _affected_weeks_filter(week_range, "s")
     with conn.cursor() as cur:
-        cur.execute(sql)
+        cur.execute(sql.format(where=where), params)
+        n = cur.rowcount
     conn.commit()
+    return n
 
-def upsert_weekly_inventory(conn):
+def upsert_weekly_inventory(conn, week_range: Optional[Tuple[date, date]] = None) -> int:
+    """Summarise daily inventory per week; only AFFECTED_WEEKS when week_range is given. Returns rows upserted."""
     sql = """
     WITH inv AS (
       SELECT
@@ -37,6 +74,7 @@ def upsert_weekly_inventory(conn):
         MAX(i.date) AS last_date
       FROM raw.inventory_snapshot i
       JOIN raw.calendar_dim c ON c.date = i.date
+      {where}
       GROUP BY i.sku_id, i.location_id, c.week_start_date
     ),
     last_vals AS (
@@ -47,6 +85,7 @@ def upsert_weekly_inventory(conn):
       FROM raw.inventory_snapshot i
       JOIN raw.calendar_dim c ON c.date = i.date
       JOIN inv v ON v.sku_id = i.sku_id AND v.location_id = i.location_id AND v.last_date = i.date
+      {where}
     )
     INSERT INTO curated.weekly_inventory (
       sku_id, location_id, week_start_date, avg_on_hand, end_on_hand, end_on_order
@@ -61,23 +100,24 @@ def upsert_weekly_inventory(conn):
       end_on_hand = EXCLUDED.end_on_hand,
       end_on_order = EXCLUDED.end_on_order;
     """
+    where, params = _affected_weeks_filter(week_range, "i")
     with conn.cursor() as cur:
-        cur.execute(sql)
+        cur.execute(sql.format(where=where), params)
+        n = cur.rowcount
     conn.commit()
+    return n
 
-def recompute_weekly_features(conn):
-    with conn.cursor() as cur:
-        cur.execute("TRUNCATE TABLE curated.weekly_features;")
-    conn.commit()
-
-    sql = """
-    INSERT INTO curated.weekly_features (
+def features_sql(table: str, source: str, target_filter: str) -> str:
+    """INSERT ... SELECT of the weekly_features rows computed from `source` into `table`."""
+    return """
+    INSERT INTO {table} (
       sku_id, location_id, week_start_date,
       lag_1, lag_2, lag_3, lag_4, lag_5, lag_6, lag_7, lag_8, lag_52,
       roll_mean_4, roll_std_4, roll_mean_8, roll_std_8,
       iso_week, iso_year, holiday_flag, season,
       promo_flag, price
     )
+    SELECT f.* FROM (
     SELECT
       d.sku_id,
       d.location_id,
@@ -101,24 +141,273 @@ def recompute_weekly_features(conn):
       cal.season,
       NULL::boolean AS promo_flag,
       NULL::numeric(12,2) AS price
-    FROM curated.weekly_demand d
+    FROM {source} d
     JOIN raw.calendar_dim cal
       ON cal.date = d.week_start_date
+    ) f
+    {target_filter}
     ;
+    """.format(table=table, source=source, target_filter=target_filter)
+
+def recompute_weekly_features(conn, week_range: Optional[Tuple[date, date]] = None) -> int:
+    """
+    Rebuild curated.weekly_features. With week_range=(lo, hi), only feature rows
+    in [lo, hi + FEATURE_LOOKBACK_WEEKS] are replaced (every week whose lags or
+    rolling windows can see an affected week), reading demand back to
+    lo - FEATURE_LOOKBACK_WEEKS. The lags are row-based, so this matches a full
+    rebuild as long as weekly series have no gaps, which holds for demand
+    aggregated from daily sales. Returns the number of feature rows written.
+    """
+    if week_range is None:
+        with conn.cursor() as cur:
+            cur.execute("TRUNCATE TABLE curated.weekly_features;")
+        conn.commit()
+        source, target_filter, params = "curated.weekly_demand", "", {}
+    else:
+        lo, hi = week_range
+        lookback = timedelta(weeks=FEATURE_LOOKBACK_WEEKS)
+        params = {"lo": lo, "hi": hi + lookback, "read_lo": lo - lookback}
+        source = """(
+      SELECT * FROM curated.weekly_demand
+      WHERE week_start_date >= %(read_lo)s AND week_start_date <= %(hi)s
+    )"""
+        target_filter = "WHERE f.week_start_date >= %(lo)s AND f.week_start_date <= %(hi)s"
+        with conn.cursor() as cur:
+            cur.execute("""
+              DELETE FROM curated.weekly_features
+              WHERE week_start_date >= %(lo)s AND week_start_date <= %(hi)s
+            """, params)
+
+    with conn.cursor() as cur:
+        cur.execute(features_sql(FEATURES_TABLE, source, target_filter), params)
+        n = cur.rowcount
+    conn.commit()
+    return n
+
+def _swap_suffix(name: str) -> str:
+    return name[:63 - len("_swap")] + "_swap"
+
+def rebuild_weekly_features_swap(conn, logged: bool = True) -> Dict[str, float]:
+    """
+    Full rebuild of curated.weekly_features without blocking its readers:
+    build the rows into an UNLOGGED shadow table (no WAL for the bulk insert),
+    add the live table's primary key, indexes and foreign keys after the load,
+    then swap the shadow in by renaming both tables in one short transaction.
+    Readers see the old rows until the swap commits and only wait on the
+    ACCESS EXCLUSIVE lock the renames take (bounded by SWAP_LOCK_TIMEOUT, retried
+    SWAP_ATTEMPTS times). With logged=True the shadow is switched to LOGGED
+    before the swap (one sequential WAL write, still outside the lock); with
+    logged=False the live table stays unlogged and is emptied by crash recovery,
+    which main() detects and answers with a full rebuild.
+    Returns timings in seconds plus the number of rows.
+    """
+    schema, live = FEATURES_TABLE.split(".")
+    shadow = f"{schema}.{FEATURES_SHADOW}"
+    timings = {}
+    with conn.cursor() as cur:
+        cur.execute("""
+          SELECT conname, contype, pg_get_constraintdef(oid) FROM pg_constraint
+          WHERE conrelid = %s::regclass AND contype IN ('p', 'u', 'f') ORDER BY contype DESC, conname
+        """, (FEATURES_TABLE,))
+        constraints = cur.fetchall()
+        cur.execute("""
+          SELECT indexname, indexdef FROM pg_indexes
+          WHERE schemaname = %s AND tablename = %s
+            AND indexname NOT IN (SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass)
+          ORDER BY indexname
+        """, (schema, live, FEATURES_TABLE))
+        indexes = cur.fetchall()
+
+        t0 = time.perf_counter()
+        cur.execute(f"DROP TABLE IF EXISTS {shadow}")
+        # NOT NULL, CHECK constraints and defaults come with LIKE; index-backed names must stay unique
+        # in the schema until the swap, so the shadow's get a _swap suffix that is renamed back after it
+        cur.execute(f"CREATE UNLOGGED TABLE {shadow} (LIKE {FEATURES_TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+        cur.execute(features_sql(shadow, "curated.weekly_demand", ""))
+        rows = cur.rowcount
+        conn.commit()
+        timings["load_s"] = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        renames = []
+        for name, contype, definition in constraints:
+            if contype == "f":
+                cur.execute(f"ALTER TABLE {shadow} ADD CONSTRAINT {name} {definition} NOT VALID")
+                cur.execute(f"ALTER TABLE {shadow} VALIDATE CONSTRAINT {name}")
+            else:
+                cur.execute(f"ALTER TABLE {shadow} ADD CONSTRAINT {_swap_suffix(name)} {definition}")
+                renames.append((_swap_suffix(name), name))
+        for name, definition in indexes:
+            definition = definition.replace(f"INDEX {name} ON {FEATURES_TABLE} ", f"INDEX {_swap_suffix(name)} ON {shadow} ", 1)
+            cur.execute(definition)
+            renames.append((_swap_suffix(name), name))
+        cur.execute(f"ANALYZE {shadow}")
+        if logged:
+            cur.execute(f"ALTER TABLE {shadow} SET LOGGED")
+        conn.commit()
+        timings["index_s"] = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        for attempt in range(1, SWAP_ATTEMPTS + 1):
+            try:
+                cur.execute("SET LOCAL lock_timeout = %s", (SWAP_LOCK_TIMEOUT,))
+                cur.execute(f"LOCK TABLE {FEATURES_TABLE} IN ACCESS EXCLUSIVE MODE")
+                locked = time.perf_counter()
+                cur.execute(f"ALTER TABLE {FEATURES_TABLE} RENAME TO {live}_old")
+                cur.execute(f"ALTER TABLE {shadow} RENAME TO {live}")
+                cur.execute(f"DROP TABLE {schema}.{live}_old")
+                for tmp, name in renames:
+                    cur.execute(f"ALTER INDEX {schema}.{tmp} RENAME TO {name}")
+                conn.commit()
+                timings["lock_held_s"] = time.perf_counter() - locked
+                break
+            except psycopg2.errors.LockNotAvailable:
+                conn.rollback()
+                print(f"  swap attempt {attempt}/{SWAP_ATTEMPTS}: {FEATURES_TABLE} is busy, retrying ...")
+        else:
+            cur.execute(f"DROP TABLE IF EXISTS {shadow}")
+            conn.commit()
+            raise RuntimeError(f"could not lock {FEATURES_TABLE} for the swap after {SWAP_ATTEMPTS} attempts")
+        timings["lock_wait_s"] = time.perf_counter() - t0 - timings["lock_held_s"]
+    timings["rows"] = rows
+    return timings
+
+def features_lost(conn) -> bool:
+    """True if weekly_features is empty while weekly_demand is not (an unlogged table after a crash)."""
+    with conn.cursor() as cur:
+        cur.execute("""
+          SELECT NOT EXISTS (SELECT 1 FROM curated.weekly_features)
+             AND EXISTS (SELECT 1 FROM curated.weekly_demand)
+        """)
+        return cur.fetchone()[0]
+
+def fetch_watermark(conn, source_table: str) -> Optional[Tuple[datetime, date]]:
+    with conn.cursor() as cur:
+        cur.execute("""
+          SELECT max_created_at, max_date FROM ops.etl_watermark WHERE source_table = %s
+        """, (source_table,))
+        row = cur.fetchone()
+    return (row[0], row[1]) if row else None
+
+def fetch_source_high_water(conn, source_table: str) -> Tuple[Optional[datetime], Optional[date]]:
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT MAX(created_at), MAX(date) FROM {source_table}")
+        return cur.fetchone()
+
+def write_watermark(conn, source_table: str, high_water: Tuple[Optional[datetime], Optional[date]]):
+    with conn.cursor() as cur:
+        cur.execute("""
+          INSERT INTO ops.etl_watermark (source_table, max_created_at, max_date, updated_at)
+          VALUES (%s, %s, %s, NOW())
+          ON CONFLICT (source_table) DO UPDATE SET
+            max_created_at = EXCLUDED.max_created_at,
+            max_date = EXCLUDED.max_date,
+            updated_at = NOW()
+        """, (source_table, *high_water))
+    conn.commit()
+
+def collect_affected_weeks(conn, watermarks: Dict[str, Tuple[datetime, date]], since: Optional[date] = None) -> Optional[Tuple[date, date]]:
     """
+    Materialise AFFECTED_WEEKS: every week holding a source row created or dated
+    after that source's watermark (or dated on/after `since`). jobs.ingest resets
+    created_at on the rows it upserts, so corrected rows count as created.
+    Returns the (first, last) affected week, or None if nothing changed.
+    """
+    selects = []
+    params: Dict[str, object] = {"since": since}
+    for k, table in enumerate(SOURCE_TABLES):
+        created_wm, date_wm = watermarks[table]
+        params[f"created_{k}"] = created_wm
+        params[f"date_{k}"] = date_wm
+        selects.append(f"""
+          SELECT c.week_start_date
+          FROM {table} t
+          JOIN raw.calendar_dim c ON c.date = t.date
+          WHERE t.created_at > %(created_{k})s OR t.date > %(date_{k})s OR t.date >= %(since)s
+        """)
     with conn.cursor() as cur:
-        cur.execute(sql)
+        cur.execute(f"DROP TABLE IF EXISTS {AFFECTED_WEEKS}")
+        cur.execute(f"CREATE TEMP TABLE {AFFECTED_WEEKS} AS {' UNION '.join(selects)}", params)
+        cur.execute(f"SELECT MIN(week_start_date), MAX(week_start_date), COUNT(*) FROM {AFFECTED_WEEKS}")
+        lo, hi, n_weeks = cur.fetchone()
     conn.commit()
+    if not n_weeks:
+        return None
+    print(f"  {n_weeks} affected week(s) between {lo} and {hi}")
+    return lo, hi
+
+def publish_snapshot(conn, root: str):
+    print(f"Publishing columnar snapshot to {root} ...")
+    with stage("snapshot") as s:
+        manifest = export_snapshot(conn, root)
+        s.rows = sum(t["rows"] for t in manifest["tables"].values())
+    print(f"  snapshot {manifest['version']}: " + ", ".join(
+        f"{name}={t['rows']}" for name, t in manifest["tables"].items()))
 
 def main():
-    with get_conn() as conn:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--full", action="store_true",
+                        help="Re-aggregate all history and rebuild weekly_features from scratch")
+    parser.add_argument("--since", type=str, default=None,
+                        help="Also treat every week on/after this date (YYYY-MM-DD) as affected, e.g. after corrections made outside jobs.ingest")
+    parser.add_argument("--features-rebuild", choices=("truncate", "swap"), default="truncate",
+                        help="Full weekly_features rebuild: truncate + insert in place, or build a shadow table "
+                             "and swap it in by rename (readers keep the old rows meanwhile)")
+    parser.add_argument("--features-unlogged", action="store_true",
+                        help="With --features-rebuild swap, leave weekly_features UNLOGGED (faster; emptied by a crash, "
+                             "which the next run detects and rebuilds)")
+    add_snapshot_arguments(parser)
+    add_instrument_arguments(parser)
+    args = parser.parse_args()
+    since = date.fromisoformat(args.since) if args.since else None
+
+    with get_conn(session=PREPROCESS_SESSION) as conn, \
+            RunProfiler("preprocess", profile=args.profile, trace_memory=args.trace_memory) as prof:
+        # Read the new high-water marks before aggregating so rows landing mid-run are picked up next time
+        with stage("read_watermarks"):
+            high_water = {table: fetch_source_high_water(conn, table) for table in SOURCE_TABLES}
+            watermarks = {table: fetch_watermark(conn, table) for table in SOURCE_TABLES}
+        week_range = None
+        if not args.full and all(wm is not None and wm[0] is not None for wm in watermarks.values()):
+            print("Collecting weeks changed since the last run ...")
+            with stage("collect_affected_weeks"):
+                week_range = collect_affected_weeks(conn, watermarks, since)
+            if week_range is None:
+                if args.snapshot_dir and not is_current(conn, args.snapshot_dir):
+                    publish_snapshot(conn, args.snapshot_dir)
+                prof.save(conn)
+                print("No new raw data since the last run; nothing to do.")
+                return
+        else:
+            print("Full rebuild ...")
+
         print("Upserting curated.weekly_demand ...")
-        upsert_weekly_demand(conn)
+        with stage("weekly_demand") as s:
+            s.rows = upsert_weekly_demand(conn, week_range)
         print("Upserting curated.weekly_inventory ...")
-        upsert_weekly_inventory(conn)
+        with stage("weekly_inventory") as s:
+            s.rows = upsert_weekly_inventory(conn, week_range)
+        features_range = week_range
+        if features_range is not None and features_lost(conn):
+            print("curated.weekly_features is empty (unlogged table after a crash?); rebuilding it in full ...")
+            features_range = None
         print("Recomputing curated.weekly_features ...")
-        recompute_weekly_features(conn)
-        print("Preprocessing completed.")
+        with stage("weekly_features") as s:
+            if features_range is None and args.features_rebuild == "swap":
+                timings = rebuild_weekly_features_swap(conn, logged=not args.features_unlogged)
+                s.rows = timings["rows"]
+                print(f"  shadow swap: load {timings['load_s']:.2f}s, indexes {timings['index_s']:.2f}s, "
+                      f"lock wait {timings['lock_wait_s'] * 1000:.1f}ms, lock held {timings['lock_held_s'] * 1000:.1f}ms")
+            else:
+                s.rows = recompute_weekly_features(conn, features_range)
+        with stage("write_watermarks"):
+            for table, hw in high_water.items():
+                write_watermark(conn, table, hw)
+        if args.snapshot_dir:
+            publish_snapshot(conn, args.snapshot_dir)
+        stage_run_id = prof.save(conn)
+        print(prof.report())
+        print(f"Preprocessing completed (stage metrics: ops.run_stage run_id={stage_run_id}).")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
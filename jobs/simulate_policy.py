@@ -0,0 +1,349 @@
+"""
+Monte Carlo replay of a compute_policy run over every SKU-location at once.
+
+Weekly demand is bootstrapped per series, either from its recent history in
+curated.weekly_demand or as the run's mean weekly forecast (mu_LT / lead
+time) plus resampled backtest residuals (actual - forecast) from
+ops.metrics_accuracy. Each week of a path: receipts due that week arrive,
+demand is served from on-hand (unmet demand is lost), and when the inventory
+position (on-hand + on-order) is below ROP an order up to S arrives lead
+time weeks later. S is ROP by default, which is compute_policy's
+qty = max(ROP - on_hand - on_order, 0); --order-up-to-weeks raises it by
+that many weeks of mean demand.
+
+State is (series x paths) arrays; series are simulated in chunks sized to
+--max-memory-mb, and only per-series sums are kept between chunks. Per
+series it reports the fill rate (served / demanded units), the cycle service
+level (share of weeks without a stockout, what the z-based ROP targets),
+stockout weeks per path and the average end-of-week on-hand.
+
+    python -m jobs.simulate_policy --paths 2000 --weeks 52
+    python -m jobs.simulate_policy --demand-source residuals --order-up-to-weeks 2
+"""
+import argparse
+import uuid
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from jobs.compute_policy import write_batch_run_start, write_batch_run_finish, fetch_latest_inference_run
+from jobs.panel import DemandPanel
+from jobs.utils.db import get_conn, copy_upsert, iter_groups
+from jobs.utils.instrument import RunProfiler, stage, add_instrument_arguments
+from jobs.utils.snapshot import add_snapshot_arguments, open_snapshot
+
+DEMAND_SOURCES = ("history", "residuals")
+HISTORY_WEEKS = 104  # most recent observed weeks bootstrapped per series
+STATE_ARRAYS = 12  # (series x paths) float32-sized arrays alive per simulated week, besides the pipeline
+
+SIMULATION_COLUMNS = [
+    "run_id", "sku_id", "location_id", "policy_run_id", "demand_source", "paths", "weeks",
+    "lead_time_weeks", "service_level", "rop_units", "order_up_to_units",
+    "fill_rate", "cycle_service_level", "stockout_weeks", "avg_on_hand",
+]
+
+
+def fetch_latest_policy_run(conn) -> Optional[uuid.UUID]:
+    with conn.cursor() as cur:
+        cur.execute("""
+          SELECT run_id
+          FROM ops.batch_run
+          WHERE job_type = 'compute_policy' AND status = 'succeeded'
+          ORDER BY started_at DESC
+          LIMIT 1
+        """)
+        row = cur.fetchone()
+    return uuid.UUID(str(row[0])) if row else None
+
+
+def fetch_policy(conn, policy_run: uuid.UUID) -> Tuple[List[Tuple[str, str]], Dict[str, np.ndarray]]:
+    """
+    (keys, arrays) of a compute_policy run's recommendations in (sku_id,
+    location_id) order: lead_time (at least 1), service_level, rop, mu_lt,
+    on_hand, on_order.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+          SELECT sku_id, location_id, GREATEST(lead_time_weeks, 1), service_level::float8,
+                 rop_units::float8, mu_lt::float8, on_hand, on_order
+          FROM ops.replenishment_recommendation
+          WHERE run_id = %s
+          ORDER BY sku_id, location_id
+        """, (str(policy_run),))
+        rows = cur.fetchall()
+    keys = [(sku, loc) for sku, loc, *_ in rows]
+    columns = list(zip(*rows)) if rows else [()] * 8
+    names = ("lead_time", "service_level", "rop", "mu_lt", "on_hand", "on_order")
+    types = (np.int64, np.float64, np.float64, np.float64, np.float64, np.float64)
+    return keys, {n: np.array(c, dtype=t) for n, c, t in zip(names, columns[2:], types)}
+
+
+def _pack(values: np.ndarray, mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Move each row's valid values to the front: (pool, counts)."""
+    order = np.argsort(~mask, axis=1, kind="stable")
+    return np.take_along_axis(np.where(mask, values, 0), order, axis=1).astype(np.float64), mask.sum(axis=1)
+
+
+def history_pools(panel: DemandPanel, keys: List[Tuple[str, str]], weeks: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Per key, the units of its last `weeks` observed weeks as (pool, counts):
+    pool[i, :counts[i]] are the samples of key i (counts 0 if it has none).
+    """
+    pools = np.zeros((len(keys), max(1, weeks)))
+    counts = np.zeros(len(keys), dtype=np.int64)
+    if not len(panel):
+        return pools, counts
+    # Keep the last `weeks` observed values of every row, then left-align them
+    rank = np.cumsum(panel.mask[:, ::-1], axis=1)[:, ::-1]
+    recent = panel.mask & (rank <= weeks)
+    pool, n = _pack(panel.values, recent)
+    rows = np.array([panel.codes.get(k, -1) for k in keys], dtype=np.int64)
+    found = rows >= 0
+    width = min(pools.shape[1], pool.shape[1])
+    pools[found, :width] = pool[rows[found], :width]
+    counts[found] = n[rows[found]]
+    return pools, counts
+
+
+def residual_pools(conn, keys: List[Tuple[str, str]], run_id: uuid.UUID, weeks: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Per key, its last `weeks` backtest residuals (actual - forecast) of an
+    ops.metrics_accuracy run, laid out like history_pools.
+    """
+    codes = {k: i for i, k in enumerate(keys)}
+    pools = np.zeros((len(keys), max(1, weeks)))
+    counts = np.zeros(len(keys), dtype=np.int64)
+    groups = iter_groups(conn, """
+      SELECT sku_id, location_id, (actual_units - forecast_units)::float8
+      FROM ops.metrics_accuracy
+      WHERE run_id = %s
+      ORDER BY sku_id, location_id, week_start_date DESC
+    """, (str(run_id),), name="policy_residuals")
+    for key, rows in groups:
+        i = codes.get(key)
+        if i is None:
+            continue
+        residuals = [r for (r,) in rows[:weeks]]
+        pools[i, :len(residuals)] = residuals
+        counts[i] = len(residuals)
+    return pools, counts
+
+
+def simulate_chunk(
+    lead_time: np.ndarray, rop: np.ndarray, order_up_to: np.ndarray,
+    on_hand0: np.ndarray, on_order0: np.ndarray,
+    base: np.ndarray, pool: np.ndarray, counts: np.ndarray,
+    paths: int, weeks: int, warmup: int, rng: np.random.Generator,
+) -> Dict[str, np.ndarray]:
+    """
+    Simulate `paths` demand paths of warmup + weeks weeks for a chunk of
+    series; weekly demand is max(base + a uniform draw from the series' pool
+    row, 0). Returns per-series sums over the weeks after warmup: demand,
+    served, stockouts (path-weeks with unmet demand) and on_hand.
+    """
+    n, width = pool.shape
+    series = np.arange(n)
+    slots = int(lead_time.max()) + 1 if n else 1
+    # Runs of equal lead time (simulate() sorts by it) receive orders into one slot each
+    starts = np.flatnonzero(np.r_[True, lead_time[1:] != lead_time[:-1]]) if n else np.zeros(0, dtype=np.int64)
+    runs = list(zip(starts.tolist(), np.r_[starts[1:], n].tolist(), lead_time[starts].tolist()))
+    shifted = bool((base != 0).any())
+    # float32 state, updated in place: the loop is bound by memory bandwidth
+    column = lambda a: np.asarray(a, dtype=np.float32)[:, None]
+    rop, order_up_to, base = column(rop), column(order_up_to), column(base)
+    on_hand = np.repeat(column(on_hand0), paths, axis=1)
+    on_order = np.repeat(column(on_order0), paths, axis=1)
+    # pipeline[t % slots] holds the receipts due at the start of week t
+    pipeline = np.zeros((slots, n, paths), dtype=np.float32)
+    pipeline[1 % slots] = on_order
+    samples = pool.astype(np.float32).ravel()
+    offset = (series * width)[:, None]
+    high = column(np.maximum(counts, 1))
+    last = offset + np.maximum(counts, 1)[:, None] - 1
+    draw = np.empty((n, paths), dtype=np.float32)
+    index = np.empty((n, paths), dtype=np.int64)
+    demand, served, qty = (np.empty((n, paths), dtype=np.float32) for _ in range(3))
+    totals = {name: np.zeros(n) for name in ("demand", "served", "stockouts", "on_hand")}
+    for t in range(warmup + weeks):
+        due = pipeline[t % slots]
+        on_hand += due
+        on_order -= due
+        due[:] = 0.0
+        rng.random(out=draw, dtype=np.float32)
+        draw *= high
+        index[:] = draw
+        index += offset
+        np.minimum(index, last, out=index)  # float32 rounding can reach counts
+        np.take(samples, index, out=demand)
+        if shifted:
+            demand += base
+            np.maximum(demand, 0.0, out=demand)
+        np.minimum(on_hand, demand, out=served)
+        on_hand -= served
+        # qty = floor(S - position) where position = on_hand + on_order < ROP, else 0
+        np.add(on_hand, on_order, out=qty)
+        below = qty < rop
+        np.subtract(order_up_to, qty, out=qty)
+        np.floor(qty, out=qty)
+        qty *= below
+        np.maximum(qty, 0.0, out=qty)
+        on_order += qty
+        for lo, hi, lt in runs:
+            pipeline[(t + lt) % slots, lo:hi] += qty[lo:hi]
+        if t >= warmup:
+            totals["demand"] += demand.sum(axis=1, dtype=np.float64)
+            totals["served"] += served.sum(axis=1, dtype=np.float64)
+            totals["stockouts"] += np.count_nonzero(demand > served, axis=1)
+            totals["on_hand"] += on_hand.sum(axis=1, dtype=np.float64)
+    return totals
+
+
+def simulate(
+    policy: Dict[str, np.ndarray], base: np.ndarray, pool: np.ndarray, counts: np.ndarray,
+    order_up_to_weeks: float, paths: int, weeks: int, warmup: int, seed: int, max_memory_mb: float,
+) -> Dict[str, np.ndarray]:
+    """
+    Simulate every series of `policy` (fetch_policy arrays) in chunks whose
+    state fits in max_memory_mb. Returns per-series order_up_to, fill_rate,
+    cycle_service_level, stockout_weeks (per path) and avg_on_hand.
+    """
+    n = len(policy["rop"])
+    lead_time = policy["lead_time"]
+    mean_weekly = policy["mu_lt"] / lead_time
+    order_up_to = policy["rop"] + order_up_to_weeks * mean_weekly
+    slots = int(lead_time.max()) + 1 if n else 1
+    bytes_per_series = (slots + STATE_ARRAYS) * paths * 4
+    chunk = max(1, int(max_memory_mb * 1024 * 1024 // bytes_per_series))
+    rng = np.random.default_rng(seed)
+    order = np.argsort(lead_time, kind="stable")
+    totals = {name: np.zeros(n) for name in ("demand", "served", "stockouts", "on_hand")}
+    for lo in range(0, n, chunk):
+        part = order[lo:lo + chunk]
+        with stage("simulate") as s:
+            sums = simulate_chunk(
+                lead_time[part], policy["rop"][part], order_up_to[part],
+                policy["on_hand"][part], policy["on_order"][part],
+                base[part], pool[part], counts[part], paths, weeks, warmup, rng,
+            )
+            s.rows = len(part) * paths * (warmup + weeks)
+        for name, values in sums.items():
+            totals[name][part] = values
+    path_weeks = float(paths * weeks)
+    demand = totals["demand"]
+    return {
+        "order_up_to": order_up_to,
+        "fill_rate": np.divide(totals["served"], demand, out=np.ones(n), where=demand > 0),
+        "cycle_service_level": 1.0 - totals["stockouts"] / path_weeks,
+        "stockout_weeks": totals["stockouts"] / paths,
+        "avg_on_hand": totals["on_hand"] / path_weeks,
+    }
+
+
+def simulation_rows(run_id, policy_run, demand_source, paths, weeks, keys, policy, result, usable):
+    """Rows in SIMULATION_COLUMNS order for the series where usable is set."""
+    run, prun = str(run_id), str(policy_run)
+    for i in np.flatnonzero(usable).tolist():
+        sku, loc = keys[i]
+        yield (
+            run, sku, loc, prun, demand_source, paths, weeks,
+            int(policy["lead_time"][i]), float(policy["service_level"][i]), float(policy["rop"][i]),
+            float(result["order_up_to"][i]), float(result["fill_rate"][i]),
+            float(result["cycle_service_level"][i]), float(result["stockout_weeks"][i]),
+            float(result["avg_on_hand"][i]),
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Monte Carlo evaluation of replenishment policies")
+    parser.add_argument("--policy-run", type=str, default=None,
+                        help="compute_policy run to evaluate (default: latest succeeded)")
+    parser.add_argument("--demand-source", choices=DEMAND_SOURCES, default="history",
+                        help="history: bootstrap weekly_demand; residuals: mean forecast + backtest residuals")
+    parser.add_argument("--residual-run", type=str, default=None,
+                        help="run whose ops.metrics_accuracy residuals are resampled (default: latest batch_inference)")
+    parser.add_argument("--history-weeks", type=int, default=HISTORY_WEEKS,
+                        help="Most recent observed weeks (or residuals) resampled per series")
+    parser.add_argument("--paths", type=int, default=1000, help="Simulated demand paths per series")
+    parser.add_argument("--weeks", type=int, default=52, help="Simulated weeks per path (after warm-up)")
+    parser.add_argument("--warmup", type=int, default=8, help="Weeks simulated before statistics are collected")
+    parser.add_argument("--order-up-to-weeks", type=float, default=0.0,
+                        help="Order up to ROP + this many weeks of mean demand (0 = order up to ROP)")
+    parser.add_argument("--max-memory-mb", type=float, default=512.0,
+                        help="Approximate memory for one chunk of simulated series")
+    parser.add_argument("--seed", type=int, default=0)
+    add_snapshot_arguments(parser)
+    add_instrument_arguments(parser)
+    args = parser.parse_args()
+    if args.paths < 1 or args.weeks < 1 or args.warmup < 0 or args.history_weeks < 1:
+        parser.error("--paths, --weeks and --history-weeks must be positive and --warmup non-negative")
+
+    with get_conn() as conn, \
+            RunProfiler("simulate_policy", profile=args.profile, trace_memory=args.trace_memory) as prof:
+        policy_run = uuid.UUID(args.policy_run) if args.policy_run else fetch_latest_policy_run(conn)
+        if policy_run is None:
+            raise RuntimeError("No successful compute_policy run found")
+        run_id = write_batch_run_start(conn, "simulate_policy")
+        try:
+            with stage("read_policy") as s:
+                keys, policy = fetch_policy(conn, policy_run)
+                s.rows = len(keys)
+            if not keys:
+                raise RuntimeError(f"compute_policy run {policy_run} has no recommendations")
+
+            with stage("read_demand") as s:
+                if args.demand_source == "history":
+                    panel = DemandPanel.load(conn, keys=keys, snapshot=open_snapshot(conn, args.snapshot_dir))
+                    pool, counts = history_pools(panel, keys, args.history_weeks)
+                    base = np.zeros(len(keys))
+                    usable = counts > 0
+                else:
+                    residual_run = uuid.UUID(args.residual_run) if args.residual_run else fetch_latest_inference_run(conn)
+                    if residual_run is None:
+                        raise RuntimeError("No successful batch_inference run found")
+                    pool, counts = residual_pools(conn, keys, residual_run, args.history_weeks)
+                    # Series without residuals get their mean forecast as deterministic demand
+                    base = policy["mu_lt"] / policy["lead_time"]
+                    usable = np.ones(len(keys), dtype=bool)
+                s.rows = int(counts.sum())
+
+            result = simulate(
+                {name: values[usable] for name, values in policy.items()},
+                base[usable], pool[usable], counts[usable],
+                args.order_up_to_weeks, args.paths, args.weeks, args.warmup, args.seed, args.max_memory_mb,
+            )
+            full = {name: np.zeros(len(keys)) for name in result}
+            for name, values in result.items():
+                full[name][usable] = values
+
+            with stage("write_results") as s:
+                s.rows = copy_upsert(
+                    conn, "ops.policy_simulation", SIMULATION_COLUMNS,
+                    simulation_rows(run_id, policy_run, args.demand_source, args.paths, args.weeks,
+                                    keys, policy, full, usable),
+                    conflict_columns=["run_id", "sku_id", "location_id"],
+                    touch_columns=["computed_at"],
+                )
+        except Exception as e:
+            conn.rollback()
+            prof.save(conn, run_id)
+            write_batch_run_finish(conn, run_id, status="failed", notes=str(e)[:500])
+            raise
+
+        target = policy["service_level"][usable]
+        met_cycle = int((result["cycle_service_level"] >= target).sum())
+        met_fill = int((result["fill_rate"] >= target).sum())
+        n = int(usable.sum())
+        notes = (
+            f"policy_run={policy_run} source={args.demand_source} series={n} skipped={len(keys) - n} "
+            f"paths={args.paths} weeks={args.weeks} "
+            f"mean_fill_rate={result['fill_rate'].mean():.4f} "
+            f"mean_cycle_service={result['cycle_service_level'].mean():.4f} "
+            f"met_cycle_target={met_cycle}/{n} met_fill_target={met_fill}/{n}"
+        )
+        prof.save(conn, run_id)
+        write_batch_run_finish(conn, run_id, status="succeeded", notes=notes)
+        print(f"Policy simulation run {run_id} completed.")
+        print(f"  {notes}")
+        print(prof.report())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,25 @@
-from datetime import date, timedelta
+from datetime import date
 import argparse
 import uuid
-from typing import List, Tuple, Dict
+from typing import List, Optional, Sequence, Tuple
 import numpy as np
 import psycopg2
 import psycopg2.extras
-from jobs.utils.db import get_conn
+from jobs.utils.db import get_conn, copy_upsert, BULK_LOAD_SESSION
+from jobs.panel import (
+    DemandPanel, PanelSeries, panel_keys, seasonal_naive, backtest_origins, backtest_seasonal_naive,
+    horizon_seasonal_naive, residual_std,
+)
+from jobs.utils.checkpoint import load_run_config, save_run_config
+from jobs.utils.instrument import RunProfiler, stage, add_instrument_arguments
+from jobs.utils.snapshot import Snapshot, add_snapshot_arguments, open_snapshot
+from jobs.utils.work_queue import (
+    add_work_queue_arguments, create_work_items, default_worker_id, find_open_run,
+    finish_run_if_complete, process_work_items,
+)
 
 H_DEFAULT = 4
 BACKTEST_WEEKS = 26
-FALLBACK_WINDOW = 8
 
 def fetch_latest_week(conn) -> date:
     with conn.cursor() as cur:
@@ -19,50 +29,21 @@ def fetch_latest_week(conn) -> date:
             raise RuntimeError("No weekly demand data found")
         return row[0]
 
-def fetch_weekly_demand(conn) -> List[Tuple[str, str, date, int]]:
-    sql = """
-      SELECT sku_id, location_id, week_start_date, units_sold
-      FROM curated.weekly_demand
-      ORDER BY sku_id, location_id, week_start_date
-    """
-    with conn.cursor() as cur:
-        cur.execute(sql)
-        return cur.fetchall()
-
-def group_by_sku_loc(rows: List[Tuple[str, str, date, int]]) -> Dict[Tuple[str,str], List[Tuple[date,int]]]:
-    data: Dict[Tuple[str,str], List[Tuple[date,int]]] = {}
-    for sku_id, loc_id, ws, units in rows:
-        data.setdefault((sku_id, loc_id), []).append((ws, units))
-    return data
-
-def seasonal_naive_forecast(ts: List[Tuple[date,int]], target_week: date) -> float:
-    ref_week = target_week - timedelta(weeks=52)
-    values = {w:u for (w,u) in ts}
-    if ref_week in values:
-        return float(values[ref_week])
-    prior_weeks = [w for (w,_) in ts if w < target_week]
-    prior_weeks.sort()
-    recent = prior_weeks[-FALLBACK_WINDOW:] if len(prior_weeks) >= FALLBACK_WINDOW else prior_weeks
-    avg = np.mean([values[w] for w in recent]) if recent else 0.0
-    return float(max(avg, 0.0))
-
-def compute_backtest(ts: List[Tuple[date,int]], latest_week: date) -> Tuple[List[Tuple[date,float,float,float]], float]:
-    if not ts:
+def seasonal_naive_forecast(series: PanelSeries, target: int) -> float:
+    """Seasonal naive forecast of one series for week index `target`."""
+    return float(seasonal_naive(series.values[None], series.mask[None], [target])[0, 0])
+
+def compute_backtest(series: PanelSeries, latest: int) -> Tuple[List[Tuple[date,float,float,float]], float]:
+    origins = backtest_origins(series.mask, latest, BACKTEST_WEEKS)
+    if not len(origins):
         return [], 0.0
-    values = {w:u for (w,u) in ts}
-    weeks = sorted([w for (w,_) in ts])
+    targets = origins + 1
+    forecasts = seasonal_naive(series.values[None], series.mask[None], targets)[0]
     per_week = []
-    for w in reversed(weeks):
-        if w >= latest_week - timedelta(weeks=BACKTEST_WEEKS):
-            target = w + timedelta(weeks=1)
-            if target in values:
-                f = seasonal_naive_forecast(ts, target)
-                a = float(values[target])
-                residual = a - f
-                per_week.append((target, a, f, residual))
-    residuals = [r for (_,_,_,r) in per_week]
-    residual_std = float(np.std(residuals, ddof=1)) if len(residuals) >= 2 else (float(abs(residuals[0])) if residuals else 0.0)
-    return list(reversed(per_week)), residual_std
+    for t, f in zip(targets, forecasts):
+        a = float(series.values[t])
+        per_week.append((series.week_start(t), a, float(f), a - float(f)))
+    return per_week, residual_std([r for (_,_,_,r) in per_week])
 
 def write_batch_run_start(conn, job_type: str) -> uuid.UUID:
     run_id = uuid.uuid4()
@@ -137,39 +118,182 @@ def insert_forecasts(conn, run_id: uuid.UUID, sku_id: str, loc_id: str, horizon_
         psycopg2.extras.execute_values(cur, sql, rows, page_size=10000)
     conn.commit()
 
+def accuracy_arrays(actual: np.ndarray, forecast: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Per-week WAPE, sMAPE and bias exactly as insert_metrics computes them."""
+    residual = actual - forecast
+    safe_actual = np.where(actual != 0, actual, 1.0)
+    denom = np.abs(actual) + np.abs(forecast)
+    wape = np.abs(residual) / safe_actual
+    smape = (2.0 * np.abs(residual)) / np.where(denom != 0, denom, 1.0)
+    bias = (forecast - actual) / safe_actual
+    return wape, smape, bias
+
+METRIC_COLUMNS = [
+    "run_id", "sku_id", "location_id", "week_start_date", "actual_units", "forecast_units",
+    "wape", "smape", "bias", "model_name", "model_stage",
+]
+FORECAST_COLUMNS = [
+    "run_id", "sku_id", "location_id", "horizon_week_start", "forecast_units",
+    "baseline_units", "residual_std", "model_name", "model_stage",
+]
+
+def load_panel(conn, keys: Optional[Sequence[Tuple[str,str]]] = None,
+               snapshot: Optional[Snapshot] = None,
+               latest_week: Optional[date] = None) -> Tuple[DemandPanel, int]:
+    """
+    Panel of all series (or just `keys`) and the week index of the latest week:
+    `latest_week` if given (weeks after it are cut), else the latest in curated.weekly_demand.
+    """
+    with stage("load_panel") as s:
+        if latest_week is None:
+            latest_week = fetch_latest_week(conn)
+        panel = DemandPanel.load(conn, keys, through=latest_week, snapshot=snapshot)
+        if len(panel):
+            panel = panel.weeks(0, panel.week_index(latest_week) + 1)
+        s.rows = int(panel.mask.sum())
+    return panel, (panel.week_index(latest_week) if len(panel) else 0)
+
+def baseline_rows(panel: DemandPanel, latest: int, H: int, run_id: uuid.UUID):
+    """
+    Backtest and forecast every series of the panel with array operations.
+    Returns lazy (metric_rows, forecast_rows) iterators in METRIC_COLUMNS /
+    FORECAST_COLUMNS order.
+    """
+    keys = panel.keys
+    targets, actual, forecast, valid, std_by_series = backtest_seasonal_naive(
+        panel.values, panel.mask, latest, BACKTEST_WEEKS
+    )
+    wape, smape, bias = accuracy_arrays(actual, forecast)
+    horizon = horizon_seasonal_naive(panel.values, panel.mask, latest, H)
+
+    target_weeks = [panel.week_start(t) for t in targets]
+    horizon_weeks = [panel.week_start(latest + h) for h in range(1, H + 1)]
+    run = str(run_id)
+
+    def metric_rows():
+        for i, j in zip(*np.nonzero(valid)):
+            sku_id, loc_id = keys[i]
+            yield (run, sku_id, loc_id, target_weeks[j], float(actual[i, j]), float(forecast[i, j]),
+                   float(wape[i, j]), float(smape[i, j]), float(bias[i, j]), 'seasonal_naive_v1', 'Production')
+
+    def forecast_rows():
+        for i, (sku_id, loc_id) in enumerate(keys):
+            std = float(std_by_series[i])
+            for h, week in enumerate(horizon_weeks):
+                f = float(horizon[i, h])
+                yield (run, sku_id, loc_id, week, f, f, std, 'seasonal_naive_v1', 'Production')
+
+    return metric_rows(), forecast_rows()
+
+def run_vectorized(conn, run_id: uuid.UUID, H: int, keys: Optional[Sequence[Tuple[str,str]]] = None,
+                   snapshot: Optional[Snapshot] = None, latest_week: Optional[date] = None) -> Tuple[int, int]:
+    """Backtest and forecast every series with array operations, then bulk-write. Returns (forecasts, metrics)."""
+    panel, latest = load_panel(conn, keys, snapshot, latest_week)
+    if not len(panel):
+        return 0, 0
+    with stage("compute") as s:
+        metric_rows, forecast_rows = baseline_rows(panel, latest, H, run_id)
+        s.rows = len(panel)
+    with stage("write_metrics") as s:
+        metrics_inserted = s.rows = copy_upsert(
+            conn, "ops.metrics_accuracy", METRIC_COLUMNS, metric_rows,
+            conflict_columns=["run_id", "sku_id", "location_id", "week_start_date"],
+            touch_columns=["recorded_at"],
+        )
+    with stage("write_forecasts") as s:
+        forecasts_inserted = s.rows = copy_upsert(
+            conn, "ops.forecast", FORECAST_COLUMNS, forecast_rows,
+            conflict_columns=["run_id", "sku_id", "location_id", "horizon_week_start"],
+            touch_columns=["generated_at"],
+        )
+    return forecasts_inserted, metrics_inserted
+
+def run_per_series(conn, run_id: uuid.UUID, H: int, keys: Optional[Sequence[Tuple[str,str]]] = None,
+                   snapshot: Optional[Snapshot] = None, latest_week: Optional[date] = None) -> Tuple[int, int]:
+    """Original per-series loop. Returns (forecasts, metrics)."""
+    panel, latest = load_panel(conn, keys, snapshot, latest_week)
+    forecasts_inserted = 0
+    metrics_inserted = 0
+
+    for series in panel:
+        sku_id, loc_id = series.key
+        with stage("compute") as s:
+            per_week_metrics, std = compute_backtest(series, latest)
+            horizon_rows: List[Tuple[date,float]] = []
+            for h in range(1, H+1):
+                f = seasonal_naive_forecast(series, latest + h)
+                horizon_rows.append((series.week_start(latest + h), max(0.0, f)))
+            s.rows = 1
+
+        with stage("write_metrics") as s:
+            insert_metrics(conn, run_id, sku_id, loc_id, per_week_metrics)
+            s.rows = len(per_week_metrics)
+        metrics_inserted += len(per_week_metrics)
+
+        with stage("write_forecasts") as s:
+            insert_forecasts(conn, run_id, sku_id, loc_id, horizon_rows, std)
+            s.rows = len(horizon_rows)
+        forecasts_inserted += len(horizon_rows)
+    return forecasts_inserted, metrics_inserted
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--horizon", type=int, default=H_DEFAULT, help="Forecast horizon in weeks (1..8)")
+    parser.add_argument("--engine", choices=["vectorized", "loop"], default="vectorized",
+                        help="vectorized: all series as one array + bulk COPY; loop: original per-series path")
+    add_work_queue_arguments(parser)
+    add_snapshot_arguments(parser)
+    add_instrument_arguments(parser)
     args = parser.parse_args()
     H = max(1, min(args.horizon, 8))
+    run = run_vectorized if args.engine == "vectorized" else run_per_series
 
-    with get_conn() as conn:
-        run_id = write_batch_run_start(conn, "batch_inference")
-        latest = fetch_latest_week(conn)
-        rows = fetch_weekly_demand(conn)
-        grouped = group_by_sku_loc(rows)
+    with get_conn(session=BULK_LOAD_SESSION) as conn, \
+            RunProfiler("batch_inference", profile=args.profile, trace_memory=args.trace_memory) as prof:
+        if args.mode == "coordinator":
+            latest_week = fetch_latest_week(conn)  # fails fast when curated.weekly_demand is empty
+            run_id = write_batch_run_start(conn, "batch_inference")
+            # Every worker forecasts from this latest week with this horizon, whenever it starts
+            save_run_config(conn, run_id, {'horizon': H, 'latest_week': latest_week.isoformat()})
+            n_items = create_work_items(conn, run_id, panel_keys(conn), args.batch_size)
+            print(f"Baseline run {run_id} created with {n_items} work items; start workers with --mode worker --run-id {run_id}")
+            return
 
-        forecasts_inserted = 0
-        metrics_inserted = 0
+        if args.mode == "worker":
+            run_id = args.run_id or find_open_run(conn, "batch_inference")
+            if run_id is None:
+                raise RuntimeError("No running batch_inference run with open work items")
+            worker_id = args.worker_id or default_worker_id()
+            config = load_run_config(conn, run_id)
+            H = config['horizon']
+            latest_week = date.fromisoformat(config['latest_week'])
 
-        for (sku_id, loc_id), ts in grouped.items():
-            ts_sorted = sorted(ts, key=lambda x: x[0])
-            per_week_metrics, residual_std = compute_backtest(ts_sorted, latest)
+            snapshot = open_snapshot(conn, args.snapshot_dir)
 
-            insert_metrics(conn, run_id, sku_id, loc_id, per_week_metrics)
-            metrics_inserted += len(per_week_metrics)
+            def handle(item, heartbeat):
+                forecasts, metrics = run(conn, run_id, H, keys=item.keys, snapshot=snapshot, latest_week=latest_week)
+                return f"forecasts={forecasts}, metrics={metrics}"
 
-            horizon_rows: List[Tuple[date,float]] = []
-            for h in range(1, H+1):
-                target = latest + timedelta(weeks=h)
-                f = seasonal_naive_forecast(ts_sorted, target)
-                horizon_rows.append((target, max(0.0, f)))
-            insert_forecasts(conn, run_id, sku_id, loc_id, horizon_rows, residual_std)
-            forecasts_inserted += len(horizon_rows)
+            stats = process_work_items(
+                conn, run_id, worker_id, handle, lease_seconds=args.lease_seconds,
+                poll_seconds=args.poll_seconds, max_attempts=args.max_attempts,
+            )
+            prof.save(conn, run_id, worker_id=worker_id)
+            notes = f"horizon={H}, backtest_weeks={BACKTEST_WEEKS}"
+            status = finish_run_if_complete(conn, run_id, notes=notes)
+            print(f"Baseline worker {worker_id} on run {run_id}: items done={stats['done']}, "
+                  f"failed={stats['failed']}, lost={stats['lost']}" + (f"; run {status}" if status else ""))
+            return
+
+        run_id = write_batch_run_start(conn, "batch_inference")
+        fetch_latest_week(conn)  # fails fast when curated.weekly_demand is empty
+        forecasts_inserted, metrics_inserted = run(conn, run_id, H, snapshot=open_snapshot(conn, args.snapshot_dir))
+        prof.save(conn, run_id)
 
         notes = f"Inserted forecasts={forecasts_inserted}, metrics={metrics_inserted}, horizon={H}, backtest_weeks={BACKTEST_WEEKS}"
         write_batch_run_finish(conn, run_id, status="succeeded", notes=notes)
         print(f"Baseline run {run_id} completed. {notes}")
+        print(prof.report())
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -3,11 +3,18 @@ MLflow-tracked training with ETS and ARIMA/SARIMA forecasting.
 Per SKU-location, fits seasonal naive, ETS, and ARIMA models, performs rolling backtest,
 selects best model by WAPE, logs to MLflow, and writes forecasts/metrics to database.
 """
-from datetime import date, timedelta
+from datetime import date
 import argparse
+import hashlib
 import uuid
 import os
-from typing import List, Tuple, Dict, Optional
+import multiprocessing
+import heapq
+from collections import deque
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, List, Tuple, Dict, Optional
 import warnings
 import numpy as np
 import pandas as pd
@@ -15,19 +22,66 @@ import psycopg2
 import psycopg2.extras
 import mlflow
 import mlflow.pyfunc
+import statsmodels
 from statsmodels.tsa.holtwinters import ExponentialSmoothing
 from statsmodels.tsa.statespace.sarimax import SARIMAX
 import matplotlib
 matplotlib.use('Agg')  # Non-interactive backend
 import matplotlib.pyplot as plt
-from jobs.utils.db import get_conn
+from jobs.utils.db import get_conn, register_statement, execute_prepared
+import jobs.global_model
+import jobs.hierarchy
+import jobs.panel
+from jobs.panel import (
+    DemandPanel, PanelSeries, panel_keys, seasonal_naive, backtest_origins, horizon_seasonal_naive, residual_std,
+)
+from jobs.utils.model_cache import ModelCache, content_hash
+from jobs.global_model import MODEL_NAME as GLOBAL_MODEL_NAME, TRAIN_WEEKS as GLOBAL_TRAIN_WEEKS, global_forecasts
+from jobs.hierarchy import (
+    MODEL_NAME as HIERARCHICAL_MODEL_NAME, PROPORTION_SOURCES, RECONCILE_METHODS, TOTAL_KEY, Hierarchy,
+    compare_runs, fetch_baseline_run, format_comparison, hierarchical_forecasts, load_categories,
+)
+from jobs.utils.mlflow_batch import AsyncRunLogger
+from jobs.utils.instrument import RunProfiler, stage, iterate, add_instrument_arguments
+from jobs.utils.snapshot import add_snapshot_arguments, open_snapshot
+from jobs.utils.checkpoint import (
+    RunHeartbeat, add_checkpoint_arguments, checkpointed_keys, find_resumable_run, mark_stale_runs,
+    load_run_config, reopen_run, save_run_config, write_checkpoint,
+)
+from jobs.utils.work_queue import (
+    add_work_queue_arguments, create_work_items, default_worker_id, find_open_run,
+    finish_run_if_complete, process_work_items,
+)
 
 # Constants
 H_DEFAULT = 4
 BACKTEST_WEEKS = 26
-FALLBACK_WINDOW = 8
 MIN_HISTORY = 52  # Minimum weeks of history for ETS/ARIMA
 SARIMA_MAX_ITER = 50  # Maximum iterations for SARIMA fitting
+MODEL_KEYS = ('seasonal_naive', 'ets', 'sarima', 'global_gbm', 'hierarchical')
+RACE_ORIGINS = 4  # origins per racing round
+RACE_CONFIDENCE = 2.0  # standard errors of excess error before a model is pruned
+RACE_MIN_TARGETS = 3  # paired targets needed before a model can be pruned
+SERIES_TABLE_ARTIFACT = "series_results.json"  # per-series selections in batched MLflow mode
+# Options that shape a run's results: stored with the run and reapplied by --resume
+# and by the workers of a coordinated run
+RESUME_OPTIONS = (
+    'horizon', 'backtest_mode', 'refit_every', 'selection', 'race_origins', 'race_confidence', 'check_agreement',
+    'global_model', 'global_train_weeks', 'hierarchical', 'hier_proportions', 'hier_reconcile',
+)
+
+# Cached fits are only reused by the exact code that produced them: this module, the
+# modules it trains through and the statsmodels release that fits ETS/SARIMA
+def _code_version() -> str:
+    digest = hashlib.sha256()
+    for module in (__file__, jobs.panel.__file__, jobs.global_model.__file__, jobs.hierarchy.__file__):
+        with open(module, 'rb') as src:
+            digest.update(src.read())
+    digest.update(statsmodels.__version__.encode())
+    return digest.hexdigest()[:16]
+
+
+CODE_VERSION = _code_version()
 
 # Suppress specific statsmodels convergence warnings
 warnings.filterwarnings('ignore', category=Warning, module='statsmodels')
@@ -43,41 +97,12 @@ def fetch_latest_week(conn) -> date:
         return row[0]
 
 
-def fetch_weekly_demand(conn) -> List[Tuple[str, str, date, int]]:
-    """Fetch all weekly demand data."""
-    sql = """
-      SELECT sku_id, location_id, week_start_date, units_sold
-      FROM curated.weekly_demand
-      ORDER BY sku_id, location_id, week_start_date
-    """
-    with conn.cursor() as cur:
-        cur.execute(sql)
-        return cur.fetchall()
-
-
-def group_by_sku_loc(rows: List[Tuple[str, str, date, int]]) -> Dict[Tuple[str,str], List[Tuple[date,int]]]:
-    """Group time series by (sku_id, location_id)."""
-    data: Dict[Tuple[str,str], List[Tuple[date,int]]] = {}
-    for sku_id, loc_id, ws, units in rows:
-        data.setdefault((sku_id, loc_id), []).append((ws, units))
-    return data
-
-
-def seasonal_naive_forecast(ts: List[Tuple[date,int]], target_week: date) -> float:
-    """Seasonal naive forecast: uses value from 52 weeks ago, or recent average if unavailable."""
-    ref_week = target_week - timedelta(weeks=52)
-    values = {w:u for (w,u) in ts}
-    if ref_week in values:
-        return float(values[ref_week])
-    prior_weeks = [w for (w,_) in ts if w < target_week]
-    prior_weeks.sort()
-    recent = prior_weeks[-FALLBACK_WINDOW:] if len(prior_weeks) >= FALLBACK_WINDOW else prior_weeks
-    avg = np.mean([values[w] for w in recent]) if recent else 0.0
-    return float(max(avg, 0.0))
-
-
-def fit_ets(series: pd.Series, seasonal_periods: int = 52) -> Optional[ExponentialSmoothing]:
-    """Fit ETS model (Exponential Smoothing) with additive seasonality."""
+def fit_ets(
+    series: pd.Series,
+    seasonal_periods: int = 52,
+    start_params: Optional[np.ndarray] = None
+) -> Optional[ExponentialSmoothing]:
+    """Fit ETS model (Exponential Smoothing) with additive seasonality, optionally warm-started."""
     try:
         if len(series) < seasonal_periods + 1:
             return None
@@ -88,14 +113,23 @@ def fit_ets(series: pd.Series, seasonal_periods: int = 52) -> Optional[Exponenti
             seasonal='add',
             damped_trend=True
         )
+        if start_params is not None:
+            try:
+                return model.fit(optimized=True, use_brute=False, start_params=start_params)
+            except Exception:
+                pass  # stale warm start; fall back to a cold fit
         fitted = model.fit(optimized=True, use_brute=False)
         return fitted
     except Exception:
         return None
 
 
-def fit_sarima(series: pd.Series, seasonal_periods: int = 52) -> Optional[SARIMAX]:
-    """Fit SARIMA model with simple order (1,0,0)x(1,0,0,52)."""
+def fit_sarima(
+    series: pd.Series,
+    seasonal_periods: int = 52,
+    start_params: Optional[np.ndarray] = None
+) -> Optional[SARIMAX]:
+    """Fit SARIMA model with simple order (1,0,0)x(1,0,0,52), optionally warm-started."""
     try:
         if len(series) < seasonal_periods + 2:
             return None
@@ -106,102 +140,288 @@ def fit_sarima(series: pd.Series, seasonal_periods: int = 52) -> Optional[SARIMA
             enforce_stationarity=False,
             enforce_invertibility=False
         )
+        if start_params is not None:
+            try:
+                return model.fit(disp=False, maxiter=SARIMA_MAX_ITER, start_params=start_params)
+            except Exception:
+                pass  # stale warm start; fall back to a cold fit
         fitted = model.fit(disp=False, maxiter=SARIMA_MAX_ITER)
         return fitted
     except Exception:
         return None
 
 
+def ets_start_params(fitted) -> np.ndarray:
+    """Fitted ETS parameters in the order ExponentialSmoothing.fit expects for start_params."""
+    p = fitted.params
+    return np.array([
+        p['smoothing_level'], p['smoothing_trend'], p['smoothing_seasonal'],
+        p['initial_level'], p['initial_trend'], p['damping_trend'],
+        *p['initial_seasons']
+    ])
+
+
+def sarima_start_params(fitted) -> np.ndarray:
+    """Fitted SARIMA parameters, usable as start_params for the same specification."""
+    return np.asarray(fitted.params)
+
+
+# Extracts warm-start parameters from a fitted model, per model function
+MODEL_START_PARAMS = {
+    fit_ets: ets_start_params,
+    fit_sarima: sarima_start_params,
+}
+
+
 def rolling_backtest_model(
-    ts_sorted: List[Tuple[date, int]],
-    latest_week: date,
+    series: PanelSeries,
+    latest: int,
     model_fn,
-    seasonal_periods: int = 52
+    seasonal_periods: int = 52,
+    start_params: Optional[np.ndarray] = None,
+    params_out: Optional[list] = None,
+    origins: Optional[np.ndarray] = None
 ) -> Tuple[List[Tuple[date, float, float, float]], float]:
     """
     Perform rolling-origin backtest for a given model function.
+    latest is the panel week index of the latest week.
     Returns list of (week, actual, forecast, residual) and residual_std.
+    start_params warm-starts every fit; if params_out is a list, the warm-start
+    parameters of each successful fit are appended to it.
+    origins restricts the backtest to a subset of its origin week indices.
     """
-    if not ts_sorted:
+    if not len(series):
         return [], 0.0
     
-    values_dict = {w: u for (w, u) in ts_sorted}
-    weeks = sorted([w for (w, _) in ts_sorted])
+    full_series = series.to_pandas()
+    n_observed = np.cumsum(series.mask)  # observed weeks up to and including each week index
     per_week = []
     
-    # Compute cutoff for backtest period (last BACKTEST_WEEKS)
-    cutoff = latest_week - timedelta(weeks=BACKTEST_WEEKS)
-    
-    for w in weeks:
-        if w >= cutoff and w < latest_week:
-            target = w + timedelta(weeks=1)
-            if target in values_dict:
-                # Train on data up to w
-                train_ts = [(wk, val) for (wk, val) in ts_sorted if wk <= w]
-                if len(train_ts) < seasonal_periods:
-                    continue
-                
-                # Create series
-                train_series = pd.Series(
-                    [val for (_, val) in train_ts],
-                    index=pd.to_datetime([wk for (wk, _) in train_ts])
-                )
-                
-                # Fit model and forecast 1 step
-                try:
-                    fitted = model_fn(train_series, seasonal_periods)
-                    if fitted is None:
-                        continue
-                    forecast = fitted.forecast(steps=1)
-                    if isinstance(forecast, pd.Series):
-                        f = float(forecast.iloc[0])
-                    else:
-                        f = float(forecast)
-                    f = max(0.0, f)
-                except Exception:
-                    continue
-                
-                a = float(values_dict[target])
-                residual = a - f
-                per_week.append((target, a, f, residual))
+    if origins is None:
+        origins = backtest_origins(series.mask, latest, BACKTEST_WEEKS)
+    for w in origins:
+        # Train on data up to w
+        k = int(n_observed[w])
+        if k < seasonal_periods:
+            continue
+        
+        # Fit model and forecast 1 step
+        try:
+            fitted = model_fn(full_series.iloc[:k], seasonal_periods, start_params)
+            if fitted is None:
+                continue
+            if params_out is not None:
+                params_out.append(MODEL_START_PARAMS[model_fn](fitted))
+            forecast = fitted.forecast(steps=1)
+            if isinstance(forecast, pd.Series):
+                f = float(forecast.iloc[0])
+            else:
+                f = float(forecast)
+            f = max(0.0, f)
+        except Exception:
+            continue
+        
+        a = float(series.values[w + 1])
+        per_week.append((series.week_start(w + 1), a, f, a - f))
     
-    residuals = [r for (_, _, _, r) in per_week]
-    residual_std = float(np.std(residuals, ddof=1)) if len(residuals) >= 2 else (
-        float(abs(residuals[0])) if residuals else 0.0
+    return per_week, residual_std([r for (_, _, _, r) in per_week])
+
+
+def filter_ets(fitted, series: pd.Series) -> np.ndarray:
+    """One-step-ahead predictions over `series` with a fitted ETS model's parameters and initial states held fixed."""
+    params = fitted.params
+    model = ExponentialSmoothing(
+        series,
+        seasonal_periods=fitted.model.seasonal_periods,
+        trend='add',
+        seasonal='add',
+        damped_trend=True,
+        initialization_method='known',
+        initial_level=params['initial_level'],
+        initial_trend=params['initial_trend'],
+        initial_seasonal=params['initial_seasons']
+    )
+    filtered = model.fit(
+        smoothing_level=params['smoothing_level'],
+        smoothing_trend=params['smoothing_trend'],
+        smoothing_seasonal=params['smoothing_seasonal'],
+        damping_trend=params['damping_trend'],
+        optimized=False
     )
-    return per_week, residual_std
+    return np.asarray(filtered.fittedvalues)
+
+
+def filter_sarima(fitted, series: pd.Series) -> np.ndarray:
+    """One-step-ahead predictions over `series` from a Kalman filter pass with fixed SARIMA parameters."""
+    return np.asarray(fitted.apply(series).fittedvalues)
+
+
+# (model key, fit function, model name) of the refittable candidates, in selection order
+MODEL_FITS = (
+    ('ets', fit_ets, 'ets_additive_v1'),
+    ('sarima', fit_sarima, 'arima_sarima_v1'),
+)
+
+# Fixed-parameter filter for each refittable model, used by the filter backtest mode
+MODEL_FILTERS = {
+    fit_ets: filter_ets,
+    fit_sarima: filter_sarima,
+}
+
+
+def rolling_backtest_model_filtered(
+    series: PanelSeries,
+    latest: int,
+    model_fn,
+    seasonal_periods: int = 52,
+    refit_every: int = 0,
+    start_params: Optional[np.ndarray] = None,
+    params_out: Optional[list] = None
+) -> Tuple[List[Tuple[date, float, float, float]], float]:
+    """
+    Refit-free variant of rolling_backtest_model over the same origins.
+    Parameters are estimated once on data up to the first backtest origin
+    (and again every `refit_every` origins if > 0); the one-step-ahead
+    forecasts for the following origins come from filtering the history with
+    those parameters fixed instead of re-optimising at every origin.
+    start_params / params_out behave as in rolling_backtest_model.
+    """
+    if not len(series):
+        return [], 0.0
+
+    n_observed = np.cumsum(series.mask)
+    # (position of the origin among observed weeks, origin week index); the target is always the next observation
+    origins = [
+        (int(n_observed[w]) - 1, int(w))
+        for w in backtest_origins(series.mask, latest, BACKTEST_WEEKS)
+        if n_observed[w] >= seasonal_periods
+    ]
+    full_series = series.to_pandas()
+    filter_fn = MODEL_FILTERS[model_fn]
+    step = refit_every if refit_every > 0 else len(origins)
+    per_week = []
+
+    for start in range(0, len(origins), step):
+        segment = origins[start:start + step]
+        # Estimate at the segment's first origin where the fit succeeds; the origins
+        # before it fail in refit mode too (same data, same start), so only they are skipped
+        fitted = None
+        for i, (pos, _) in enumerate(segment):
+            try:
+                fitted = model_fn(full_series.iloc[:pos + 1], seasonal_periods, start_params)
+            except Exception:
+                fitted = None
+            if fitted is not None:
+                segment = segment[i:]
+                break
+        if fitted is None:
+            continue
+
+        # Filter through the segment's last target, or refit at each of its origins if that fails
+        try:
+            predictions = filter_fn(fitted, full_series.iloc[:segment[-1][0] + 2])
+        except Exception:
+            refitted, _ = rolling_backtest_model(
+                series, latest, model_fn, seasonal_periods, start_params, params_out,
+                origins=np.array([w for _, w in segment])
+            )
+            per_week.extend(refitted)
+            continue
+        if params_out is not None:
+            params_out.append(MODEL_START_PARAMS[model_fn](fitted))
+
+        for pos, w in segment:
+            f = max(0.0, float(predictions[pos + 1]))
+            a = float(series.values[w + 1])
+            per_week.append((series.week_start(w + 1), a, f, a - f))
+
+    return per_week, residual_std([r for (_, _, _, r) in per_week])
 
 
 def rolling_backtest_seasonal_naive(
-    ts_sorted: List[Tuple[date, int]],
-    latest_week: date
+    series: PanelSeries,
+    latest: int
 ) -> Tuple[List[Tuple[date, float, float, float]], float]:
-    """Perform rolling backtest for seasonal naive."""
-    if not ts_sorted:
+    """Perform rolling backtest for seasonal naive (all origins in one array pass)."""
+    targets = backtest_origins(series.mask, latest, BACKTEST_WEEKS) + 1
+    if not len(targets):
         return [], 0.0
-    
-    values_dict = {w: u for (w, u) in ts_sorted}
-    weeks = sorted([w for (w, _) in ts_sorted])
+    forecasts = seasonal_naive(series.values[None], series.mask[None], targets)[0]
     per_week = []
-    
-    cutoff = latest_week - timedelta(weeks=BACKTEST_WEEKS)
-    
-    for w in weeks:
-        if w >= cutoff and w < latest_week:
-            target = w + timedelta(weeks=1)
-            if target in values_dict:
-                # Train on data up to w
-                train_ts = [(wk, val) for (wk, val) in ts_sorted if wk <= w]
-                f = seasonal_naive_forecast(train_ts, target)
-                a = float(values_dict[target])
-                residual = a - f
-                per_week.append((target, a, f, residual))
-    
-    residuals = [r for (_, _, _, r) in per_week]
-    residual_std = float(np.std(residuals, ddof=1)) if len(residuals) >= 2 else (
-        float(abs(residuals[0])) if residuals else 0.0
-    )
-    return per_week, residual_std
+    for t, f in zip(targets, forecasts):
+        a = float(series.values[t])
+        per_week.append((series.week_start(t), a, float(f), a - float(f)))
+    return per_week, residual_std([r for (_, _, _, r) in per_week])
+
+
+def race_backtest(
+    series: PanelSeries,
+    latest: int,
+    baseline: List[Tuple[date, float, float, float]],
+    start_params: Dict[str, np.ndarray],
+    params_out: Dict[str, list],
+    race_origins: int = RACE_ORIGINS,
+    confidence: float = RACE_CONFIDENCE
+) -> Tuple[Dict[str, Tuple[List[Tuple[date, float, float, float]], float]], Dict[str, Dict]]:
+    """
+    Racing variant of the ETS/SARIMA rolling backtests (refit mode).
+    Origins are evaluated newest first in rounds of `race_origins`. After each
+    round the model with the lowest mean absolute error so far (seasonal naive,
+    `baseline`, included) leads; any other model whose paired per-target
+    absolute errors exceed the leader's by more than `confidence` standard
+    errors is pruned and never fitted on its remaining origins. Survivors
+    finish every origin, so their per_week rows match the exhaustive backtest.
+    Returns ({surviving model key: (per_week, residual_std)}, {pruned model key: pruning record}).
+    """
+    n_observed = np.cumsum(series.mask)
+    origins = [w for w in backtest_origins(series.mask, latest, BACKTEST_WEEKS) if n_observed[w] >= 52][::-1]
+    abs_errors = {'seasonal_naive': {week: abs(r) for week, _, _, r in baseline}}
+    per_week: Dict[str, list] = {}
+    for key, _, _ in MODEL_FITS:
+        abs_errors[key] = {}
+        per_week[key] = []
+    pruned: Dict[str, Dict] = {}
+
+    for start in range(0, len(origins), max(1, race_origins)):
+        batch = np.array(origins[start:start + max(1, race_origins)], dtype=np.int64)
+        for key, model_fn, _ in MODEL_FITS:
+            if key in pruned:
+                continue
+            rows, _ = rolling_backtest_model(
+                series, latest, model_fn, seasonal_periods=52,
+                start_params=start_params.get(key), params_out=params_out[key], origins=batch
+            )
+            per_week[key].extend(rows)
+            abs_errors[key].update((week, abs(r)) for week, _, _, r in rows)
+
+        alive = [key for key in abs_errors if key not in pruned and abs_errors[key]]
+        leader = min(alive, key=lambda k: sum(abs_errors[k].values()) / len(abs_errors[k]))
+        for key in alive:
+            if key in (leader, 'seasonal_naive'):
+                continue
+            common = sorted(abs_errors[key].keys() & abs_errors[leader].keys())
+            if len(common) < RACE_MIN_TARGETS:
+                continue
+            gap = np.array([abs_errors[key][w] - abs_errors[leader][w] for w in common])
+            mean = float(gap.mean())
+            se = float(gap.std(ddof=1)) / np.sqrt(len(gap))
+            if mean > 0 and mean > confidence * se:
+                pruned[key] = {
+                    'after_origins': start + len(batch),
+                    'of_origins': len(origins),
+                    'leader': leader,
+                    'mean_gap': mean,
+                    'z': mean / se if se > 0 else float('inf'),
+                }
+        if all(key in pruned for key, _, _ in MODEL_FITS):
+            break
+
+    survivors = {}
+    for key, rows in per_week.items():
+        if key not in pruned and rows:
+            rows.sort()
+            survivors[key] = (rows, residual_std([r for (_, _, _, r) in rows]))
+    return survivors, pruned
 
 
 def compute_metrics(per_week: List[Tuple[date, float, float, float]]) -> Dict[str, float]:
@@ -228,28 +448,26 @@ def compute_metrics(per_week: List[Tuple[date, float, float, float]]) -> Dict[st
 
 
 def generate_forecast_horizon(
-    ts_sorted: List[Tuple[date, int]],
-    latest_week: date,
+    series: PanelSeries,
+    latest: int,
     horizon: int,
     model_fn,
-    seasonal_periods: int = 52
+    seasonal_periods: int = 52,
+    start_params: Optional[np.ndarray] = None,
+    params_out: Optional[list] = None
 ) -> List[Tuple[date, float]]:
-    """Generate H-week ahead forecasts using fitted model."""
-    if not ts_sorted:
+    """Generate H-week ahead forecasts using fitted model (warm-started / reported as in rolling_backtest_model)."""
+    if not len(series):
         return []
     
-    # Train on full history
-    train_series = pd.Series(
-        [val for (_, val) in ts_sorted],
-        index=pd.to_datetime([wk for (wk, _) in ts_sorted])
-    )
-    
     try:
-        fitted = model_fn(train_series, seasonal_periods)
+        # Train on full history
+        fitted = model_fn(series.to_pandas(), seasonal_periods, start_params)
         if fitted is None:
             # Fallback to seasonal naive
-            return [(latest_week + timedelta(weeks=h), seasonal_naive_forecast(ts_sorted, latest_week + timedelta(weeks=h))) 
-                    for h in range(1, horizon+1)]
+            return generate_forecast_horizon_seasonal_naive(series, latest, horizon)
+        if params_out is not None:
+            params_out.append(MODEL_START_PARAMS[model_fn](fitted))
         
         forecast = fitted.forecast(steps=horizon)
         if isinstance(forecast, pd.Series):
@@ -257,22 +475,21 @@ def generate_forecast_horizon(
         else:
             forecast_vals = [forecast] if horizon == 1 else list(forecast)
         
-        return [(latest_week + timedelta(weeks=h), max(0.0, float(forecast_vals[h-1]))) 
+        return [(series.week_start(latest + h), max(0.0, float(forecast_vals[h-1]))) 
                 for h in range(1, horizon+1)]
     except Exception:
         # Fallback to seasonal naive
-        return [(latest_week + timedelta(weeks=h), seasonal_naive_forecast(ts_sorted, latest_week + timedelta(weeks=h))) 
-                for h in range(1, horizon+1)]
+        return generate_forecast_horizon_seasonal_naive(series, latest, horizon)
 
 
 def generate_forecast_horizon_seasonal_naive(
-    ts_sorted: List[Tuple[date, int]],
-    latest_week: date,
+    series: PanelSeries,
+    latest: int,
     horizon: int
 ) -> List[Tuple[date, float]]:
     """Generate H-week ahead forecasts using seasonal naive."""
-    return [(latest_week + timedelta(weeks=h), seasonal_naive_forecast(ts_sorted, latest_week + timedelta(weeks=h))) 
-            for h in range(1, horizon+1)]
+    forecasts = horizon_seasonal_naive(series.values[None], series.mask[None], latest, horizon)[0]
+    return [(series.week_start(latest + h), float(forecasts[h-1])) for h in range(1, horizon+1)]
 
 
 def plot_backtest_results(per_week: List[Tuple[date, float, float, float]], title: str) -> Optional[str]:
@@ -295,7 +512,6 @@ def plot_backtest_results(per_week: List[Tuple[date, float, float, float]], titl
     plt.tight_layout()
     
     # Save to temp file
-    import tempfile
     fd, path = tempfile.mkstemp(suffix='.png')
     plt.savefig(path)
     plt.close()
@@ -303,6 +519,71 @@ def plot_backtest_results(per_week: List[Tuple[date, float, float, float]], titl
     return path
 
 
+def parse_plot_spec(spec: str) -> Tuple[str, float]:
+    """Parse --plots: 'all', 'off', 'sample:N' (N percent of series) or 'worst:K' (K highest-WAPE series)."""
+    kind, _, value = spec.partition(':')
+    if kind in ('all', 'off') and not value:
+        return kind, 0.0
+    if kind in ('sample', 'worst') and value.replace('.', '', 1).isdigit():
+        n = float(value)
+        if kind == 'sample' or n.is_integer():
+            return kind, n
+    raise ValueError(f"invalid plot spec {spec!r} (expected all, off, sample:N or worst:K)")
+
+
+class PlotSelector:
+    """Decides which series get a backtest plot under a parsed --plots spec."""
+
+    def __init__(self, spec: Tuple[str, float]):
+        self.kind, self.value = spec
+        self._worst: List[Tuple[float, int, tuple]] = []  # min-heap of the K worst so far
+        self._seen = 0
+
+    def wants_now(self, sku_id: str, loc_id: str) -> bool:
+        """True if the series should be plotted as soon as it is trained."""
+        if self.kind == 'all':
+            return True
+        if self.kind == 'sample':
+            # Hash-based so the same series are sampled on every run
+            bucket = int(hashlib.sha1(f"{sku_id}|{loc_id}".encode()).hexdigest()[:8], 16) % 10000
+            return bucket < self.value * 100
+        return False
+
+    def offer(self, wape: float, item: tuple):
+        """Track a candidate for worst-K selection."""
+        if self.kind != 'worst' or self.value < 1:
+            return
+        self._seen += 1
+        entry = (wape, self._seen, item)
+        if len(self._worst) < self.value:
+            heapq.heappush(self._worst, entry)
+        elif wape > self._worst[0][0]:
+            heapq.heapreplace(self._worst, entry)
+
+    def worst(self) -> List[tuple]:
+        """Items of the K highest-WAPE series, worst first."""
+        return [item for _, _, item in sorted(self._worst, reverse=True)]
+
+
+def log_backtest_plot(client, mlflow_run_id: str, per_week, sku_id: str, loc_id: str, model_key: str):
+    """Render a backtest plot and upload it as plots/<sku>_<loc>.png to an MLflow run."""
+    plot_path = plot_backtest_results(per_week, f"Backtest: {sku_id} {loc_id} ({model_key})")
+    if not plot_path:
+        return
+    tmpdir = tempfile.mkdtemp()
+    try:
+        named = os.path.join(tmpdir, f"{sku_id}_{loc_id}.png")
+        shutil.move(plot_path, named)
+        client.log_artifact(mlflow_run_id, named, "plots")
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def log_series_table(client, mlflow_run_id: str, rows: List[Dict]):
+    """Upload per-series results as a table artifact (readable with mlflow.load_table)."""
+    client.log_table(mlflow_run_id, data=pd.DataFrame(rows), artifact_file=SERIES_TABLE_ARTIFACT)
+
+
 def write_batch_run_start(conn, job_type: str) -> uuid.UUID:
     """Start a batch run in ops.batch_run."""
     run_id = uuid.uuid4()
@@ -326,6 +607,40 @@ def write_batch_run_finish(conn, run_id: uuid.UUID, status: str = 'succeeded', n
     conn.commit()
 
 
+INSERT_METRICS = register_statement("train_ml_insert_metrics", """
+  INSERT INTO ops.metrics_accuracy (
+    run_id, sku_id, location_id, week_start_date, actual_units, forecast_units, wape, smape, bias, model_name, model_stage
+  )
+  SELECT $1::uuid, $2::text, $3::text, w.week, w.actual, w.forecast, w.wape, w.smape, w.bias, $10::text, $11::text
+  FROM unnest($4::date[], $5::numeric[], $6::numeric[], $7::numeric[], $8::numeric[], $9::numeric[])
+       AS w(week, actual, forecast, wape, smape, bias)
+  ON CONFLICT (run_id, sku_id, location_id, week_start_date) DO UPDATE SET
+    actual_units = EXCLUDED.actual_units,
+    forecast_units = EXCLUDED.forecast_units,
+    wape = EXCLUDED.wape,
+    smape = EXCLUDED.smape,
+    bias = EXCLUDED.bias,
+    model_name = EXCLUDED.model_name,
+    model_stage = EXCLUDED.model_stage,
+    recorded_at = NOW()
+""")
+
+INSERT_FORECASTS = register_statement("train_ml_insert_forecasts", """
+  INSERT INTO ops.forecast (
+    run_id, sku_id, location_id, horizon_week_start, forecast_units, baseline_units, residual_std, model_name, model_stage
+  )
+  SELECT $1::uuid, $2::text, $3::text, h.week, h.units, h.units, $6::numeric, $7::text, $8::text
+  FROM unnest($4::date[], $5::numeric[]) AS h(week, units)
+  ON CONFLICT (run_id, sku_id, location_id, horizon_week_start) DO UPDATE SET
+    forecast_units = EXCLUDED.forecast_units,
+    baseline_units = EXCLUDED.baseline_units,
+    residual_std = EXCLUDED.residual_std,
+    model_name = EXCLUDED.model_name,
+    model_stage = EXCLUDED.model_stage,
+    generated_at = NOW()
+""")
+
+
 def insert_metrics(
     conn,
     run_id: uuid.UUID,
@@ -335,35 +650,23 @@ def insert_metrics(
     model_name: str,
     model_stage: str = 'Production'
 ):
-    """Write per-week backtest metrics to ops.metrics_accuracy."""
-    rows = []
+    """Write per-week backtest metrics to ops.metrics_accuracy (one prepared, array-valued statement)."""
+    weeks, actuals, forecasts, wapes, smapes, biases = [], [], [], [], [], []
     for week, actual, forecast, residual in per_week_metrics:
-        wape = float(abs(residual) / (actual if actual != 0 else 1.0))
+        weeks.append(week)
+        actuals.append(actual)
+        forecasts.append(forecast)
+        wapes.append(float(abs(residual) / (actual if actual != 0 else 1.0)))
         denom = (abs(actual) + abs(forecast))
-        smape = float((2.0 * abs(residual)) / (denom if denom != 0 else 1.0))
-        bias = float((forecast - actual) / (actual if actual != 0 else 1.0))
-        rows.append((
-            str(run_id), sku_id, loc_id, week, actual, forecast, wape, smape, bias, model_name, model_stage
-        ))
-    if not rows:
+        smapes.append(float((2.0 * abs(residual)) / (denom if denom != 0 else 1.0)))
+        biases.append(float((forecast - actual) / (actual if actual != 0 else 1.0)))
+    if not weeks:
         return
-    
-    sql = """
-      INSERT INTO ops.metrics_accuracy (
-        run_id, sku_id, location_id, week_start_date, actual_units, forecast_units, wape, smape, bias, model_name, model_stage
-      ) VALUES %s
-      ON CONFLICT (run_id, sku_id, location_id, week_start_date) DO UPDATE SET
-        actual_units = EXCLUDED.actual_units,
-        forecast_units = EXCLUDED.forecast_units,
-        wape = EXCLUDED.wape,
-        smape = EXCLUDED.smape,
-        bias = EXCLUDED.bias,
-        model_name = EXCLUDED.model_name,
-        model_stage = EXCLUDED.model_stage,
-        recorded_at = NOW()
-    """
+
     with conn.cursor() as cur:
-        psycopg2.extras.execute_values(cur, sql, rows, page_size=10000)
+        execute_prepared(cur, INSERT_METRICS, (
+            str(run_id), sku_id, loc_id, weeks, actuals, forecasts, wapes, smapes, biases, model_name, model_stage
+        ))
     conn.commit()
 
 
@@ -377,37 +680,449 @@ def insert_forecasts(
     model_name: str,
     model_stage: str = 'Production'
 ):
-    """Write horizon forecasts to ops.forecast."""
-    rows = []
-    for horizon_week, f in horizon_rows:
-        rows.append((
-            str(run_id), sku_id, loc_id, horizon_week, f, f, residual_std, model_name, model_stage
-        ))
-    if not rows:
+    """Write horizon forecasts to ops.forecast (one prepared, array-valued statement)."""
+    if not horizon_rows:
         return
-    
-    sql = """
-      INSERT INTO ops.forecast (
-        run_id, sku_id, location_id, horizon_week_start, forecast_units, baseline_units, residual_std, model_name, model_stage
-      ) VALUES %s
-      ON CONFLICT (run_id, sku_id, location_id, horizon_week_start) DO UPDATE SET
-        forecast_units = EXCLUDED.forecast_units,
-        baseline_units = EXCLUDED.baseline_units,
-        residual_std = EXCLUDED.residual_std,
-        model_name = EXCLUDED.model_name,
-        model_stage = EXCLUDED.model_stage,
-        generated_at = NOW()
-    """
+
     with conn.cursor() as cur:
-        psycopg2.extras.execute_values(cur, sql, rows, page_size=10000)
+        execute_prepared(cur, INSERT_FORECASTS, (
+            str(run_id), sku_id, loc_id,
+            [week for week, _ in horizon_rows], [f for _, f in horizon_rows],
+            residual_std, model_name, model_stage
+        ))
     conn.commit()
 
 
+def train_series(
+    series: PanelSeries,
+    latest: int,
+    H: int,
+    start_params: Optional[Dict[str, np.ndarray]] = None,
+    backtest_mode: str = 'refit',
+    refit_every: int = 0,
+    selection: str = 'exhaustive',
+    race_origins: int = RACE_ORIGINS,
+    race_confidence: float = RACE_CONFIDENCE,
+    check_agreement: bool = False,
+    global_forecast: Optional[Tuple[list, float, list]] = None,
+    hierarchical_forecast: Optional[Tuple[list, float, list]] = None,
+    local_models: bool = True
+) -> Dict:
+    """
+    Fit, backtest and select the best model for one SKU-location.
+    Pure computation (no DB or MLflow access) so it can run in a worker process.
+    latest is the panel week index of the latest week.
+    start_params: optional warm-start parameters per model key ('ets', 'sarima').
+    backtest_mode: 'refit' re-estimates ETS/SARIMA at every origin,
+                   'filter' estimates once (or every `refit_every` origins) and filters.
+    selection: 'exhaustive' backtests every model on every origin, 'racing'
+               prunes clearly worse ETS/SARIMA early (see race_backtest; refit mode only).
+    check_agreement: with racing or the filter mode, also run the exhaustive
+               refit selection and record it under 'exhaustive' for comparison
+               (doubles the work); in filter mode 'target_mismatches' lists the
+               models whose backtest target weeks differ from refitting's.
+    global_forecast: this series' (per_week, residual_std, horizon_rows) from
+               the global model (jobs.global_model), entered as candidate 'global_gbm'.
+    hierarchical_forecast: this series' forecasts disaggregated from the
+               category x location / total fits (jobs.hierarchy), candidate 'hierarchical'.
+    local_models: False skips the series' own ETS/SARIMA fits (hierarchical mode).
+    The result's 'params' holds the latest fitted parameters per model key.
+    """
+    sku_id, loc_id = series.key
+    start_params = start_params or {}
+    models_results = {}
+    errors = {}
+    fitted_params: Dict[str, list] = {'ets': [], 'sarima': []}
+
+    # 1. Seasonal Naive
+    per_week_sn, residual_std_sn = rolling_backtest_seasonal_naive(series, latest)
+    models_results['seasonal_naive'] = {
+        'per_week': per_week_sn,
+        'residual_std': residual_std_sn,
+        'metrics': compute_metrics(per_week_sn),
+        'model_name': 'seasonal_naive_v1'
+    }
+
+    # 2. ETS and 3. SARIMA (if sufficient history)
+    pruned = {}
+    if local_models and len(series) >= MIN_HISTORY and selection == 'racing':
+        survivors, pruned = race_backtest(
+            series, latest, per_week_sn, start_params, fitted_params,
+            race_origins=race_origins, confidence=race_confidence
+        )
+        for key, _, model_name in MODEL_FITS:
+            if key in survivors:
+                per_week, residual_std = survivors[key]
+                models_results[key] = {
+                    'per_week': per_week,
+                    'residual_std': residual_std,
+                    'metrics': compute_metrics(per_week),
+                    'model_name': model_name
+                }
+    elif local_models and len(series) >= MIN_HISTORY:
+        for key, model_fn, model_name in MODEL_FITS:
+            try:
+                if backtest_mode == 'filter':
+                    per_week, residual_std = rolling_backtest_model_filtered(
+                        series, latest, model_fn, seasonal_periods=52, refit_every=refit_every,
+                        start_params=start_params.get(key), params_out=fitted_params[key]
+                    )
+                else:
+                    per_week, residual_std = rolling_backtest_model(
+                        series, latest, model_fn, seasonal_periods=52,
+                        start_params=start_params.get(key), params_out=fitted_params[key]
+                    )
+                if per_week:
+                    models_results[key] = {
+                        'per_week': per_week,
+                        'residual_std': residual_std,
+                        'metrics': compute_metrics(per_week),
+                        'model_name': model_name
+                    }
+            except Exception as e:
+                errors[key] = str(e)[:200]
+
+    # 4. Global model: fitted once across all series, its predictions are passed in
+    if global_forecast is not None and global_forecast[0]:
+        models_results['global_gbm'] = {
+            'per_week': global_forecast[0],
+            'residual_std': global_forecast[1],
+            'metrics': compute_metrics(global_forecast[0]),
+            'model_name': GLOBAL_MODEL_NAME
+        }
+
+    # 5. Hierarchical: disaggregated from the category x location / total fits
+    if hierarchical_forecast is not None and hierarchical_forecast[0]:
+        models_results['hierarchical'] = {
+            'per_week': hierarchical_forecast[0],
+            'residual_std': hierarchical_forecast[1],
+            'metrics': compute_metrics(hierarchical_forecast[0]),
+            'model_name': HIERARCHICAL_MODEL_NAME
+        }
+
+    backtest_fits = sum(len(params) for params in fitted_params.values())
+
+    # Model selection: lowest WAPE, tie-break by sMAPE
+    best_model_key = None
+    best_wape = float('inf')
+    best_smape = float('inf')
+
+    for key, result in models_results.items():
+        wape = result['metrics']['wape']
+        smape = result['metrics']['smape']
+        if wape < best_wape or (wape == best_wape and smape < best_smape):
+            best_wape = wape
+            best_smape = smape
+            best_model_key = key
+
+    if best_model_key is None:
+        best_model_key = 'seasonal_naive'
+
+    # Generate horizon forecasts using selected model
+    if best_model_key == 'ets':
+        horizon_rows = generate_forecast_horizon(
+            series, latest, H, fit_ets,
+            start_params=start_params.get('ets'), params_out=fitted_params['ets']
+        )
+    elif best_model_key == 'sarima':
+        horizon_rows = generate_forecast_horizon(
+            series, latest, H, fit_sarima,
+            start_params=start_params.get('sarima'), params_out=fitted_params['sarima']
+        )
+    elif best_model_key == 'global_gbm':
+        horizon_rows = global_forecast[2]
+    elif best_model_key == 'hierarchical':
+        horizon_rows = hierarchical_forecast[2]
+    else:
+        horizon_rows = generate_forecast_horizon_seasonal_naive(series, latest, H)
+
+    exhaustive = None
+    if check_agreement and (selection == 'racing' or backtest_mode == 'filter'):
+        reference = train_series(
+            series, latest, H, start_params, 'refit', global_forecast=global_forecast,
+            hierarchical_forecast=hierarchical_forecast, local_models=local_models
+        )
+        exhaustive = {key: reference[key] for key in ('best_model_key', 'best_wape', 'backtest_fits')}
+        if selection == 'exhaustive':
+            # Filtering must backtest the same target weeks as refitting
+            exhaustive['target_mismatches'] = [
+                key for key, _, _ in MODEL_FITS
+                if [row[0] for row in models_results.get(key, {}).get('per_week', [])]
+                != [row[0] for row in reference['models_results'].get(key, {}).get('per_week', [])]
+            ]
+
+    return {
+        'sku_id': sku_id,
+        'loc_id': loc_id,
+        'history_length': len(series),
+        'backtest_mode': backtest_mode,
+        'models_results': models_results,
+        'errors': errors,
+        'best_model_key': best_model_key,
+        'best_wape': best_wape,
+        'best_smape': best_smape,
+        'horizon_rows': horizon_rows,
+        'selection': selection,
+        'pruned': pruned,
+        'backtest_fits': backtest_fits,
+        'exhaustive': exhaustive,
+        'params': {key: params[-1] for key, params in fitted_params.items() if params},
+        'warm_started': bool(start_params),
+        'cache_hit': False,
+    }
+
+
+def _train_series_task(
+    task: Tuple[PanelSeries, int, int, Optional[Dict], Optional[tuple], Optional[tuple]], **options
+) -> Dict:
+    """Process-pool entry point: unpack one task tuple and train the series."""
+    series, latest, H, start_params, global_forecast, hierarchical_forecast = task
+    return train_series(
+        series, latest, H, start_params, global_forecast=global_forecast,
+        hierarchical_forecast=hierarchical_forecast, **options
+    )
+
+
+def iter_series_results(
+    series: Iterable[PanelSeries],
+    latest: int,
+    H: int,
+    workers: int = 1,
+    cache: Optional[ModelCache] = None,
+    global_results: Optional[Dict] = None,
+    hierarchical_results: Optional[Dict] = None,
+    **options
+):
+    """
+    Yield train_series results for every series in `series` (e.g. a
+    DemandPanel), consuming it lazily.
+    With workers > 1, series are trained in a process pool with a bounded
+    number of series in flight, and results are streamed back (in submission
+    order) to the single DB writer.
+    With a cache, series whose history, latest week, options and code version
+    are unchanged are served from it without fitting; the rest are warm-started
+    from their last cached parameters and written back to the cache.
+    global_results maps series keys to their global model forecasts (see
+    jobs.global_model.global_forecasts), hierarchical_results to their
+    disaggregated forecasts (jobs.hierarchy.hierarchical_forecasts).
+    Extra keyword options are passed through to train_series.
+    """
+    option_items = tuple(sorted(options.items()))
+    entries: Dict[Tuple[str,str], tuple] = {}
+
+    def prepare(item: PanelSeries):
+        """Return (cached result, None) for a cache hit, else (None, train_series task)."""
+        warm = None
+        global_forecast = global_results.get(item.key) if global_results else None
+        hierarchical_forecast = hierarchical_results.get(item.key) if hierarchical_results else None
+        if cache is not None:
+            sku_id, loc_id = item.key
+            config = (CODE_VERSION, item.week_start(latest), H, option_items)
+            if global_forecast is not None:
+                config += (content_hash(global_forecast),)
+            if hierarchical_forecast is not None:
+                config += ('hierarchical', content_hash(hierarchical_forecast))
+            entry = ('series', sku_id, loc_id, item.fingerprint(), config)
+            cached = cache.get(*entry)
+            if cached is not None:
+                # Unchanged series: replay the stored result without fitting
+                return {**cached, 'cache_hit': True}, None
+            entries[item.key] = entry
+            warm = {
+                key: params for key in ('ets', 'sarima')
+                if (params := cache.get('params', sku_id, loc_id, key, CODE_VERSION, count=False)) is not None
+            }
+        return None, (item, latest, H, warm or None, global_forecast, hierarchical_forecast)
+
+    def store(result: Dict) -> Dict:
+        if cache is not None:
+            sku_id, loc_id = result['sku_id'], result['loc_id']
+            cache.put(result, *entries.pop((sku_id, loc_id)))
+            for key, params in result['params'].items():
+                cache.put(params, 'params', sku_id, loc_id, key, CODE_VERSION)
+        return result
+
+    if workers <= 1:
+        for item in series:
+            hit, task = prepare(item)
+            yield hit if hit is not None else store(_train_series_task(task, **options))
+        return
+
+    # One BLAS thread per worker so N workers actually use N cores
+    for var in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ.setdefault(var, "1")
+    max_in_flight = workers * 4
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as executor:
+        pending = deque()
+        for item in series:
+            hit, task = prepare(item)
+            if hit is not None:
+                yield hit
+                continue
+            pending.append(executor.submit(_train_series_task, task, **options))
+            if len(pending) >= max_in_flight:
+                yield store(pending.popleft().result())
+        while pending:
+            yield store(pending.popleft().result())
+
+
+def series_summary(result: Dict) -> Dict:
+    """Flat per-series row (selection plus every model's metrics) for the batched MLflow table."""
+    row = {
+        'sku_id': result['sku_id'],
+        'location_id': result['loc_id'],
+        'history_length': result['history_length'],
+        'selected_model': result['best_model_key'],
+        'selected_wape': result['best_wape'],
+        'selected_smape': result['best_smape'],
+    }
+    for key in MODEL_KEYS:
+        metrics = result['models_results'].get(key, {}).get('metrics', {})
+        for name in ('wape', 'smape', 'bias'):
+            row[f"{key}_{name}"] = metrics.get(name)
+        row[f"{key}_error"] = result['errors'].get(key)
+        row[f"{key}_pruned_after"] = result['pruned'].get(key, {}).get('after_origins')
+    row['backtest_fits'] = result['backtest_fits']
+    if result['exhaustive'] is not None:
+        row['exhaustive_model'] = result['exhaustive']['best_model_key']
+        row['exhaustive_wape'] = result['exhaustive']['best_wape']
+    row['cache_hit'] = result['cache_hit']
+    row['warm_started'] = result['warm_started']
+    return row
+
+
+def log_series_run(result: Dict, H: int, plot: bool = True) -> str:
+    """Log one series result as its own MLflow run (per-series mode). Returns the MLflow run id."""
+    sku_id = result['sku_id']
+    loc_id = result['loc_id']
+    models_results = result['models_results']
+    best_model_key = result['best_model_key']
+
+    # Start MLflow run for this SKU-location
+    with mlflow.start_run(run_name=f"{sku_id}_{loc_id}") as mlflow_run:
+        mlflow.log_param("sku_id", sku_id)
+        mlflow.log_param("location_id", loc_id)
+        mlflow.log_param("horizon", H)
+        mlflow.log_param("backtest_weeks", BACKTEST_WEEKS)
+        mlflow.log_param("backtest_mode", result['backtest_mode'])
+        mlflow.log_param("history_length", result['history_length'])
+
+        for key, model_result in models_results.items():
+            metrics = model_result['metrics']
+            mlflow.log_metric(f"{key}_wape", metrics['wape'])
+            mlflow.log_metric(f"{key}_smape", metrics['smape'])
+            mlflow.log_metric(f"{key}_bias", metrics['bias'])
+        for key, err in result['errors'].items():
+            mlflow.log_param(f"{key}_error", err)
+        mlflow.log_param("selection", result['selection'])
+        mlflow.log_metric("backtest_fits", result['backtest_fits'])
+        for key, record in result['pruned'].items():
+            mlflow.log_param(f"{key}_pruned", f"after {record['after_origins']}/{record['of_origins']} origins "
+                                              f"(behind {record['leader']}, z={record['z']:.2f})")
+        if result['exhaustive'] is not None:
+            mlflow.log_param("exhaustive_model", result['exhaustive']['best_model_key'])
+            mlflow.log_metric("exhaustive_wape", result['exhaustive']['best_wape'])
+
+        mlflow.log_param("selected_model", best_model_key)
+        mlflow.log_metric("selected_wape", result['best_wape'])
+        mlflow.log_metric("selected_smape", result['best_smape'])
+
+        # Plot backtest results and log artifact
+        if plot:
+            log_backtest_plot(
+                mlflow.tracking.MlflowClient(), mlflow_run.info.run_id,
+                models_results[best_model_key]['per_week'], sku_id, loc_id, best_model_key
+            )
+    return mlflow_run.info.run_id
+
+
+def write_series(conn, run_id: uuid.UUID, result: Dict) -> Tuple[int, int]:
+    """Write one series' selected metrics/forecasts. Returns (forecasts, metrics) counts."""
+    sku_id = result['sku_id']
+    loc_id = result['loc_id']
+    selected_result = result['models_results'][result['best_model_key']]
+    horizon_rows = result['horizon_rows']
+
+    insert_metrics(
+        conn, run_id, sku_id, loc_id,
+        selected_result['per_week'],
+        selected_result['model_name'],
+        'Production'
+    )
+    insert_forecasts(
+        conn, run_id, sku_id, loc_id,
+        horizon_rows,
+        selected_result['residual_std'],
+        selected_result['model_name'],
+        'Production'
+    )
+    return len(horizon_rows), len(selected_result['per_week'])
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--horizon", type=int, default=H_DEFAULT, help="Forecast horizon in weeks (1..8)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes for per-series fitting (1 = serial)")
+    parser.add_argument("--backtest-mode", choices=["refit", "filter"], default="refit",
+                        help="refit: re-estimate ETS/SARIMA at every origin; filter: estimate once and filter with fixed parameters")
+    parser.add_argument("--refit-every", type=int, default=0,
+                        help="In filter mode, re-estimate parameters every K origins (0 = once per series)")
+    parser.add_argument("--cache-dir", type=str, default=os.getenv("TRAIN_ML_CACHE_DIR"),
+                        help="Directory for the fitted-model cache (default: $TRAIN_ML_CACHE_DIR; unset = no cache)")
+    parser.add_argument("--cache-max-mb", type=int, default=1024, help="Size cap of the model cache (LRU eviction)")
+    parser.add_argument("--mlflow-mode", choices=["per-series", "batched"], default="per-series",
+                        help="per-series: one MLflow run per SKU-location; batched: one parent run, "
+                             "per-series results as a table artifact, uploads on a background thread")
+    parser.add_argument("--plots", type=str, default=None,
+                        help="Backtest plots: all, off, sample:N (percent of series) or worst:K by WAPE "
+                             "(default: all in per-series mode, worst:20 in batched mode)")
+    parser.add_argument("--mlflow-queue", type=int, default=64,
+                        help="Max pending uploads in batched mode before training waits on MLflow")
+    parser.add_argument("--selection", choices=["exhaustive", "racing"], default="exhaustive",
+                        help="exhaustive: backtest every model on every origin; racing: evaluate origins in rounds "
+                             "(newest first) and stop fitting ETS/SARIMA once clearly worse than the leader")
+    parser.add_argument("--race-origins", type=int, default=RACE_ORIGINS, help="Origins per racing round")
+    parser.add_argument("--race-confidence", type=float, default=RACE_CONFIDENCE,
+                        help="Prune a model when its mean excess absolute error over the leader exceeds this many "
+                             "standard errors (higher = fewer, safer prunes)")
+    parser.add_argument("--check-agreement", action="store_true",
+                        help="With racing or --backtest-mode filter, also run the exhaustive refit selection per "
+                             "series and report agreement, and in filter mode series whose backtest target weeks "
+                             "differ from refitting's (for evaluating these settings; doubles the fitting work)")
+    parser.add_argument("--global-model", action="store_true",
+                        help="Also fit one gradient-boosted model across all series on curated.weekly_features "
+                             "and enter it in each series' WAPE selection as global_gbm")
+    parser.add_argument("--global-train-weeks", type=int, default=GLOBAL_TRAIN_WEEKS,
+                        help="Origin weeks per series in the global model's training sets")
+    parser.add_argument("--hierarchical", action="store_true",
+                        help="Fit ETS/SARIMA only on category x location and total sums and disaggregate them to the "
+                             "series (candidate 'hierarchical'); the series' own ETS/SARIMA fits are skipped")
+    parser.add_argument("--hier-proportions", choices=PROPORTION_SOURCES, default="historical",
+                        help="Disaggregation shares: historical (recent units) or forecast (seasonal naive forecasts)")
+    parser.add_argument("--hier-reconcile", choices=RECONCILE_METHODS, default="none",
+                        help="Reconcile category x location forecasts with the total: ols, or mint (diagonal covariance)")
+    parser.add_argument("--hier-baseline-run", type=str, default=None,
+                        help="Bottom-up train_ml run to compare backtest WAPE with per level "
+                             "(default: the latest non-hierarchical run)")
+    add_work_queue_arguments(parser)
+    add_checkpoint_arguments(parser)
+    add_snapshot_arguments(parser)
+    add_instrument_arguments(parser)
     args = parser.parse_args()
+    if args.resume and args.mode != "single":
+        parser.error("--resume applies to single-process runs (coordinated runs resume through their work items)")
+    if args.selection == "racing" and args.backtest_mode != "refit":
+        parser.error("--selection racing needs --backtest-mode refit (filter mode fits each model once already)")
     H = max(1, min(args.horizon, 8))
+    workers = max(1, args.workers)
+    batched = args.mlflow_mode == "batched"
+    plot_spec = args.plots or ("worst:20" if batched else "all")
+    try:
+        plots = PlotSelector(parse_plot_spec(plot_spec))
+    except ValueError as e:
+        parser.error(str(e))
     
     # MLflow setup
     mlflow_uri = os.getenv("MLFLOW_TRACKING_URI", "http://localhost:5000")
@@ -415,151 +1130,336 @@ def main():
     mlflow.set_tracking_uri(mlflow_uri)
     mlflow.set_experiment(mlflow_experiment)
     
-    with get_conn() as conn:
-        run_id = write_batch_run_start(conn, "train_ml")
-        latest = fetch_latest_week(conn)
-        rows = fetch_weekly_demand(conn)
-        grouped = group_by_sku_loc(rows)
+    cache = ModelCache(args.cache_dir, max_bytes=args.cache_max_mb * 1024 * 1024) if args.cache_dir else None
+
+    with get_conn() as conn, \
+            RunProfiler("train_ml", profile=args.profile, trace_memory=args.trace_memory) as prof:
+        def run_config(latest_week: date) -> Dict:
+            return {**{name: getattr(args, name) for name in RESUME_OPTIONS}, 'latest_week': latest_week.isoformat()}
+
+        def apply_run_config(config: Dict) -> date:
+            """Take the stored options of a run over the command line's; returns its latest week."""
+            nonlocal H
+            for name in RESUME_OPTIONS:
+                if name in config:
+                    setattr(args, name, config[name])
+            H = max(1, min(args.horizon, 8))
+            return date.fromisoformat(config['latest_week'])
+
+        if args.mode == "coordinator":
+            latest_week = fetch_latest_week(conn)  # fails fast when curated.weekly_demand is empty
+            run_id = write_batch_run_start(conn, "train_ml")
+            # Every worker trains on this latest week with these options, whenever it starts
+            save_run_config(conn, run_id, run_config(latest_week))
+            n_items = create_work_items(conn, run_id, panel_keys(conn), args.batch_size)
+            print(f"✓ ML training run {run_id} created with {n_items} work items.")
+            print(f"  Start workers with: python -m jobs.train_ml --mode worker --run-id {run_id}")
+            return
+
+        worker_id = None
+        done: set = set()
+        if args.mode == "worker":
+            run_id = args.run_id or find_open_run(conn, "train_ml")
+            if run_id is None:
+                raise RuntimeError("No running train_ml run with open work items")
+            worker_id = args.worker_id or default_worker_id()
+            latest_week = apply_run_config(load_run_config(conn, run_id))
+        else:
+            for stale_id, n_done in mark_stale_runs(conn, "train_ml", args.stale_after):
+                print(f"Run {stale_id} stopped sending heartbeats and was marked failed ({n_done} series checkpointed); "
+                      f"resume it with --resume {stale_id}")
+            if args.resume:
+                run_id = find_resumable_run(conn, "train_ml") if args.resume == "latest" else args.resume
+                if run_id is None:
+                    raise RuntimeError("No failed or interrupted train_ml run to resume")
+                # The same latest week as the interrupted attempt, even if newer demand has arrived since
+                latest_week = apply_run_config(reopen_run(conn, run_id, "train_ml"))
+                done = checkpointed_keys(conn, run_id)
+                print(f"Resuming run {run_id} (latest week {latest_week}): {len(done)} series already checkpointed")
+            else:
+                latest_week = fetch_latest_week(conn)  # fails fast when curated.weekly_demand is empty
+                run_id = write_batch_run_start(conn, "train_ml")
+                save_run_config(conn, run_id, run_config(latest_week))
+        snapshot = open_snapshot(conn, args.snapshot_dir)
+
+        def load_panel(keys=None) -> DemandPanel:
+            """Panel of `keys` (default: all series) cut at latest_week, which newer demand may follow."""
+            panel = DemandPanel.load(conn, keys, through=latest_week, snapshot=snapshot)
+            return panel.weeks(0, panel.week_index(latest_week) + 1) if len(panel) else panel
         
         forecasts_inserted = 0
         metrics_inserted = 0
         model_selections = []
-        
-        for (sku_id, loc_id), ts in grouped.items():
-            ts_sorted = sorted(ts, key=lambda x: x[0])
-            
-            # Start MLflow run for this SKU-location
-            with mlflow.start_run(run_name=f"{sku_id}_{loc_id}"):
-                mlflow.log_param("sku_id", sku_id)
-                mlflow.log_param("location_id", loc_id)
-                mlflow.log_param("horizon", H)
-                mlflow.log_param("backtest_weeks", BACKTEST_WEEKS)
-                mlflow.log_param("history_length", len(ts_sorted))
-                
-                # Fit and evaluate models
-                models_results = {}
-                
-                # 1. Seasonal Naive
-                per_week_sn, residual_std_sn = rolling_backtest_seasonal_naive(ts_sorted, latest)
-                metrics_sn = compute_metrics(per_week_sn)
-                models_results['seasonal_naive'] = {
-                    'per_week': per_week_sn,
-                    'residual_std': residual_std_sn,
-                    'metrics': metrics_sn,
-                    'model_name': 'seasonal_naive_v1'
-                }
-                
-                # Log seasonal naive metrics
-                mlflow.log_metric("seasonal_naive_wape", metrics_sn['wape'])
-                mlflow.log_metric("seasonal_naive_smape", metrics_sn['smape'])
-                mlflow.log_metric("seasonal_naive_bias", metrics_sn['bias'])
-                
-                # 2. ETS (if sufficient history)
-                if len(ts_sorted) >= MIN_HISTORY:
-                    try:
-                        per_week_ets, residual_std_ets = rolling_backtest_model(
-                            ts_sorted, latest, fit_ets, seasonal_periods=52
-                        )
-                        if per_week_ets:
-                            metrics_ets = compute_metrics(per_week_ets)
-                            models_results['ets'] = {
-                                'per_week': per_week_ets,
-                                'residual_std': residual_std_ets,
-                                'metrics': metrics_ets,
-                                'model_name': 'ets_additive_v1'
-                            }
-                            mlflow.log_metric("ets_wape", metrics_ets['wape'])
-                            mlflow.log_metric("ets_smape", metrics_ets['smape'])
-                            mlflow.log_metric("ets_bias", metrics_ets['bias'])
-                    except Exception as e:
-                        mlflow.log_param("ets_error", str(e)[:200])
-                
-                # 3. SARIMA (if sufficient history)
-                if len(ts_sorted) >= MIN_HISTORY:
-                    try:
-                        per_week_sarima, residual_std_sarima = rolling_backtest_model(
-                            ts_sorted, latest, fit_sarima, seasonal_periods=52
-                        )
-                        if per_week_sarima:
-                            metrics_sarima = compute_metrics(per_week_sarima)
-                            models_results['sarima'] = {
-                                'per_week': per_week_sarima,
-                                'residual_std': residual_std_sarima,
-                                'metrics': metrics_sarima,
-                                'model_name': 'arima_sarima_v1'
-                            }
-                            mlflow.log_metric("sarima_wape", metrics_sarima['wape'])
-                            mlflow.log_metric("sarima_smape", metrics_sarima['smape'])
-                            mlflow.log_metric("sarima_bias", metrics_sarima['bias'])
-                    except Exception as e:
-                        mlflow.log_param("sarima_error", str(e)[:200])
-                
-                # Model selection: lowest WAPE, tie-break by sMAPE
-                best_model_key = None
-                best_wape = float('inf')
-                best_smape = float('inf')
-                
-                for key, result in models_results.items():
-                    wape = result['metrics']['wape']
-                    smape = result['metrics']['smape']
-                    if wape < best_wape or (wape == best_wape and smape < best_smape):
-                        best_wape = wape
-                        best_smape = smape
-                        best_model_key = key
-                
-                if best_model_key is None:
-                    best_model_key = 'seasonal_naive'
-                
-                selected_result = models_results[best_model_key]
-                mlflow.log_param("selected_model", best_model_key)
-                mlflow.log_metric("selected_wape", best_wape)
-                mlflow.log_metric("selected_smape", best_smape)
-                
-                # Generate horizon forecasts using selected model
-                if best_model_key == 'seasonal_naive':
-                    horizon_rows = generate_forecast_horizon_seasonal_naive(ts_sorted, latest, H)
-                elif best_model_key == 'ets':
-                    horizon_rows = generate_forecast_horizon(ts_sorted, latest, H, fit_ets)
-                elif best_model_key == 'sarima':
-                    horizon_rows = generate_forecast_horizon(ts_sorted, latest, H, fit_sarima)
-                else:
-                    horizon_rows = generate_forecast_horizon_seasonal_naive(ts_sorted, latest, H)
-                
-                # Plot backtest results and log artifact
-                plot_path = plot_backtest_results(
-                    selected_result['per_week'],
-                    f"Backtest: {sku_id} {loc_id} ({best_model_key})"
-                )
-                if plot_path:
-                    mlflow.log_artifact(plot_path, "plots")
-                    os.remove(plot_path)
-                
-                # Write to database
-                insert_metrics(
-                    conn, run_id, sku_id, loc_id,
-                    selected_result['per_week'],
-                    selected_result['model_name'],
-                    'Production'
+        warm_starts = 0
+        backtest_fits = 0
+        pruned_counts = {key: 0 for key, _, _ in MODEL_FITS}
+        agreement = {'series': 0, 'agree': 0, 'worse': 0, 'regret': 0.0, 'exhaustive_fits': 0, 'target_mismatches': 0}
+        global_results = None
+        global_info = {}
+        hierarchical_results = None
+        hierarchy_info = {}
+
+        def fit_global_model(panel: DemandPanel):
+            """Fit the global model once over the full panel (two fits, one batched predict each)."""
+            nonlocal global_results, global_info
+            with stage("global_model") as s:
+                latest = panel.week_index(latest_week) if len(panel) else 0
+                global_results, global_info = global_forecasts(
+                    conn, panel, latest, H, BACKTEST_WEEKS, train_weeks=max(1, args.global_train_weeks)
                 )
-                metrics_inserted += len(selected_result['per_week'])
-                
-                insert_forecasts(
-                    conn, run_id, sku_id, loc_id,
-                    horizon_rows,
-                    selected_result['residual_std'],
-                    selected_result['model_name'],
-                    'Production'
+                s.rows = global_info['train_rows'] + global_info['backtest_train_rows']
+            print(f"Global model: {len(global_results)} series forecast, "
+                  f"{global_info['train_rows']} training rows ({global_info['backtest_train_rows']} for the backtest fit)")
+
+        def fit_hierarchy(panel: DemandPanel):
+            """Fit the category x location and total sums of the panel, then disaggregate to its series."""
+            nonlocal hierarchical_results, hierarchy_info
+            with stage("hierarchy") as s:
+                hierarchy = Hierarchy(panel, load_categories(conn))
+                nodes = hierarchy.aggregate()
+                latest = panel.week_index(latest_week) if len(panel) else 0
+                node_forecasts, node_fits, selections = {}, 0, {}
+                for result in iter_series_results(
+                    nodes, latest, H, workers=workers, cache=cache,
+                    backtest_mode=args.backtest_mode, refit_every=max(0, args.refit_every),
+                    selection=args.selection, race_origins=max(1, args.race_origins),
+                    race_confidence=args.race_confidence
+                ):
+                    chosen = result['models_results'][result['best_model_key']]
+                    node_forecasts[(result['sku_id'], result['loc_id'])] = (
+                        chosen['per_week'], chosen['residual_std'], result['horizon_rows']
+                    )
+                    node_fits += result['backtest_fits']
+                    selections[result['best_model_key']] = selections.get(result['best_model_key'], 0) + 1
+                hierarchical_results, hierarchy_info = hierarchical_forecasts(
+                    hierarchy, latest, H, BACKTEST_WEEKS, node_forecasts,
+                    proportions=args.hier_proportions, method=args.hier_reconcile
                 )
-                forecasts_inserted += len(horizon_rows)
-                
+                hierarchy_info.update(node_fits=node_fits, selections=selections)
+                s.rows = len(nodes)
+            total = node_forecasts.get(TOTAL_KEY)
+            print(f"Hierarchy: {hierarchy_info['nodes']} category x location nodes + total, "
+                  f"{node_fits} backtest fits, node models " + "/".join(f"{k}:{n}" for k, n in sorted(selections.items())) +
+                  f"; {len(hierarchical_results)} series disaggregated ({args.hier_proportions} proportions, "
+                  f"reconcile={args.hier_reconcile})" + ("" if total else "; no total forecast"))
+
+        logger = None
+        if batched:
+            run_name = f"train_ml_{run_id}" + (f"_{worker_id}" if worker_id else "")
+            parent = mlflow.start_run(run_name=run_name)
+            logger = AsyncRunLogger(parent.info.run_id, max_queue=args.mlflow_queue)
+            logger.log_params({
+                "batch_run_id": run_id, "horizon": H, "backtest_weeks": BACKTEST_WEEKS,
+                "backtest_mode": args.backtest_mode, "refit_every": max(0, args.refit_every),
+                "workers": workers, "plots": plot_spec, "worker_id": worker_id or "",
+                "global_model": GLOBAL_MODEL_NAME if args.global_model else "",
+                "hierarchical": f"{args.hier_proportions}/{args.hier_reconcile}" if args.hierarchical else "",
+            })
+        series_rows = []
+
+        def train_panel(panel: DemandPanel, heartbeat=None, skip: frozenset = frozenset()) -> Tuple[int, int]:
+            """
+            Train, write and log every series of the panel but those in skip.
+            Outside worker mode each written series is checkpointed. Returns (forecasts, metrics) written.
+            """
+            nonlocal forecasts_inserted, metrics_inserted, warm_starts, backtest_fits
+            n_forecasts_total, n_metrics_total = 0, 0
+            latest = panel.week_index(latest_week) if len(panel) else 0
+            series = (item for item in panel if item.key not in skip) if skip else panel
+            results = iter_series_results(
+                series, latest, H, workers=workers, cache=cache,
+                backtest_mode=args.backtest_mode, refit_every=max(0, args.refit_every),
+                global_results=global_results, hierarchical_results=hierarchical_results,
+                local_models=not args.hierarchical, selection=args.selection, race_origins=max(1, args.race_origins),
+                race_confidence=args.race_confidence, check_agreement=args.check_agreement
+            )
+            for result in iterate("fit", results):
+                sku_id, loc_id, best_model_key = result['sku_id'], result['loc_id'], result['best_model_key']
+                warm_starts += int(result['warm_started'] and not result['cache_hit'])
+                backtest_fits += result['backtest_fits']
+                for key in result['pruned']:
+                    pruned_counts[key] += 1
+                if result['exhaustive'] is not None:
+                    agreement['series'] += 1
+                    agreement['agree'] += int(result['exhaustive']['best_model_key'] == best_model_key)
+                    regret = result['best_wape'] - result['exhaustive']['best_wape']
+                    agreement['worse'] += int(regret > 0)
+                    agreement['regret'] += regret
+                    agreement['exhaustive_fits'] += result['exhaustive']['backtest_fits']
+                    if result['exhaustive'].get('target_mismatches'):
+                        agreement['target_mismatches'] += 1
+                        print(f"  {sku_id}/{loc_id}: filter and refit backtest different target weeks for "
+                              + ", ".join(result['exhaustive']['target_mismatches']))
+                with stage("db_write") as s:
+                    n_forecasts, n_metrics = write_series(conn, run_id, result)
+                    if not worker_id:
+                        model_name = result['models_results'][best_model_key]['model_name']
+                        write_checkpoint(conn, run_id, sku_id, loc_id, model_name)
+                    s.rows = n_forecasts + n_metrics
+                n_forecasts_total += n_forecasts
+                n_metrics_total += n_metrics
+                forecasts_inserted += n_forecasts
+                metrics_inserted += n_metrics
                 model_selections.append(f"{sku_id}-{loc_id}: {best_model_key}")
+
+                per_week = result['models_results'][best_model_key]['per_week']
+                plot_now = plots.wants_now(sku_id, loc_id)
+                with stage("mlflow") as s:
+                    if batched:
+                        series_rows.append(series_summary(result))
+                        if plot_now:
+                            logger.submit(log_backtest_plot, per_week, sku_id, loc_id, best_model_key)
+                        plots.offer(result['best_wape'], (None, per_week, sku_id, loc_id, best_model_key))
+                    else:
+                        mlflow_run_id = log_series_run(result, H, plot=plot_now)
+                        plots.offer(result['best_wape'], (mlflow_run_id, per_week, sku_id, loc_id, best_model_key))
+                    s.rows = 1
+                if heartbeat is not None:
+                    heartbeat()
+            return n_forecasts_total, n_metrics_total
+        
+        run_heartbeat = None if worker_id else RunHeartbeat(run_id)
+        if run_heartbeat is not None:
+            run_heartbeat.start()
+        try:
+            if worker_id:
+                if args.global_model or args.hierarchical:
+                    # Every worker fits the same global model / hierarchy on the full panel before taking items
+                    with stage("load_panel") as s:
+                        panel = load_panel()
+                        s.rows = int(panel.mask.sum())
+                    if args.global_model:
+                        fit_global_model(panel)
+                    if args.hierarchical:
+                        fit_hierarchy(panel)
+                    del panel
+
+                reported = {'cache_hits': 0, 'cache_misses': 0, 'warm_starts': 0}
+
+                def handle(item, heartbeat):
+                    with stage("load_panel") as s:
+                        panel = load_panel(item.keys)
+                        s.rows = int(panel.mask.sum())
+                    n_forecasts, n_metrics = train_panel(panel, heartbeat)
+                    item_notes = f"forecasts={n_forecasts}, metrics={n_metrics}"
+                    if cache is not None:
+                        # Counts since the previous item (the first one includes the global model / hierarchy
+                        # fits); finish_run_if_complete sums them over the run's items
+                        counts = {'cache_hits': cache.hits, 'cache_misses': cache.misses, 'warm_starts': warm_starts}
+                        item_notes += "".join(f", {name}={n - reported[name]}" for name, n in counts.items())
+                        reported.update(counts)
+                    return item_notes
+
+                stats = process_work_items(
+                    conn, run_id, worker_id, handle, lease_seconds=args.lease_seconds,
+                    poll_seconds=args.poll_seconds, max_attempts=args.max_attempts,
+                )
+            else:
+                with stage("load_panel") as s:
+                    panel = load_panel()
+                    s.rows = int(panel.mask.sum())
+                if args.global_model:
+                    fit_global_model(panel)
+                if args.hierarchical:
+                    fit_hierarchy(panel)
+                train_panel(panel, skip=frozenset(done))
+
+            with stage("mlflow_finalize"):
+                if batched:
+                    for _, per_week, sku_id, loc_id, best_model_key in plots.worst():
+                        logger.submit(log_backtest_plot, per_week, sku_id, loc_id, best_model_key)
+                    logger.submit(log_series_table, series_rows)
+                    selected = pd.DataFrame(series_rows, columns=['selected_model', 'selected_wape'])
+                    summary = {"series_count": len(series_rows)}
+                    if series_rows:
+                        summary.update({
+                            "selected_wape_mean": selected['selected_wape'].mean(),
+                            "selected_wape_median": selected['selected_wape'].median(),
+                        })
+                    for key in MODEL_KEYS:
+                        summary[f"selected_{key}_count"] = int((selected['selected_model'] == key).sum())
+                    summary["backtest_fits"] = backtest_fits
+                    if args.selection == "racing":
+                        for key, n in pruned_counts.items():
+                            summary[f"pruned_{key}_count"] = n
+                    if agreement['series']:
+                        summary["selection_agreement"] = agreement['agree'] / agreement['series']
+                        summary["selection_worse_count"] = agreement['worse']
+                        summary["selection_wape_regret"] = agreement['regret'] / agreement['series']
+                        summary["exhaustive_backtest_fits"] = agreement['exhaustive_fits']
+                        if args.backtest_mode == "filter" and args.selection == "exhaustive":
+                            summary["target_week_mismatch_count"] = agreement['target_mismatches']
+                    logger.log_metrics(summary)
+                    logger.close()
+                else:
+                    client = mlflow.tracking.MlflowClient()
+                    for mlflow_run_id, per_week, sku_id, loc_id, best_model_key in plots.worst():
+                        log_backtest_plot(client, mlflow_run_id, per_week, sku_id, loc_id, best_model_key)
+        except BaseException as e:
+            if batched:
+                mlflow.end_run(status="FAILED")
+            if not worker_id:
+                # Best effort: with the connection gone, the stale heartbeat marks the run failed later
+                try:
+                    conn.rollback()
+                    write_batch_run_finish(conn, run_id, status="failed", notes=(
+                        f"{type(e).__name__}: {e}"[:300] + f"; {len(checkpointed_keys(conn, run_id))} series "
+                        f"checkpointed, resume with --resume {run_id}"
+                    ))
+                except psycopg2.Error:
+                    pass
+            raise
+        finally:
+            if run_heartbeat is not None:
+                run_heartbeat.stop()
+        if batched:
+            mlflow.end_run()
         
-        notes = f"Inserted forecasts={forecasts_inserted}, metrics={metrics_inserted}, horizon={H}, backtest_weeks={BACKTEST_WEEKS}"
-        write_batch_run_finish(conn, run_id, status="succeeded", notes=notes)
-        print(f"✓ ML training run {run_id} completed.")
+        config = f"horizon={H}, backtest_weeks={BACKTEST_WEEKS}, backtest_mode={args.backtest_mode}, workers={workers}, mlflow_mode={args.mlflow_mode}, plots={plot_spec}"
+        if args.global_model:
+            config += f", global_model={GLOBAL_MODEL_NAME}, global_train_weeks={max(1, args.global_train_weeks)}"
+        if args.hierarchical:
+            config += f", hierarchical={args.hier_proportions}/{args.hier_reconcile}"
+        if args.selection == "racing":
+            config += f", selection=racing, race_origins={max(1, args.race_origins)}, race_confidence={args.race_confidence}"
+        notes = f"Inserted forecasts={forecasts_inserted}, metrics={metrics_inserted}, {config}, backtest_fits={backtest_fits}"
+        if args.resume:
+            notes += f", resumed_after={len(done)} checkpointed series"
+        if global_info:
+            notes += f", global_train_rows={global_info['train_rows']}"
+        if hierarchy_info:
+            notes += f", hierarchy_nodes={hierarchy_info['nodes']}, hierarchy_fits={hierarchy_info['node_fits']}"
+        if args.selection == "racing":
+            notes += ", pruned=" + "/".join(f"{key}:{n}" for key, n in pruned_counts.items())
+        if agreement['series']:
+            notes += (
+                f", agreement={agreement['agree']}/{agreement['series']}"
+                f" ({agreement['agree'] / agreement['series']:.1%}), worse_selections={agreement['worse']}, mean_wape_regret={agreement['regret'] / agreement['series']:.4f}"
+                f", exhaustive_fits={agreement['exhaustive_fits']}"
+            )
+            if args.backtest_mode == "filter" and args.selection == "exhaustive":
+                notes += f", target_week_mismatches={agreement['target_mismatches']}"
+        if cache is not None:
+            notes += f", cache_hits={cache.hits}, cache_misses={cache.misses}, warm_starts={warm_starts}"
+        prof.save(conn, run_id, worker_id=worker_id or '')
+        if worker_id:
+            status = finish_run_if_complete(conn, run_id, notes=config)
+            print(f"✓ ML training worker {worker_id} finished on run {run_id}.")
+            print(f"  Items done={stats['done']}, failed={stats['failed']}, lost={stats['lost']}" + (f"; run {status}" if status else ""))
+        else:
+            if args.hierarchical:
+                baseline = args.hier_baseline_run or fetch_baseline_run(conn, exclude=str(run_id))
+                comparison = compare_runs(conn, str(run_id), baseline) if baseline else []
+                if comparison:
+                    notes += f", backtest WAPE vs bottom-up run {baseline}: {format_comparison(comparison)}"
+            write_batch_run_finish(conn, run_id, status="succeeded", notes=notes)
+            print(f"✓ ML training run {run_id} completed.")
         print(f"  {notes}")
         print(f"  Model selections: {len(model_selections)} SKU-locations")
         print(f"  MLflow tracking URI: {mlflow_uri}")
+        if batched:
+            print(f"  MLflow parent run: {parent.info.run_id} (per-series table: {SERIES_TABLE_ARTIFACT})")
+        print(prof.report())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,170 @@
+"""
+Per-series checkpoints and liveness of long single-process batch runs.
+
+Each series whose results are written is recorded in ops.series_checkpoint
+under its run, after the result upserts (a crash in between redoes the series,
+and the upserts make that harmless). The run's options are stored in
+ops.batch_run.config when it starts, so a resumed run (--resume) reuses them
+and processes only the series without a checkpoint. Coordinated runs store
+them too, for their workers to apply instead of their own command lines.
+
+While a run is alive, a background thread with its own connection refreshes
+ops.batch_run.heartbeat_at every HEARTBEAT_SECONDS. A process killed by the
+OOM killer or cut off from the database stops the heartbeat, and the next
+start of the job marks its 'running' runs whose heartbeat is older than
+STALE_AFTER_SECONDS as failed ("interrupted"), which makes them resumable.
+Runs split into ops.work_item batches are left alone: their items carry
+leases of their own.
+"""
+import argparse
+import json
+import threading
+import uuid
+from typing import Dict, List, Optional, Set, Tuple
+from jobs.utils.db import get_conn, register_statement, execute_prepared
+
+HEARTBEAT_SECONDS = 60
+STALE_AFTER_SECONDS = 900
+
+INSERT_CHECKPOINT = register_statement("insert_series_checkpoint", """
+  INSERT INTO ops.series_checkpoint (run_id, sku_id, location_id, model_name)
+  VALUES ($1::uuid, $2::text, $3::text, $4::text)
+  ON CONFLICT (run_id, sku_id, location_id) DO UPDATE SET
+    model_name = EXCLUDED.model_name,
+    completed_at = NOW()
+""")
+
+
+def add_checkpoint_arguments(parser: argparse.ArgumentParser):
+    """CLI options of the jobs that checkpoint their series."""
+    parser.add_argument("--resume", nargs="?", const="latest", default=None, metavar="RUN_ID",
+                        help="Resume an interrupted or failed run (default: the latest one) with the options it was "
+                             "started with, processing only series without a checkpoint")
+    parser.add_argument("--stale-after", type=float, default=STALE_AFTER_SECONDS,
+                        help="Seconds without a heartbeat after which a running run counts as interrupted")
+
+
+def save_run_config(conn, run_id: uuid.UUID, config: Dict):
+    with conn.cursor() as cur:
+        cur.execute("UPDATE ops.batch_run SET config = %s WHERE run_id = %s", (json.dumps(config), str(run_id)))
+    conn.commit()
+
+
+def load_run_config(conn, run_id: uuid.UUID) -> Dict:
+    """Options stored with a run; raises if it has none."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT config FROM ops.batch_run WHERE run_id = %s", (str(run_id),))
+        row = cur.fetchone()
+    conn.commit()
+    if row is None or row[0] is None:
+        raise RuntimeError(f"Run {run_id} has no stored options; create it with --mode coordinator")
+    return row[0]
+
+
+def mark_stale_runs(conn, job_type: str, stale_after: float = STALE_AFTER_SECONDS) -> List[Tuple[str, int]]:
+    """
+    Mark running runs of job_type without a heartbeat (or, for runs that never
+    had one, a start) within stale_after seconds as failed. Returns
+    (run_id, checkpointed series) of each.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+          UPDATE ops.batch_run r
+          SET status = 'failed', finished_at = NOW(),
+              notes = 'interrupted: no heartbeat since ' || COALESCE(r.heartbeat_at, r.started_at)::text
+                      || COALESCE('; ' || r.notes, '')
+          WHERE r.job_type = %s AND r.status = 'running'
+            AND COALESCE(r.heartbeat_at, r.started_at) < NOW() - make_interval(secs => %s)
+            AND NOT EXISTS (SELECT 1 FROM ops.work_item w WHERE w.run_id = r.run_id)
+          RETURNING r.run_id::text,
+                    (SELECT COUNT(*) FROM ops.series_checkpoint c WHERE c.run_id = r.run_id)
+        """, (job_type, float(stale_after)))
+        rows = cur.fetchall()
+    conn.commit()
+    return rows
+
+
+def find_resumable_run(conn, job_type: str) -> Optional[str]:
+    """Latest failed run of job_type that recorded its options (runs started before checkpointing did not)."""
+    with conn.cursor() as cur:
+        cur.execute("""
+          SELECT run_id::text FROM ops.batch_run
+          WHERE job_type = %s AND status = 'failed' AND config IS NOT NULL
+            AND NOT EXISTS (SELECT 1 FROM ops.work_item w WHERE w.run_id = ops.batch_run.run_id)
+          ORDER BY started_at DESC LIMIT 1
+        """, (job_type,))
+        row = cur.fetchone()
+    conn.commit()
+    return row[0] if row else None
+
+
+def reopen_run(conn, run_id: str, job_type: str) -> Dict:
+    """Mark a failed run running again (with a fresh heartbeat); returns its stored options."""
+    with conn.cursor() as cur:
+        cur.execute("""
+          UPDATE ops.batch_run SET status = 'running', finished_at = NULL, heartbeat_at = NOW()
+          WHERE run_id = %s AND job_type = %s AND status = 'failed' AND config IS NOT NULL
+          RETURNING config
+        """, (run_id, job_type))
+        row = cur.fetchone()
+        if row is None:
+            conn.rollback()
+            raise RuntimeError(f"{run_id} is not a failed or interrupted {job_type} run with stored options")
+    conn.commit()
+    return row[0]
+
+
+def checkpointed_keys(conn, run_id: uuid.UUID) -> Set[Tuple[str, str]]:
+    with conn.cursor() as cur:
+        cur.execute("SELECT sku_id, location_id FROM ops.series_checkpoint WHERE run_id = %s", (str(run_id),))
+        keys = set(cur.fetchall())
+    conn.commit()
+    return keys
+
+
+def write_checkpoint(conn, run_id: uuid.UUID, sku_id: str, loc_id: str, model_name: str):
+    with conn.cursor() as cur:
+        execute_prepared(cur, INSERT_CHECKPOINT, (str(run_id), sku_id, loc_id, model_name))
+    conn.commit()
+
+
+class RunHeartbeat:
+    """Refreshes ops.batch_run.heartbeat_at of one run on a background thread while in the with block."""
+
+    def __init__(self, run_id: uuid.UUID, interval: float = HEARTBEAT_SECONDS):
+        self.run_id = str(run_id)
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._worker, name="run-heartbeat", daemon=True)
+
+    def _beat(self, conn):
+        with conn.cursor() as cur:
+            cur.execute("UPDATE ops.batch_run SET heartbeat_at = NOW() WHERE run_id = %s", (self.run_id,))
+        conn.commit()
+
+    def _worker(self):
+        while not self._stop.is_set():
+            try:
+                # A dropped connection is replaced after the next interval
+                with get_conn(pooled=False) as conn:
+                    self._beat(conn)
+                    while not self._stop.wait(self.interval):
+                        self._beat(conn)
+                    return
+            except Exception:
+                self._stop.wait(self.interval)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self) -> "RunHeartbeat":
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
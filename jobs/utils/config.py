@@ -16,4 +16,17 @@ PG_CONFIG = {
     "user": os.getenv("PGUSER", "postgres"),
     "password": os.getenv("PGPASSWORD", ""),
     "sslmode": "require" if getenv_bool("PGSSL", False) else "disable",
-}
\ No newline at end of file
+}
+POOL_CONFIG = {
+    "enabled": getenv_bool("PG_POOL", False),
+    "minconn": int(os.getenv("PG_POOL_MIN", "1")),
+    "maxconn": int(os.getenv("PG_POOL_MAX", "8")),
+}
+
+# Session settings applied to every job connection (unset = server default)
+SESSION_SETTINGS = {
+    name: value for name, value in (
+        ("work_mem", os.getenv("PG_WORK_MEM")),
+        ("synchronous_commit", os.getenv("PG_SYNCHRONOUS_COMMIT")),
+    ) if value
+}
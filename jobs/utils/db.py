@@ -1,11 +1,24 @@
+import csv
+import io
+import itertools
+import re
+import threading
+import weakref
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
 from contextlib import contextmanager
-from .config import PG_CONFIG
+from typing import Iterable, Iterator, Optional, Sequence, Tuple
+from .config import PG_CONFIG, POOL_CONFIG, SESSION_SETTINGS
 
-@contextmanager
-def get_conn():
-  conn = psycopg2.connect(
+COPY_BATCH_ROWS = 10000
+
+# Session overrides for jobs that mostly bulk-load: commits do not wait for the
+# WAL flush (a crash can lose the last commits, never corrupt them)
+BULK_LOAD_SESSION = {"synchronous_commit": "off"}
+
+def _connect_kwargs() -> dict:
+  return dict(
       host=PG_CONFIG["host"],
       port=PG_CONFIG["port"],
       dbname=PG_CONFIG["database"],
@@ -13,12 +26,281 @@ def get_conn():
       password=PG_CONFIG["password"],
       sslmode=PG_CONFIG["sslmode"],
   )
+
+def _apply_session(conn, settings: dict):
+  if not settings:
+    return
+  with conn.cursor() as cur:
+    for name, value in settings.items():
+      cur.execute("SELECT set_config(%s, %s, false)", (name, str(value)))
+  conn.commit()
+
+class _BlockingPool(psycopg2.pool.ThreadedConnectionPool):
+  """
+  ThreadedConnectionPool that waits for a free connection instead of raising
+  PoolError when all maxconn connections are checked out, and hands out only
+  connections that pass a health check.
+  """
+
+  def __init__(self, minconn: int, maxconn: int):
+    self._slots = threading.BoundedSemaphore(maxconn)
+    super().__init__(minconn, maxconn, **_connect_kwargs())
+
+  def checkout(self):
+    self._slots.acquire()
+    try:
+      for _ in range(self.maxconn + 1):
+        conn = self.getconn()
+        if _healthy(conn):
+          return conn
+        self.putconn(conn, close=True)
+      raise psycopg2.OperationalError("no healthy database connection available")
+    except BaseException:
+      self._slots.release()
+      raise
+
+  def checkin(self, conn):
+    try:
+      if conn.closed:
+        self.putconn(conn, close=True)
+        return
+      try:
+        conn.rollback()
+        _reset_session(conn)
+        self.putconn(conn)
+      except psycopg2.Error:
+        self.putconn(conn, close=True)
+    finally:
+      self._slots.release()
+
+def _healthy(conn) -> bool:
+  if conn.closed:
+    return False
+  try:
+    with conn.cursor() as cur:
+      cur.execute("SELECT 1")
+    conn.rollback()
+    return True
+  except psycopg2.Error:
+    return False
+
+def _reset_session(conn):
+  overrides = _SESSION_OVERRIDES.pop(conn, None)
+  if not overrides:
+    return
+  # Back to the pool-wide settings so the next borrower starts clean
+  with conn.cursor() as cur:
+    cur.execute(
+        "SELECT set_config(name, reset_val, false) FROM pg_settings WHERE name = ANY(%s)",
+        (list(overrides),),
+    )
+  conn.commit()
+  _apply_session(conn, {k: v for k, v in SESSION_SETTINGS.items() if k in overrides})
+
+_pool: Optional[_BlockingPool] = None
+_pool_lock = threading.Lock()
+_SESSION_OVERRIDES: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_POOLED_READY: "weakref.WeakSet" = weakref.WeakSet()
+
+def get_pool() -> _BlockingPool:
+  """Process-wide connection pool sized by PG_POOL_MIN / PG_POOL_MAX (created lazily)."""
+  global _pool
+  with _pool_lock:
+    if _pool is None or _pool.closed:
+      _pool = _BlockingPool(POOL_CONFIG["minconn"], max(1, POOL_CONFIG["maxconn"]))
+    return _pool
+
+def close_pool():
+  global _pool
+  with _pool_lock:
+    if _pool is not None and not _pool.closed:
+      _pool.closeall()
+    _pool = None
+
+@contextmanager
+def get_conn(session: Optional[dict] = None, pooled: Optional[bool] = None):
+  """
+  Database connection for a unit of work.
+
+  session: extra session settings for this connection (e.g. BULK_LOAD_SESSION),
+           applied on top of PG_WORK_MEM / PG_SYNCHRONOUS_COMMIT.
+  pooled: borrow from the process-wide pool instead of opening a new
+          connection (default: PG_POOL). Pooled connections are health-checked
+          on checkout, rolled back and reset on return, and keep their
+          prepared statements across borrowers.
+  """
+  if pooled is None:
+    pooled = POOL_CONFIG["enabled"]
+  if not pooled:
+    conn = psycopg2.connect(**_connect_kwargs())
+    try:
+      _apply_session(conn, {**SESSION_SETTINGS, **(session or {})})
+      yield conn
+    finally:
+      conn.close()
+    return
+
+  pool = get_pool()
+  conn = pool.checkout()
   try:
+    if conn not in _POOLED_READY:
+      _apply_session(conn, SESSION_SETTINGS)
+      _POOLED_READY.add(conn)
+    if session:
+      _SESSION_OVERRIDES[conn] = session
+      _apply_session(conn, session)
     yield conn
   finally:
-    conn.close()
+    pool.checkin(conn)
+
+# Prepared statements: SQL is registered once per process under a name and
+# PREPAREd lazily the first time each connection executes it.
+_STATEMENTS: dict = {}
+_PREPARED: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_PARAM_RE = re.compile(r"\$(\d+)")
+
+def register_statement(name: str, sql: str) -> str:
+  """
+  Register `sql` (with $1..$n placeholders) under `name` and return the name.
+  Re-registering the same SQL is a no-op; different SQL under a taken name raises.
+  """
+  if not re.fullmatch(r"[a-z_][a-z0-9_]*", name):
+    raise ValueError(f"invalid prepared statement name {name!r}")
+  n_params = max((int(i) for i in _PARAM_RE.findall(sql)), default=0)
+  existing = _STATEMENTS.get(name)
+  if existing is not None and existing[0] != sql:
+    raise ValueError(f"prepared statement {name!r} is already registered with different SQL")
+  _STATEMENTS[name] = (sql, n_params)
+  return name
+
+def execute_prepared(cur, name: str, params: Sequence = ()):
+  """Execute a registered statement on `cur`, preparing it on this connection if needed."""
+  sql, n_params = _STATEMENTS[name]
+  if len(params) != n_params:
+    raise ValueError(f"prepared statement {name!r} takes {n_params} parameters, got {len(params)}")
+  prepared = _PREPARED.setdefault(cur.connection, set())
+  if name not in prepared:
+    # PREPARE is not transactional: it survives a later rollback of this transaction
+    cur.execute(f"PREPARE {name} AS {sql}")
+    prepared.add(name)
+  if n_params:
+    cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * n_params)})", tuple(params))
+  else:
+    cur.execute(f"EXECUTE {name}")
+
+def iter_groups(
+    conn,
+    sql: str,
+    params: Optional[Sequence] = None,
+    key_columns: int = 2,
+    name: str = "grouped_rows",
+    itersize: int = COPY_BATCH_ROWS,
+) -> Iterator[Tuple[tuple, list]]:
+  """
+  Stream `sql` through a server-side (named) cursor and yield (key, rows) for
+  each contiguous run of equal leading `key_columns` values; rows hold the
+  remaining columns in query order. `sql` must ORDER BY the key columns.
+  Client memory is one group plus one `itersize` fetch batch. The cursor is
+  WITH HOLD, so the caller may commit between groups (the server then keeps
+  the rest of the result until the cursor closes).
+  """
+  with conn.cursor(name=name, withhold=True) as cur:
+    cur.itersize = itersize
+    cur.execute(sql, params)
+    for key, group in itertools.groupby(cur, key=lambda row: row[:key_columns]):
+      yield key, [row[key_columns:] for row in group]
 
 def execute_values_insert(conn, sql: str, rows: list[tuple]):
   with conn.cursor() as cur:
     psycopg2.extras.execute_values(cur, sql, rows, page_size=10000)
-  conn.commit()
\ No newline at end of file
+  conn.commit()
+
+COPY_NULL = "\\N"
+
+def _null_marked(row: tuple) -> tuple:
+  return tuple(COPY_NULL if v is None else v for v in row)
+
+class _CsvRowStream(io.TextIOBase):
+  """
+  Read-only file object that renders rows from an iterator as CSV on demand,
+  so COPY can consume an arbitrarily long iterator with bounded memory.
+  None is written as \\N (the COPY NULL marker); an empty string stays ''.
+  """
+
+  def __init__(self, rows: Iterable[tuple], batch_rows: int = COPY_BATCH_ROWS):
+    self._rows = iter(rows)
+    self._batch_rows = batch_rows
+    self._sink = io.StringIO()
+    self._writer = csv.writer(self._sink, lineterminator="\n")
+    self.rows_written = 0
+
+  def readable(self) -> bool:
+    return True
+
+  def _render(self) -> str:
+    batch = list(itertools.islice(self._rows, self._batch_rows))
+    self.rows_written += len(batch)
+    self._writer.writerows(_null_marked(row) if None in row else row for row in batch)
+    out = self._sink.getvalue()
+    self._sink.seek(0)
+    self._sink.truncate()
+    return out
+
+  def read(self, size: int = -1) -> str:
+    # COPY sends whatever a read() returns, so hand out one rendered batch per
+    # call (ignoring size) and signal EOF with ""
+    if size >= 0:
+      return self._render()
+    return "".join(iter(self._render, ""))
+
+def copy_upsert(
+    conn,
+    table: str,
+    columns: Sequence[str],
+    rows: Iterable[tuple],
+    conflict_columns: Sequence[str],
+    update_columns: Optional[Sequence[str]] = None,
+    touch_columns: Sequence[str] = (),
+    batch_rows: Optional[int] = None,
+    commit: bool = True,
+) -> int:
+  """
+  Bulk upsert `rows` into `table` via COPY ... FROM STDIN (CSV) into a temp
+  staging table, followed by one set-based INSERT ... ON CONFLICT merge.
+
+  rows: any iterable of tuples ordered like `columns`; consumed lazily.
+  update_columns: columns overwritten from EXCLUDED on conflict
+                  (default: all non-conflict columns; empty = DO NOTHING).
+  touch_columns: columns set to NOW() on conflict (e.g. updated_at).
+  batch_rows: if set, stage and merge every `batch_rows` rows so the staging
+              table also stays bounded (each batch commits when commit=True).
+  Returns the number of rows streamed.
+  """
+  if update_columns is None:
+    update_columns = [c for c in columns if c not in conflict_columns]
+  col_list = ", ".join(columns)
+  staging = "_stage_" + table.replace(".", "_")
+  set_clause = [f"{c} = EXCLUDED.{c}" for c in update_columns] + [f"{c} = NOW()" for c in touch_columns]
+  on_conflict = f"DO UPDATE SET {', '.join(set_clause)}" if set_clause else "DO NOTHING"
+  merge_sql = f"""
+    INSERT INTO {table} ({col_list})
+    SELECT {col_list} FROM {staging}
+    ON CONFLICT ({", ".join(conflict_columns)}) {on_conflict}
+  """
+
+  rows = iter(rows)
+  batches = iter(lambda: list(itertools.islice(rows, batch_rows)), []) if batch_rows else [rows]
+  total = 0
+  for batch in batches:
+    stream = _CsvRowStream(batch)
+    with conn.cursor() as cur:
+      cur.execute(f"DROP TABLE IF EXISTS {staging}")
+      cur.execute(f"CREATE TEMP TABLE {staging} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP")
+      cur.copy_expert(f"COPY {staging} ({col_list}) FROM STDIN WITH (FORMAT csv, NULL '{COPY_NULL}')", stream)
+      if stream.rows_written:
+        cur.execute(merge_sql)
+      cur.execute(f"DROP TABLE {staging}")
+    total += stream.rows_written
+    if commit:
+      conn.commit()
+  return total
@@ -0,0 +1,221 @@
+"""
+Lightweight per-stage instrumentation for the jobs.
+
+A RunProfiler is entered once per job; while it is active, stage(name) (a
+context manager that also works as a decorator) and iterate(name, iterable)
+time named stages anywhere in the call tree and count the rows they handle,
+and are no-ops when no profiler is active. Repeated entries of a stage are
+aggregated. Per stage it records wall and CPU seconds, rows, how much the
+process RSS high-water mark grew, and with trace_memory the tracemalloc peak
+of Python allocations inside the stage. save() writes one ops.run_stage row
+per stage; with a profile path, the whole job also runs under cProfile.
+
+    with RunProfiler("compute_policy", profile=args.profile) as prof:
+        with stage("read_settings") as s:
+            settings = fetch_settings(conn)
+            s.rows = len(settings)
+        ...
+        prof.save(conn, run_id)
+"""
+import cProfile
+import io
+import pstats
+import resource
+import sys
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Iterator, List, Optional
+import psycopg2.extras
+
+_active: Optional["RunProfiler"] = None
+
+
+def rss_high_water_mb() -> float:
+    """Peak RSS of this process so far (ru_maxrss is KiB on Linux, bytes on macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+class StageStats:
+    __slots__ = ("name", "order", "started_at", "calls", "wall_seconds", "cpu_seconds", "rows",
+                 "rss_peak_mb", "rss_growth_mb", "traced_peak_mb")
+
+    def __init__(self, name: str, order: int):
+        self.name = name
+        self.order = order
+        self.started_at = datetime.now(timezone.utc)
+        self.calls = 0
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.rows = 0
+        self.rss_peak_mb = 0.0
+        self.rss_growth_mb = 0.0
+        self.traced_peak_mb: Optional[float] = None
+
+
+class StageHandle:
+    """Yielded by stage(); set or add to .rows for the rows the stage handled."""
+    __slots__ = ("rows",)
+
+    def __init__(self):
+        self.rows = 0
+
+
+class RunProfiler:
+    def __init__(self, job_type: str, profile: Optional[str] = None, trace_memory: bool = False):
+        self.job_type = job_type
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.stages: Dict[str, StageStats] = {}
+        self._open: List[List[float]] = []  # traced peak (bytes) seen by each open stage
+        self._profiler: Optional[cProfile.Profile] = None
+        self._started_tracing = False
+
+    def __enter__(self) -> "RunProfiler":
+        global _active
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        if self.profile is not None:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        _active = self
+        return self
+
+    def __exit__(self, *exc):
+        global _active
+        _active = None
+        if self._profiler is not None:
+            self._profiler.disable()
+            self.dump_profile()
+        if self._started_tracing:
+            tracemalloc.stop()
+        return False
+
+    def _stats(self, name: str) -> StageStats:
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = self.stages[name] = StageStats(name, len(self.stages))
+        return stats
+
+    def _fold_traced_peak(self):
+        """Credit the current tracemalloc peak to every open stage, then reset it."""
+        if not self.trace_memory or not self._open:
+            return
+        peak = tracemalloc.get_traced_memory()[1]
+        for frame in self._open:
+            frame[0] = max(frame[0], peak)
+        tracemalloc.reset_peak()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[StageHandle]:
+        stats = self._stats(name)
+        handle = StageHandle()
+        if self.trace_memory:
+            self._fold_traced_peak()
+            tracemalloc.reset_peak()
+        frame = [0.0]
+        self._open.append(frame)
+        rss_before = rss_high_water_mb()
+        wall0, cpu0 = time.perf_counter(), time.process_time()
+        try:
+            yield handle
+        finally:
+            stats.wall_seconds += time.perf_counter() - wall0
+            stats.cpu_seconds += time.process_time() - cpu0
+            stats.calls += 1
+            stats.rows += handle.rows
+            rss_after = rss_high_water_mb()
+            stats.rss_peak_mb = max(stats.rss_peak_mb, rss_after)
+            stats.rss_growth_mb += rss_after - rss_before
+            if self.trace_memory:
+                self._fold_traced_peak()
+                traced = frame[0] / (1024 * 1024)
+                stats.traced_peak_mb = max(stats.traced_peak_mb or 0.0, traced)
+            self._open.pop()
+
+    def count(self, name: str, rows: int):
+        """Add rows to a stage without timing anything."""
+        self._stats(name).rows += rows
+
+    def report(self) -> str:
+        lines = [f"  {'stage':<24}{'calls':>7}{'wall s':>10}{'cpu s':>10}{'rows':>12}{'rss +MB':>9}"]
+        for s in sorted(self.stages.values(), key=lambda s: s.order):
+            lines.append(f"  {s.name:<24}{s.calls:>7}{s.wall_seconds:>10.2f}{s.cpu_seconds:>10.2f}"
+                         f"{s.rows:>12,}{s.rss_growth_mb:>9.1f}")
+        return "\n".join(lines)
+
+    def save(self, conn, run_id: Optional[uuid.UUID] = None, worker_id: str = '') -> uuid.UUID:
+        """
+        Write one ops.run_stage row per stage (replacing rows of an earlier
+        save); a fresh run id is used when the job has none. Returns the run id.
+        """
+        run_id = run_id or uuid.uuid4()
+        rows = [
+            (str(run_id), self.job_type, s.name, worker_id, s.order, s.calls, s.started_at,
+             s.wall_seconds, s.cpu_seconds, s.rows, s.rss_peak_mb, s.rss_growth_mb, s.traced_peak_mb)
+            for s in self.stages.values()
+        ]
+        if not rows:
+            return run_id
+        with conn.cursor() as cur:
+            psycopg2.extras.execute_values(cur, """
+              INSERT INTO ops.run_stage (
+                run_id, job_type, stage, worker_id, stage_order, calls, started_at,
+                wall_seconds, cpu_seconds, row_count, rss_peak_mb, rss_growth_mb, traced_peak_mb
+              ) VALUES %s
+              ON CONFLICT (run_id, stage, worker_id) DO UPDATE SET
+                calls = EXCLUDED.calls, wall_seconds = EXCLUDED.wall_seconds,
+                cpu_seconds = EXCLUDED.cpu_seconds, row_count = EXCLUDED.row_count,
+                rss_peak_mb = EXCLUDED.rss_peak_mb, rss_growth_mb = EXCLUDED.rss_growth_mb,
+                traced_peak_mb = EXCLUDED.traced_peak_mb, recorded_at = NOW()
+            """, rows)
+        conn.commit()
+        return run_id
+
+    def dump_profile(self, top: int = 25):
+        """Write cProfile stats to self.profile (default <job_type>.prof) and print the top entries."""
+        path = self.profile or f"{self.job_type}.prof"
+        self._profiler.dump_stats(path)
+        out = io.StringIO()
+        pstats.Stats(self._profiler, stream=out).sort_stats("cumulative").print_stats(top)
+        print(f"cProfile stats written to {path} (view with: python -m pstats {path})")
+        print(out.getvalue())
+
+
+@contextmanager
+def stage(name: str) -> Iterator[StageHandle]:
+    """Time a named stage of the active RunProfiler; a no-op handle when none is active."""
+    if _active is None:
+        yield StageHandle()
+        return
+    with _active.stage(name) as handle:
+        yield handle
+
+
+def iterate(name: str, iterable: Iterable) -> Iterator:
+    """
+    Yield from iterable, timing only the time spent producing each item
+    (e.g. fitting inside a lazy generator) under stage `name`, one row per item.
+    The stage's calls include the final step that finds the iterable exhausted.
+    """
+    it = iter(iterable)
+    while True:
+        with stage(name) as s:
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            s.rows = 1
+        yield item
+
+
+def add_instrument_arguments(parser):
+    """--profile / --trace-memory options shared by every job."""
+    parser.add_argument("--profile", nargs="?", const="", default=None, metavar="PATH",
+                        help="Run under cProfile and write the stats to PATH (default: <job>.prof)")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="Record tracemalloc peaks per stage in ops.run_stage (slows the job down)")
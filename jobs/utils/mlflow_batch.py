@@ -0,0 +1,92 @@
+"""
+Batched, asynchronous MLflow logging under a single run.
+Params and metrics are buffered and sent with log_batch; artifact uploads
+(and anything else slow, such as plot rendering) run on one background thread
+fed by a bounded queue, so a slow tracking server applies back-pressure to the
+producer instead of growing memory without limit.
+"""
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from mlflow.entities import Metric, Param
+from mlflow.tracking import MlflowClient
+from mlflow.utils.validation import MAX_METRICS_PER_BATCH, MAX_PARAMS_TAGS_PER_BATCH
+
+_STOP = object()
+
+
+class AsyncRunLogger:
+    def __init__(self, run_id: str, client: Optional[MlflowClient] = None, max_queue: int = 64):
+        self.run_id = run_id
+        self.client = client or MlflowClient()
+        self._params: List[Param] = []
+        self._metrics: List[Metric] = []
+        self._errors: List[BaseException] = []
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max(1, max_queue))
+        self._thread = threading.Thread(target=self._worker, name="mlflow-logger", daemon=True)
+        self._thread.start()
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _STOP:
+                    return
+                fn, args = item
+                fn(self.client, self.run_id, *args)
+            except Exception as e:
+                # Keep draining so one failed upload does not stall the producer
+                self._errors.append(e)
+            finally:
+                self._queue.task_done()
+
+    def submit(self, fn: Callable, *args: Any):
+        """Queue fn(client, run_id, *args) for the background thread; blocks while the queue is full."""
+        if not self._thread.is_alive():
+            raise RuntimeError("MLflow logger thread is not running")
+        self._queue.put((fn, args))
+
+    def log_params(self, params: Dict[str, Any]):
+        self._params.extend(Param(str(k), str(v)[:500]) for k, v in params.items())
+        if len(self._params) >= MAX_PARAMS_TAGS_PER_BATCH:
+            self._flush_params()
+
+    def log_metrics(self, metrics: Dict[str, float], step: int = 0):
+        ts = int(time.time() * 1000)
+        self._metrics.extend(Metric(str(k), float(v), ts, step) for k, v in metrics.items())
+        if len(self._metrics) >= MAX_METRICS_PER_BATCH:
+            self._flush_metrics()
+
+    def _flush_params(self):
+        while self._params:
+            batch, self._params = self._params[:MAX_PARAMS_TAGS_PER_BATCH], self._params[MAX_PARAMS_TAGS_PER_BATCH:]
+            self.submit(_log_batch, [], batch)
+
+    def _flush_metrics(self):
+        while self._metrics:
+            batch, self._metrics = self._metrics[:MAX_METRICS_PER_BATCH], self._metrics[MAX_METRICS_PER_BATCH:]
+            self.submit(_log_batch, batch, [])
+
+    def flush(self):
+        """Send buffered params/metrics and wait until every queued task has run."""
+        self._flush_params()
+        self._flush_metrics()
+        self._queue.join()
+
+    def close(self):
+        """Flush, stop the background thread and raise if any queued task failed."""
+        try:
+            self.flush()
+        finally:
+            self._queue.put(_STOP)
+            self._thread.join()
+        if self._errors:
+            raise RuntimeError(
+                f"{len(self._errors)} MLflow logging task(s) failed; first error: {self._errors[0]!r}"
+            ) from self._errors[0]
+
+
+def _log_batch(client: MlflowClient, run_id: str, metrics: List[Metric], params: List[Param]):
+    client.log_batch(run_id, metrics=metrics, params=params, synchronous=True)
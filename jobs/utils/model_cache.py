@@ -0,0 +1,88 @@
+"""
+On-disk cache for train_ml: fitted model parameters and per-series results.
+Entries are pickles addressed by a SHA-256 of their key parts, sharded into
+two-character subdirectories. Reads refresh the file mtime so eviction under
+the size cap is least-recently-used.
+"""
+import hashlib
+import os
+import pickle
+import tempfile
+from typing import Any, Optional
+
+
+def content_hash(obj: Any) -> str:
+    """Stable hash of a picklable/reprable value (e.g. a list of (week, units) tuples)."""
+    return hashlib.sha256(repr(obj).encode("utf-8")).hexdigest()
+
+
+class ModelCache:
+    def __init__(self, root: str, max_bytes: int = 512 * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(root, exist_ok=True)
+        self._size = sum(size for _, _, size in self._entries())
+
+    def _path(self, *key_parts: Any) -> str:
+        digest = hashlib.sha256(repr(key_parts).encode("utf-8")).hexdigest()
+        return os.path.join(self.root, digest[:2], digest + ".pkl")
+
+    def _entries(self):
+        """Yield (path, mtime, size) for every cached file."""
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if not name.endswith(".pkl"):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, st.st_mtime, st.st_size
+
+    def get(self, *key_parts: Any, count: bool = True) -> Optional[Any]:
+        """Return the cached value or None. `count=False` skips the hit/miss counters."""
+        path = self._path(*key_parts)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            if count:
+                self.misses += 1
+            return None
+        os.utime(path)
+        if count:
+            self.hits += 1
+        return value
+
+    def put(self, value: Any, *key_parts: Any):
+        path = self._path(*key_parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            old_size = os.path.getsize(path)
+        except FileNotFoundError:
+            old_size = 0
+        # Write-then-rename so concurrent readers never see a partial pickle
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+        self._size += os.path.getsize(path) - old_size
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Delete least-recently-used entries until the cache fits in max_bytes."""
+        entries = sorted(self._entries(), key=lambda e: e[1])
+        total = sum(size for _, _, size in entries)
+        for path, _, size in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._size = total
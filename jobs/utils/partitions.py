@@ -0,0 +1,129 @@
+"""
+Monthly range partitions of the daily raw fact tables.
+
+Migration 13 partitions raw.sales_fact and raw.inventory_snapshot by RANGE
+(date): the pre-migration heap is one <table>_legacy partition, and every
+later month is a <table>_yYYYYmMM partition over [first day, first day of the
+next month). There is no default partition, so writers create the months they
+need first (ensure_partitions; jobs.ingest does this before loading), and a
+row for a missing month fails instead of landing somewhere unprunable.
+Retention detaches whole partitions that end on or before a cutoff, which is
+a catalog change rather than a DELETE. On a database without the migration
+the tables are plain heaps and these helpers do nothing.
+
+    ensure_partitions(conn, "raw.sales_fact", start_date, end_date)
+    detach_partitions(conn, "raw.sales_fact", cutoff, archive_schema="archive")
+"""
+import re
+from datetime import date
+from typing import List, NamedTuple, Optional
+
+PARTITIONED_TABLES = ("raw.sales_fact", "raw.inventory_snapshot")
+ARCHIVE_SCHEMA = "archive"
+_BOUND_RE = re.compile(r"FOR VALUES FROM \('([0-9-]+)'\) TO \('([0-9-]+)'\)")
+
+
+class Partition(NamedTuple):
+    name: str  # schema-qualified
+    lower: date  # inclusive
+    upper: date  # exclusive
+
+
+def month_start(d: date) -> date:
+    return d.replace(day=1)
+
+
+def add_months(d: date, months: int) -> date:
+    """First day of the month `months` after d's month."""
+    k = d.year * 12 + d.month - 1 + months
+    return date(k // 12, k % 12 + 1, 1)
+
+
+def partition_name(table: str, month: date) -> str:
+    return f"{table}_y{month.year:04d}m{month.month:02d}"
+
+
+def is_partitioned(conn, table: str) -> bool:
+    with conn.cursor() as cur:
+        cur.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)", (table,))
+        return cur.fetchone() is not None
+
+
+def list_partitions(conn, table: str) -> List[Partition]:
+    """Range partitions of table ordered by lower bound ([] if it is not partitioned)."""
+    with conn.cursor() as cur:
+        cur.execute("""
+          SELECT c.oid::regclass::text, pg_get_expr(c.relpartbound, c.oid)
+          FROM pg_inherits i
+          JOIN pg_class c ON c.oid = i.inhrelid
+          WHERE i.inhparent = to_regclass(%s)
+        """, (table,))
+        rows = cur.fetchall()
+    out = []
+    for name, bound in rows:
+        m = _BOUND_RE.search(bound or "")
+        if m:
+            out.append(Partition(name, date.fromisoformat(m.group(1)), date.fromisoformat(m.group(2))))
+    return sorted(out, key=lambda p: p.lower)
+
+
+def ensure_partitions(conn, table: str, first: date, last: date) -> List[str]:
+    """
+    Create the monthly partitions of table covering [first, last] that are
+    not covered yet. Returns the names created; no-op if table is not
+    partitioned. Commits.
+    """
+    if not is_partitioned(conn, table):
+        return []
+    existing = list_partitions(conn, table)
+    created = []
+    month = month_start(first)
+    with conn.cursor() as cur:
+        while month <= last:
+            upper = add_months(month, 1)
+            if not any(p.lower < upper and month < p.upper for p in existing):
+                name = partition_name(table, month)
+                cur.execute(
+                    f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)",
+                    (month, upper),
+                )
+                created.append(name)
+            month = upper
+    conn.commit()
+    return created
+
+
+def detach_partitions(
+    conn, table: str, cutoff: date, archive_schema: Optional[str] = ARCHIVE_SCHEMA,
+    drop: bool = False, concurrently: bool = False, dry_run: bool = False,
+) -> List[Partition]:
+    """
+    Detach every partition of table whose range ends on or before cutoff,
+    then move it to archive_schema (or drop it with drop=True; with neither
+    it stays a standalone table next to the parent). concurrently uses
+    DETACH PARTITION ... CONCURRENTLY, which does not block queries on the
+    parent but cannot run inside a transaction, so each detach commits on
+    its own. Returns the partitions detached (or that would be, dry_run).
+    """
+    old = [p for p in list_partitions(conn, table) if p.upper <= cutoff]
+    if dry_run or not old:
+        return old
+    conn.commit()
+    if concurrently:
+        conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            if archive_schema and not drop:
+                cur.execute(f"CREATE SCHEMA IF NOT EXISTS {archive_schema}")
+            for p in old:
+                cur.execute(f"ALTER TABLE {table} DETACH PARTITION {p.name}{' CONCURRENTLY' if concurrently else ''}")
+                if drop:
+                    cur.execute(f"DROP TABLE {p.name}")
+                elif archive_schema:
+                    cur.execute(f"ALTER TABLE {p.name} SET SCHEMA {archive_schema}")
+                if not concurrently:
+                    conn.commit()
+    finally:
+        if concurrently:
+            conn.autocommit = False
+    return old
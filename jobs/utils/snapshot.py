@@ -0,0 +1,234 @@
+"""
+Versioned columnar snapshots of the curated tables.
+
+preprocess publishes curated.weekly_demand and curated.weekly_inventory as
+Arrow IPC files under <root>/<version>/, read in one REPEATABLE READ
+transaction and ordered like the SQL loaders (sku_id, location_id,
+week_start_date). A manifest.json records the ops.etl_watermark rows the
+snapshot was built from, and <root>/CURRENT is switched to the new version
+by an atomic rename. Downstream jobs open the current snapshot memory-mapped
+only while its watermarks still equal ops.etl_watermark (every preprocess
+run that writes curated rows bumps them) and otherwise fall back to SQL.
+Older versions beyond KEEP_VERSIONS are deleted; readers that still map them
+keep working, as unlinked files stay readable on POSIX.
+
+    snapshot = open_snapshot(conn, args.snapshot_dir)  # None -> use SQL
+    panel = DemandPanel.load(conn, snapshot=snapshot)
+"""
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Sequence, Tuple
+import numpy as np
+import pyarrow as pa
+
+FORMAT_VERSION = 1
+KEEP_VERSIONS = 2
+FETCH_ROWS = 100_000
+CURRENT = "CURRENT"
+MANIFEST = "manifest.json"
+
+# Snapshot table -> (columns, Arrow types, SELECT list); values are cast in SQL to match the types
+TABLES: Dict[str, Tuple[Tuple[str, ...], Tuple[pa.DataType, ...], str]] = {
+    "weekly_demand": (
+        ("sku_id", "location_id", "week_start_date", "units_sold"),
+        (pa.string(), pa.string(), pa.date32(), pa.int32()),
+        "sku_id, location_id, week_start_date, units_sold",
+    ),
+    "weekly_inventory": (
+        ("sku_id", "location_id", "week_start_date", "avg_on_hand", "end_on_hand", "end_on_order"),
+        (pa.string(), pa.string(), pa.date32(), pa.float64(), pa.int32(), pa.int32()),
+        "sku_id, location_id, week_start_date, avg_on_hand::float8, end_on_hand, end_on_order",
+    ),
+}
+
+
+def add_snapshot_arguments(parser):
+    """--snapshot-dir option shared by the jobs that publish or read snapshots."""
+    parser.add_argument("--snapshot-dir", type=str, default=os.getenv("SNAPSHOT_DIR") or None,
+                        help="Directory of columnar curated-table snapshots (default: $SNAPSHOT_DIR; unset = SQL only)")
+
+
+def fetch_etl_watermarks(conn) -> Dict[str, List[Optional[str]]]:
+    """ops.etl_watermark as {source_table: [max_created_at, max_date, updated_at]} in ISO format."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT source_table, max_created_at, max_date, updated_at FROM ops.etl_watermark")
+        rows = cur.fetchall()
+    return {
+        table: [v.isoformat() if v is not None else None for v in values]
+        for table, *values in sorted(rows)
+    }
+
+
+def _write_table(conn, name: str, path: str) -> Tuple[int, Optional[str], Optional[str]]:
+    """Stream one curated table into an Arrow IPC file. Returns (rows, first week, last week)."""
+    columns, types, select = TABLES[name]
+    schema = pa.schema(list(zip(columns, types)))
+    n_rows, first_week, last_week = 0, None, None
+    with conn.cursor(name=f"snapshot_{name}") as cur, pa.OSFile(path, "wb") as sink, \
+            pa.ipc.new_file(sink, schema) as writer:
+        cur.itersize = FETCH_ROWS
+        cur.execute(f"SELECT {select} FROM curated.{name} ORDER BY sku_id, location_id, week_start_date")
+        while True:
+            rows = cur.fetchmany(FETCH_ROWS)
+            if not rows:
+                break
+            arrays = [pa.array(values, type=t) for values, t in zip(zip(*rows), types)]
+            writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+            lo, hi = min(row[2] for row in rows), max(row[2] for row in rows)
+            first_week = lo if first_week is None else min(first_week, lo)
+            last_week = hi if last_week is None else max(last_week, hi)
+            n_rows += len(rows)
+    return n_rows, first_week and first_week.isoformat(), last_week and last_week.isoformat()
+
+
+def export_snapshot(conn, root: str, keep: int = KEEP_VERSIONS) -> Dict:
+    """
+    Write a new snapshot version of TABLES under root, make it current and
+    prune old versions. Returns its manifest.
+    """
+    os.makedirs(root, exist_ok=True)
+    version = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+    tmp = tempfile.mkdtemp(dir=root, prefix=".tmp-")
+    conn.commit()
+    try:
+        with conn.cursor() as cur:
+            # One MVCC snapshot for the watermarks and every table
+            cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        manifest = {
+            "format_version": FORMAT_VERSION,
+            "version": version,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "watermarks": fetch_etl_watermarks(conn),
+            "tables": {},
+        }
+        for name in TABLES:
+            rows, first_week, last_week = _write_table(conn, name, os.path.join(tmp, f"{name}.arrow"))
+            manifest["tables"][name] = {
+                "file": f"{name}.arrow", "rows": rows, "first_week": first_week, "last_week": last_week,
+            }
+        conn.commit()
+        with open(os.path.join(tmp, MANIFEST), "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.rename(tmp, os.path.join(root, version))
+    except BaseException:
+        conn.rollback()
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    fd, pointer = tempfile.mkstemp(dir=root, prefix=".tmp-")
+    with os.fdopen(fd, "w") as f:
+        f.write(version + "\n")
+    os.replace(pointer, os.path.join(root, CURRENT))
+    for old in sorted(_versions(root))[:-max(1, keep)]:
+        shutil.rmtree(os.path.join(root, old), ignore_errors=True)
+    return manifest
+
+
+def _versions(root: str) -> List[str]:
+    return [
+        name for name in os.listdir(root)
+        if not name.startswith(".") and os.path.isfile(os.path.join(root, name, MANIFEST))
+    ]
+
+
+def read_manifest(root: str) -> Optional[Dict]:
+    """Manifest of the current snapshot under root, or None if there is none."""
+    try:
+        with open(os.path.join(root, CURRENT)) as f:
+            version = f.read().strip()
+        with open(os.path.join(root, version, MANIFEST)) as f:
+            return json.load(f)
+    except (FileNotFoundError, NotADirectoryError, json.JSONDecodeError):
+        return None
+
+
+class Snapshot:
+    """A published snapshot version; tables are memory-mapped on first use."""
+
+    def __init__(self, path: str, manifest: Dict):
+        self.path = path
+        self.manifest = manifest
+        self.version = manifest["version"]
+        self._tables: Dict[str, pa.Table] = {}
+        self._series: Dict[str, Tuple[List[Tuple[str, str]], np.ndarray]] = {}
+        self._columns: Dict[Tuple[str, str], np.ndarray] = {}
+
+    def table(self, name: str) -> pa.Table:
+        if name not in self._tables:
+            source = pa.memory_map(os.path.join(self.path, self.manifest["tables"][name]["file"]), "r")
+            self._tables[name] = pa.ipc.open_file(source).read_all()
+        return self._tables[name]
+
+    def column(self, name: str, column: str) -> np.ndarray:
+        """One column as a numpy array (dates as datetime64[D]); cached."""
+        if (name, column) not in self._columns:
+            values = self.table(name).column(column)
+            if pa.types.is_date32(values.type):
+                self._columns[name, column] = values.to_numpy().astype("datetime64[D]")
+            else:
+                self._columns[name, column] = values.to_numpy()
+        return self._columns[name, column]
+
+    def series(self, name: str) -> Tuple[List[Tuple[str, str]], np.ndarray]:
+        """
+        (keys, bounds) of a table's (sku_id, location_id) runs: rows of
+        keys[i] are bounds[i]:bounds[i + 1]. Cached.
+        """
+        if name not in self._series:
+            table = self.table(name)
+            n = table.num_rows
+            sku = table.column("sku_id").to_numpy(zero_copy_only=False)
+            loc = table.column("location_id").to_numpy(zero_copy_only=False)
+            change = np.ones(n, dtype=bool)
+            if n > 1:
+                change[1:] = (sku[1:] != sku[:-1]) | (loc[1:] != loc[:-1])
+            starts = np.flatnonzero(change)
+            keys = list(zip(sku[starts].tolist(), loc[starts].tolist()))
+            self._series[name] = (keys, np.append(starts, n))
+        return self._series[name]
+
+    def rows_for(self, name: str, keys: Optional[Sequence[Tuple[str, str]]] = None) -> Tuple[List[Tuple[str, str]], np.ndarray, np.ndarray]:
+        """
+        (keys, series code per row, row indices) of a table, restricted to
+        `keys` if given; keys keep the table order.
+        """
+        all_keys, bounds = self.series(name)
+        codes = range(len(all_keys))
+        if keys is not None:
+            wanted = set(map(tuple, keys))
+            codes = [i for i, key in enumerate(all_keys) if key in wanted]
+        lengths = np.array([bounds[i + 1] - bounds[i] for i in codes], dtype=np.int64)
+        rows = np.concatenate([np.arange(bounds[i], bounds[i + 1]) for i in codes]) if len(lengths) else np.zeros(0, dtype=np.int64)
+        return [all_keys[i] for i in codes], np.repeat(np.arange(len(lengths)), lengths), rows
+
+
+def open_snapshot(conn, root: Optional[str]) -> Optional[Snapshot]:
+    """
+    The current snapshot under root if it was built from the current
+    ops.etl_watermark rows; None (after printing why) when root is unset or
+    the snapshot is missing or stale, in which case the caller reads SQL.
+    """
+    if not root:
+        return None
+    manifest = read_manifest(root)
+    if manifest is None or manifest.get("format_version") != FORMAT_VERSION:
+        print(f"No usable snapshot in {root}; reading curated tables from Postgres")
+        return None
+    watermarks = fetch_etl_watermarks(conn)
+    conn.commit()
+    if manifest["watermarks"] != watermarks:
+        print(f"Snapshot {manifest['version']} is stale (curated tables changed since); reading from Postgres")
+        return None
+    print(f"Reading curated tables from snapshot {manifest['version']}")
+    return Snapshot(os.path.join(root, manifest["version"]), manifest)
+
+
+def is_current(conn, root: str) -> bool:
+    """Whether the current snapshot under root matches ops.etl_watermark."""
+    manifest = read_manifest(root)
+    current = manifest is not None and manifest.get("format_version") == FORMAT_VERSION \
+        and manifest["watermarks"] == fetch_etl_watermarks(conn)
+    conn.commit()
+    return current
@@ -0,0 +1,294 @@
+"""
+Lease-based work queue over ops.work_item for splitting a batch run across
+worker processes on any number of hosts.
+
+A coordinator creates the batch_run and its items (batches of series keys).
+Workers claim one item at a time with SELECT ... FOR UPDATE SKIP LOCKED, so
+concurrent claims never block on or return the same row, and hold it under a
+lease that they renew while working. An item whose lease expired (crashed or
+stalled worker) is claimable again. Result writes are idempotent upserts, so
+an item processed twice after a lost lease is harmless. The run is finished
+as succeeded once every item is done, or failed once the remaining items have
+exhausted their attempts.
+"""
+import argparse
+import os
+import socket
+import time
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+import uuid
+
+MAX_ATTEMPTS = 3
+LEASE_SECONDS = 600
+POLL_SECONDS = 5.0
+BATCH_SIZE = 100
+
+
+class LeaseLost(RuntimeError):
+    """The item's lease expired and another worker claimed it."""
+
+
+class WorkItem(NamedTuple):
+    run_id: str
+    item_no: int
+    keys: List[Tuple[str, str]]
+    attempts: int
+    worker_id: str
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def add_work_queue_arguments(parser: argparse.ArgumentParser):
+    """CLI options shared by the jobs that can run as coordinator/worker."""
+    parser.add_argument("--mode", choices=["single", "coordinator", "worker"], default="single",
+                        help="single: whole run in this process; coordinator: create the run and its work "
+                             "items, then exit; worker: claim and process items of a coordinated run")
+    parser.add_argument("--run-id", type=str, default=None,
+                        help="Run to work on in worker mode (default: latest running run with open items)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Series per work item (coordinator)")
+    parser.add_argument("--lease-seconds", type=float, default=LEASE_SECONDS,
+                        help="Lease length; an item not renewed within it is handed to another worker")
+    parser.add_argument("--poll-seconds", type=float, default=POLL_SECONDS,
+                        help="Wait between claim attempts while other workers hold the remaining items")
+    parser.add_argument("--max-attempts", type=int, default=MAX_ATTEMPTS,
+                        help="Claims per item before it is marked failed")
+    parser.add_argument("--worker-id", type=str, default=None, help="Worker name in ops.work_item (default: host:pid)")
+
+
+def create_work_items(conn, run_id: uuid.UUID, keys: Sequence[Tuple[str, str]], batch_size: int) -> int:
+    """Split `keys` into items of up to batch_size series. Returns the number of items."""
+    batch_size = max(1, batch_size)
+    rows = []
+    for item_no, start in enumerate(range(0, len(keys), batch_size)):
+        batch = keys[start:start + batch_size]
+        rows.append((str(run_id), item_no, [k[0] for k in batch], [k[1] for k in batch]))
+    with conn.cursor() as cur:
+        cur.executemany("""
+          INSERT INTO ops.work_item (run_id, item_no, sku_ids, location_ids)
+          VALUES (%s, %s, %s, %s)
+          ON CONFLICT (run_id, item_no) DO NOTHING
+        """, rows)
+    conn.commit()
+    return len(rows)
+
+
+def claim_work_item(conn, run_id: uuid.UUID, worker_id: str, lease_seconds: float,
+                    max_attempts: int = MAX_ATTEMPTS) -> Optional[WorkItem]:
+    """Lease the next pending or lease-expired item of the run, or return None if there is none right now."""
+    with conn.cursor() as cur:
+        cur.execute("""
+          UPDATE ops.work_item w
+          SET status = 'leased', leased_by = %s, attempts = w.attempts + 1,
+              lease_expires_at = NOW() + make_interval(secs => %s), started_at = NOW()
+          FROM (
+            SELECT run_id, item_no
+            FROM ops.work_item
+            WHERE run_id = %s AND attempts < %s
+              AND (status = 'pending' OR (status = 'leased' AND lease_expires_at < NOW()))
+            ORDER BY item_no
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+          ) next_item
+          WHERE w.run_id = next_item.run_id AND w.item_no = next_item.item_no
+          RETURNING w.item_no, w.sku_ids, w.location_ids, w.attempts
+        """, (worker_id, float(lease_seconds), str(run_id), max_attempts))
+        row = cur.fetchone()
+    conn.commit()
+    if row is None:
+        return None
+    item_no, sku_ids, location_ids, attempts = row
+    return WorkItem(str(run_id), item_no, list(zip(sku_ids, location_ids)), attempts, worker_id)
+
+
+def renew_lease(conn, item: WorkItem, lease_seconds: float) -> bool:
+    """Extend the lease; False if it was lost (expired and claimed by another worker)."""
+    with conn.cursor() as cur:
+        cur.execute("""
+          UPDATE ops.work_item
+          SET lease_expires_at = NOW() + make_interval(secs => %s)
+          WHERE run_id = %s AND item_no = %s AND status = 'leased' AND leased_by = %s
+        """, (float(lease_seconds), item.run_id, item.item_no, item.worker_id))
+        renewed = cur.rowcount == 1
+    conn.commit()
+    return renewed
+
+
+def complete_work_item(conn, item: WorkItem, notes: Optional[str] = None) -> bool:
+    """Mark the item done; False if the lease was lost (another worker now owns it)."""
+    with conn.cursor() as cur:
+        cur.execute("""
+          UPDATE ops.work_item
+          SET status = 'done', finished_at = NOW(), lease_expires_at = NULL, notes = %s
+          WHERE run_id = %s AND item_no = %s AND status = 'leased' AND leased_by = %s
+        """, (notes, item.run_id, item.item_no, item.worker_id))
+        done = cur.rowcount == 1
+    conn.commit()
+    return done
+
+
+def fail_work_item(conn, item: WorkItem, error: str, max_attempts: int = MAX_ATTEMPTS):
+    """Release the item for a retry, or mark it failed once it has used max_attempts."""
+    conn.rollback()
+    with conn.cursor() as cur:
+        cur.execute("""
+          UPDATE ops.work_item
+          SET status = CASE WHEN attempts >= %s THEN 'failed' ELSE 'pending' END,
+              lease_expires_at = NULL, finished_at = NOW(), notes = %s
+          WHERE run_id = %s AND item_no = %s AND status = 'leased' AND leased_by = %s
+        """, (max_attempts, error[:500], item.run_id, item.item_no, item.worker_id))
+    conn.commit()
+
+
+def fail_exhausted_leases(conn, run_id: uuid.UUID, max_attempts: int = MAX_ATTEMPTS) -> int:
+    """Mark expired leases that cannot be retried any more as failed. Returns how many."""
+    with conn.cursor() as cur:
+        cur.execute("""
+          UPDATE ops.work_item
+          SET status = 'failed', finished_at = NOW(),
+              notes = COALESCE(notes, 'lease expired on the last attempt')
+          WHERE run_id = %s AND status = 'leased' AND lease_expires_at < NOW() AND attempts >= %s
+        """, (str(run_id), max_attempts))
+        n = cur.rowcount
+    conn.commit()
+    return n
+
+
+def work_item_counts(conn, run_id: uuid.UUID) -> Dict[str, int]:
+    with conn.cursor() as cur:
+        cur.execute("SELECT status, COUNT(*) FROM ops.work_item WHERE run_id = %s GROUP BY status", (str(run_id),))
+        counts = dict(cur.fetchall())
+    conn.commit()
+    return counts
+
+
+def iter_claims(conn, run_id: uuid.UUID, worker_id: str, lease_seconds: float,
+                poll_seconds: float = 5.0, max_attempts: int = MAX_ATTEMPTS) -> Iterator[WorkItem]:
+    """
+    Claim and yield items until none is left to do. While other workers still
+    hold live leases, keep polling so their items are picked up if they expire.
+    """
+    while True:
+        item = claim_work_item(conn, run_id, worker_id, lease_seconds, max_attempts)
+        if item is not None:
+            yield item
+            continue
+        fail_exhausted_leases(conn, run_id, max_attempts)
+        counts = work_item_counts(conn, run_id)
+        if not counts.get('pending') and not counts.get('leased'):
+            return
+        time.sleep(poll_seconds)
+
+
+def process_work_items(conn, run_id: uuid.UUID, worker_id: str,
+                       handler: Callable[[WorkItem, Callable[[], None]], Optional[str]],
+                       lease_seconds: float = LEASE_SECONDS, poll_seconds: float = POLL_SECONDS,
+                       max_attempts: int = MAX_ATTEMPTS) -> Dict[str, int]:
+    """
+    Claim items until the run has none left and call handler(item, heartbeat)
+    for each; its return value becomes the item's notes. The handler should
+    call heartbeat() regularly: it renews the lease (at most every third of
+    lease_seconds) and raises LeaseLost once another worker has taken the item
+    over. A handler error releases the item for a retry and moves on to the
+    next one. Returns counts of items done, failed and lost by this worker.
+    """
+    stats = {'done': 0, 'failed': 0, 'lost': 0}
+    for item in iter_claims(conn, run_id, worker_id, lease_seconds, poll_seconds, max_attempts):
+        renewed_at = time.monotonic()
+
+        def heartbeat():
+            nonlocal renewed_at
+            if time.monotonic() - renewed_at < lease_seconds / 3:
+                return
+            if not renew_lease(conn, item, lease_seconds):
+                raise LeaseLost(f"lease on item {item.item_no} of run {item.run_id} was lost")
+            renewed_at = time.monotonic()
+
+        try:
+            notes = handler(item, heartbeat)
+        except LeaseLost as e:
+            conn.rollback()
+            stats['lost'] += 1
+            print(f"  {e}; moving on")
+            continue
+        except Exception as e:
+            fail_work_item(conn, item, f"{type(e).__name__}: {e}", max_attempts)
+            stats['failed'] += 1
+            print(f"  item {item.item_no} failed (attempt {item.attempts}/{max_attempts}): {e!r}")
+            continue
+        if complete_work_item(conn, item, notes):
+            stats['done'] += 1
+        else:
+            stats['lost'] += 1
+    return stats
+
+
+def find_open_run(conn, job_type: str) -> Optional[str]:
+    """Latest running batch_run of job_type that has work items still to do."""
+    with conn.cursor() as cur:
+        cur.execute("""
+          SELECT r.run_id
+          FROM ops.batch_run r
+          WHERE r.job_type = %s AND r.status = 'running'
+            AND EXISTS (
+              SELECT 1 FROM ops.work_item w
+              WHERE w.run_id = r.run_id AND w.status IN ('pending', 'leased')
+            )
+          ORDER BY r.started_at DESC
+          LIMIT 1
+        """, (job_type,))
+        row = cur.fetchone()
+    conn.commit()
+    return str(row[0]) if row else None
+
+
+def item_counts(notes: Iterator[Optional[str]]) -> Dict[str, int]:
+    """Sum the integer name=value fields of comma-separated item notes, in order of first appearance."""
+    counts: Dict[str, int] = {}
+    for note in notes:
+        for field in (note or "").split(","):
+            name, sep, value = field.strip().partition("=")
+            if sep and value.lstrip("-").isdigit():
+                counts[name] = counts.get(name, 0) + int(value)
+    return counts
+
+
+def finish_run_if_complete(conn, run_id: uuid.UUID, notes: Optional[str] = None) -> Optional[str]:
+    """
+    Close the batch run once no item is pending or leased: 'succeeded' if all
+    are done, else 'failed'. The run row is locked so concurrent workers
+    finishing their last items close it exactly once. The run's notes sum the
+    name=count fields of its done items' notes (see item_counts). Returns the
+    status set by this call, or None.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT status FROM ops.batch_run WHERE run_id = %s FOR UPDATE", (str(run_id),))
+        row = cur.fetchone()
+        if row is None or row[0] != 'running':
+            conn.rollback()
+            return None
+        cur.execute("""
+          SELECT COUNT(*) FILTER (WHERE status IN ('pending', 'leased')),
+                 COUNT(*) FILTER (WHERE status = 'failed'),
+                 COUNT(*),
+                 COUNT(DISTINCT leased_by)
+          FROM ops.work_item WHERE run_id = %s
+        """, (str(run_id),))
+        open_items, failed, total, workers = cur.fetchone()
+        if open_items:
+            conn.rollback()
+            return None
+        status = 'failed' if failed else 'succeeded'
+        cur.execute("SELECT notes FROM ops.work_item WHERE run_id = %s AND status = 'done' ORDER BY item_no",
+                    (str(run_id),))
+        counts = item_counts(notes for (notes,) in cur.fetchall())
+        summary = f"work_items={total}, failed_items={failed}, workers={workers}"
+        summary += "".join(f", {name}={n}" for name, n in counts.items())
+        cur.execute("""
+          UPDATE ops.batch_run
+          SET status = %s, finished_at = NOW(), notes = %s
+          WHERE run_id = %s
+        """, (status, f"{summary}; {notes}" if notes else summary, str(run_id)))
+    conn.commit()
+    return status